@@ -0,0 +1,153 @@
+"""
+Agregados incrementales de llamadas (rollups) por empresa y por hora/día
+"""
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import Call, CallMessage, CallRollup
+
+GRANULARITIES = ("hour", "day")
+
+
+def bucket_start(value: datetime, granularity: str) -> datetime:
+    """Trunca una fecha al inicio de su bucket"""
+    if granularity == "day":
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def count_turns(db: Session, call_id: int) -> int:
+    """Número de turnos de la llamada (respuestas del asistente)"""
+    return db.query(func.count(CallMessage.id)).filter(
+        CallMessage.call_id == call_id,
+        CallMessage.role == "assistant"
+    ).scalar() or 0
+
+
+def _call_duration(call: Call, end_time: Optional[datetime] = None) -> float:
+    end_time = end_time or call.end_time
+    if not call.start_time or not end_time:
+        return 0.0
+    return max((end_time - call.start_time).total_seconds(), 0.0)
+
+
+def _upsert(db: Session, company_id: int, granularity: str, start: datetime, deltas: dict):
+    """Suma los deltas al bucket, creándolo si no existe (INSERT ... ON CONFLICT)"""
+    dialect = db.get_bind().dialect.name
+    insert = pg_insert if dialect == "postgresql" else sqlite_insert
+
+    values = {"company_id": company_id, "granularity": granularity, "bucket_start": start}
+    values.update(deltas)
+    stmt = insert(CallRollup).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["company_id", "granularity", "bucket_start"],
+        set_={field: getattr(CallRollup, field) + getattr(stmt.excluded, field) for field in deltas}
+    )
+    db.execute(stmt)
+
+
+def _apply(db: Session, company_id: int, when: datetime, deltas: dict):
+    for granularity in GRANULARITIES:
+        _upsert(db, company_id, granularity, bucket_start(when, granularity), deltas)
+
+
+def record_call_ended(db: Session, call: Call):
+    """
+    Suma una llamada recién finalizada a sus buckets de hora y día.
+    Debe llamarse una sola vez por llamada, cuando end_time pasa de NULL a un valor,
+    dentro de la misma transacción que guarda el end_time.
+    """
+    if call.start_time is None:
+        return
+
+    # La sesión no usa autoflush: asegurar que los mensajes pendientes se cuenten
+    db.flush()
+    _apply(db, call.company_id, call.start_time, _call_deltas(call, count_turns(db, call.id)))
+
+
+def _call_deltas(call: Call, turns: int) -> dict:
+    return {
+        "call_count": 1,
+        "rated_count": 1 if call.rating is not None else 0,
+        "rating_sum": call.rating or 0,
+        "duration_sum": _call_duration(call),
+        "turn_sum": turns,
+    }
+
+
+def record_call_change(db: Session, call: Call, previous_rating: Optional[int], previous_end_time: datetime):
+    """
+    Ajusta los buckets cuando cambian la calificación o el end_time de una llamada
+    que ya estaba contabilizada (por ejemplo, al volver a finalizarla)
+    """
+    if call.start_time is None:
+        return
+
+    deltas = {
+        "rated_count": (1 if call.rating is not None else 0) - (1 if previous_rating is not None else 0),
+        "rating_sum": (call.rating or 0) - (previous_rating or 0),
+        "duration_sum": _call_duration(call) - _call_duration(call, previous_end_time),
+    }
+    if any(deltas.values()):
+        _apply(db, call.company_id, call.start_time, deltas)
+
+
+def get_rollups(
+    db: Session,
+    granularity: str = "day",
+    company_id: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> Iterable[CallRollup]:
+    query = db.query(CallRollup).filter(CallRollup.granularity == granularity)
+    if company_id is not None:
+        query = query.filter(CallRollup.company_id == company_id)
+    if start is not None:
+        query = query.filter(CallRollup.bucket_start >= bucket_start(start, granularity))
+    if end is not None:
+        query = query.filter(CallRollup.bucket_start < end)
+    return query.order_by(CallRollup.bucket_start, CallRollup.company_id).all()
+
+
+def _averages(call_count: int, rated_count: int, rating_sum: int, duration_sum: float, turn_sum: int) -> dict:
+    return {
+        "call_count": call_count,
+        "avg_rating": round(rating_sum / rated_count, 2) if rated_count else None,
+        "avg_duration_seconds": round(duration_sum / call_count, 2) if call_count else None,
+        "avg_turns": round(turn_sum / call_count, 2) if call_count else None,
+    }
+
+
+def summarize(rollups: Iterable[CallRollup]) -> dict:
+    """Convierte los buckets en la respuesta del endpoint (O(buckets))"""
+    rollups = sorted(rollups, key=lambda rollup: (rollup.bucket_start, rollup.company_id))
+    buckets = []
+    totals = {"call_count": 0, "rated_count": 0, "rating_sum": 0, "duration_sum": 0.0, "turn_sum": 0}
+    for rollup in rollups:
+        bucket = {"company_id": rollup.company_id, "bucket_start": rollup.bucket_start}
+        bucket.update(_averages(
+            rollup.call_count, rollup.rated_count, rollup.rating_sum, rollup.duration_sum, rollup.turn_sum
+        ))
+        buckets.append(bucket)
+        for field in totals:
+            totals[field] += getattr(rollup, field) or 0
+    return {"buckets": buckets, "totals": _averages(**totals)}
+
+
+def move_call_rollups(source_db: Session, target_db: Session, call: Call, turns: int):
+    """
+    Resta una llamada finalizada de los buckets del shard origen y la suma a los del destino
+    (usado al mover una empresa de shard). Sin commit: cada lado se confirma en la misma
+    transacción que copia o borra la llamada, así los rollups de cada shard cuadran con sus llamadas.
+    """
+    if call.start_time is None or call.end_time is None:
+        return
+
+    deltas = _call_deltas(call, turns)
+    _apply(target_db, call.company_id, call.start_time, deltas)
+    _apply(source_db, call.company_id, call.start_time, {field: -value for field, value in deltas.items()})
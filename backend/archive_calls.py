@@ -0,0 +1,44 @@
+"""
+Script para archivar las llamadas finalizadas que superan la retención de su empresa
+
+Uso:
+    python archive_calls.py            # Archivar
+    python archive_calls.py --vacuum   # Archivar y compactar el archivo SQLite
+"""
+import sys
+from sqlalchemy import text
+from database import SessionLocal, engine, Base
+from archive_service import archive_expired_calls
+from sharding import shard_router, ShardSessions
+
+def archive_calls(vacuum: bool = False):
+    Base.metadata.create_all(bind=engine)
+    shard_router.init_schemas()
+    db = SessionLocal()
+    shards = ShardSessions(db)
+    try:
+        stats = archive_expired_calls(db, session_for_company=shards.for_company)
+        print(f"✓ {stats['calls']} llamadas archivadas ({stats['messages']} mensajes)")
+        if stats["compressed_bytes"]:
+            ratio = stats["raw_bytes"] / stats["compressed_bytes"]
+            print(f"  {stats['raw_bytes']} bytes -> {stats['compressed_bytes']} bytes ({ratio:.1f}x)")
+    except Exception as e:
+        print(f"Error archivando llamadas: {e}")
+        db.rollback()
+        raise
+    finally:
+        shards.close()
+        db.close()
+    
+    # SQLite no libera el espacio de las filas borradas hasta hacer VACUUM
+    if vacuum:
+        for shard_engine in shard_router.engines:
+            if shard_engine.dialect.name == "sqlite":
+                with shard_engine.connect() as conn:
+                    conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+        print("✓ Base de datos compactada")
+
+if __name__ == "__main__":
+    print("Archivando llamadas antiguas...")
+    archive_calls(vacuum="--vacuum" in sys.argv)
+    print("\nProceso completado.")
@@ -0,0 +1,154 @@
+"""
+Archivado en frío de llamadas finalizadas
+
+Los mensajes y el contexto de conversación de cada llamada se empaquetan en un
+único blob comprimido (zstd si está instalado, gzip si no) en la tabla call_archives.
+La fila de calls se conserva (es pequeña) para que los listados y la analítica
+sigan funcionando; call_messages, call_turn_traces y calls.conversation_context
+quedan vacíos.
+"""
+import gzip
+import json
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from models import Call, CallArchive, CallMessage, CallTurnTrace, Company
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_BATCH_SIZE = 100
+
+
+def _compress(data: bytes) -> tuple[str, bytes]:
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "gzip", gzip.compress(data, compresslevel=9)
+
+
+def _decompress(codec: str, payload: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("La llamada está archivada con zstd pero el paquete 'zstandard' no está instalado")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return gzip.decompress(payload)
+
+
+def archive_call(db: Session, call: Call) -> CallArchive:
+    """Mueve los mensajes y el contexto de una llamada a call_archives (sin hacer commit)"""
+    messages = db.query(CallMessage).filter(CallMessage.call_id == call.id).order_by(CallMessage.timestamp, CallMessage.id).all()
+    traces = (
+        db.query(CallTurnTrace.response_message_id, CallTurnTrace.request_message_id, CallTurnTrace.trace)
+        .filter(CallTurnTrace.call_id == call.id)
+        .all()
+    )
+    document = {
+        "conversation_context": call.conversation_context,
+        "messages": [
+            [msg.id, msg.role, msg.content, msg.timestamp.isoformat() if msg.timestamp else None]
+            for msg in messages
+        ],
+    }
+    if traces:
+        document["traces"] = [
+            [response_id, request_id, json.loads(trace)] for response_id, request_id, trace in traces
+        ]
+    raw = json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    codec, payload = _compress(raw)
+
+    archive = CallArchive(
+        call_id=call.id,
+        company_id=call.company_id,
+        codec=codec,
+        payload=payload,
+        message_count=len(messages),
+        assistant_turns=sum(1 for msg in messages if msg.role == "assistant"),
+        raw_size=len(raw),
+        compressed_size=len(payload),
+    )
+    db.add(archive)
+
+    db.query(CallMessage).filter(CallMessage.call_id == call.id).delete(synchronize_session=False)
+    db.query(CallTurnTrace).filter(CallTurnTrace.call_id == call.id).delete(synchronize_session=False)
+    call.conversation_context = None
+    call.archived_at = datetime.utcnow()
+    return archive
+
+
+def count_assistant_turns(archive: CallArchive) -> int:
+    """Turnos del asistente de un archivo anterior a la columna assistant_turns (descomprime el blob)"""
+    document = json.loads(_decompress(archive.codec, archive.payload))
+    return sum(1 for message in document.get("messages", []) if message[1] == "assistant")
+
+
+def load_archive(db: Session, call_id: int) -> Optional[dict]:
+    """
+    Lee una llamada archivada. Devuelve {"conversation_context": str, "messages": [dict]}
+    con los mensajes en el mismo formato que CallMessageResponse.
+    """
+    archive = db.query(CallArchive).filter(CallArchive.call_id == call_id).first()
+    if not archive:
+        return None
+
+    document = json.loads(_decompress(archive.codec, archive.payload))
+    traces = {}
+    for response_id, request_id, trace in document.get("traces", []):
+        trace["request_message_id"] = request_id
+        traces[response_id] = trace
+    return {
+        "conversation_context": document.get("conversation_context"),
+        "messages": [
+            {"id": msg_id, "role": role, "content": content, "timestamp": timestamp, "trace": traces.get(msg_id)}
+            for msg_id, role, content, timestamp in document.get("messages", [])
+        ],
+    }
+
+
+def archive_expired_calls(
+    db: Session,
+    now: Optional[datetime] = None,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    session_for_company: Optional[Callable[[int], Session]] = None,
+) -> dict:
+    """
+    Archiva las llamadas finalizadas que superan la retención de su empresa.
+    Las empresas se leen de db; las llamadas, del shard que devuelva session_for_company.
+    Hace commit por lotes para no mantener transacciones largas.
+    """
+    now = now or datetime.utcnow()
+    stats = {"calls": 0, "messages": 0, "raw_bytes": 0, "compressed_bytes": 0}
+
+    # Los esquemas exigen retention_days >= 1; valores guardados antes de validarlo se ignoran
+    companies = db.query(Company.id, Company.retention_days).filter(Company.retention_days >= 1).all()
+    for company_id, retention_days in companies:
+        cutoff = now - timedelta(days=retention_days)
+        call_db = session_for_company(company_id) if session_for_company else db
+        while True:
+            calls = (
+                call_db.query(Call)
+                .filter(
+                    Call.company_id == company_id,
+                    Call.end_time.isnot(None),
+                    Call.end_time < cutoff,
+                    Call.archived_at.is_(None),
+                )
+                .order_by(Call.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not calls:
+                break
+
+            for call in calls:
+                archive = archive_call(call_db, call)
+                stats["calls"] += 1
+                stats["messages"] += archive.message_count
+                stats["raw_bytes"] += archive.raw_size
+                stats["compressed_bytes"] += archive.compressed_size
+            call_db.commit()
+
+    return stats
@@ -1,21 +1,32 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+import asyncio
+import threading
+import time
 from jose import JWTError, jwt
 import bcrypt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
-from database import SessionLocal
+from database import get_db
 from models import User
-import os
-from dotenv import load_dotenv
+from settings import settings
 
-load_dotenv()
-
-SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
+SECRET_KEY = settings.secret_key
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 días
 
+# Coste de bcrypt (log2 de las iteraciones). Si cambia, los hashes se actualizan al iniciar sesión
+BCRYPT_ROUNDS = settings.bcrypt_rounds
+# Hilos dedicados a bcrypt (libera el GIL, así que escala con los núcleos)
+BCRYPT_WORKERS = settings.bcrypt_workers
+
+# Cache de usuarios autenticados (por email del token) para no consultar users en cada request
+AUTH_CACHE_TTL_SECONDS = settings.auth_cache_ttl_seconds
+AUTH_CACHE_MAX_SIZE = 10000
+
 security = HTTPBearer()
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -36,10 +47,58 @@ def get_password_hash(password: str) -> str:
     # Truncar contraseña si es muy larga (bcrypt tiene límite de 72 bytes)
     if len(password) > 72:
         password = password[:72]
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password, salt)
     return hashed.decode('utf-8')
 
+def _hash_rounds(hashed_password: str) -> Optional[int]:
+    """Extrae el coste de un hash bcrypt ($2b$12$...)"""
+    try:
+        return int(hashed_password.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def _verify_and_rehash(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    if not verify_password(plain_password, hashed_password):
+        return False, None
+    if _hash_rounds(hashed_password) != BCRYPT_ROUNDS:
+        return True, get_password_hash(plain_password)
+    return True, None
+
+# Pool acotado para que el trabajo de bcrypt no bloquee el event loop.
+# Se crea con el primer uso y se cierra en el apagado del servidor (lifespan).
+_password_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def _get_password_executor() -> ThreadPoolExecutor:
+    global _password_executor
+    with _executor_lock:
+        if _password_executor is None:
+            _password_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+        return _password_executor
+
+def shutdown_password_executor():
+    """Espera a que terminen los hashes en curso y libera los hilos de bcrypt"""
+    global _password_executor
+    with _executor_lock:
+        executor, _password_executor = _password_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+async def hash_password_async(password: str) -> str:
+    """Versión de get_password_hash para handlers async (se ejecuta en el pool de bcrypt)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_password_executor(), get_password_hash, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verifica la contraseña en el pool de bcrypt.
+    Retorna (válida, nuevo_hash); nuevo_hash tiene valor cuando el hash guardado
+    usa un coste distinto de BCRYPT_ROUNDS y debe reemplazarse.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_password_executor(), _verify_and_rehash, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -50,12 +109,60 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+class PrincipalCache:
+    """
+    Cache en memoria de usuarios verificados, con TTL corto.
+    Guarda copias desacopladas de la sesión (sin password_hash) para que
+    puedan compartirse entre requests. Los cambios hechos en otro proceso
+    se ven como máximo AUTH_CACHE_TTL_SECONDS después.
+    """
+    
+    def __init__(self, ttl: float = AUTH_CACHE_TTL_SECONDS, max_size: int = AUTH_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, email: str) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                del self._entries[email]
+                return None
+            return user
+    
+    def put(self, user: User):
+        snapshot = User(
+            id=user.id,
+            email=user.email,
+            name=user.name,
+            phone=user.phone,
+            role=user.role,
+            company_id=user.company_id,
+            created_at=user.created_at
+        )
+        with self._lock:
+            self._entries[user.email] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user.email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, email: str):
+        with self._lock:
+            self._entries.pop(email, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+principal_cache = PrincipalCache()
+
+def invalidate_user(email: str):
+    """Llamar cuando se crea, modifica o elimina un usuario o cambia su rol"""
+    principal_cache.invalidate(email)
 
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
@@ -76,9 +183,14 @@ async def get_current_user(
     except JWTError:
         raise credentials_exception
     
+    user = principal_cache.get(email)
+    if user is not None:
+        return user
+    
     user = db.query(User).filter(User.email == email).first()
     if user is None:
         raise credentials_exception
     
+    principal_cache.put(user)
     return user
 
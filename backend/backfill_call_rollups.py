@@ -0,0 +1,95 @@
+"""
+Script para reconstruir la tabla call_rollups a partir de las llamadas existentes
+"""
+from collections import defaultdict
+from sqlalchemy import func
+from database import engine, Base
+from models import Call, CallArchive, CallMessage, CallRollup
+from archive_service import count_assistant_turns
+from analytics_service import GRANULARITIES, bucket_start
+from sharding import shard_router
+
+def backfill_call_rollups():
+    """Recalcular los rollups de todos los shards"""
+    Base.metadata.create_all(bind=engine, tables=[CallRollup.__table__])
+    shard_router.init_schemas()
+    for shard, session_factory in enumerate(shard_router.sessionmakers):
+        print(f"Shard {shard}:")
+        backfill_shard(session_factory)
+
+def backfill_shard(session_factory):
+    """
+    Recalcular todos los buckets de hora y día desde las llamadas finalizadas.
+    Las llamadas archivadas ya no tienen call_messages: sus turnos salen de call_archives.
+    """
+    db = session_factory()
+    try:
+        fill_archive_turns(db)
+        turns = (
+            db.query(CallMessage.call_id, func.count(CallMessage.id).label("turns"))
+            .filter(CallMessage.role == "assistant")
+            .group_by(CallMessage.call_id)
+            .subquery()
+        )
+        calls = (
+            db.query(Call.company_id, Call.start_time, Call.end_time, Call.rating, turns.c.turns,
+                     CallArchive.assistant_turns)
+            .outerjoin(turns, turns.c.call_id == Call.id)
+            .outerjoin(CallArchive, CallArchive.call_id == Call.id)
+            .filter(Call.end_time.isnot(None), Call.start_time.isnot(None))
+            .yield_per(1000)
+        )
+        
+        # Acumular en memoria por bucket (O(buckets), no O(llamadas))
+        buckets = defaultdict(lambda: {
+            "call_count": 0, "rated_count": 0, "rating_sum": 0, "duration_sum": 0.0, "turn_sum": 0
+        })
+        processed = 0
+        for company_id, start_time, end_time, rating, turn_count, archived_turns in calls:
+            duration = max((end_time - start_time).total_seconds(), 0.0)
+            for granularity in GRANULARITIES:
+                bucket = buckets[(company_id, granularity, bucket_start(start_time, granularity))]
+                bucket["call_count"] += 1
+                bucket["rated_count"] += 1 if rating is not None else 0
+                bucket["rating_sum"] += rating or 0
+                bucket["duration_sum"] += duration
+                bucket["turn_sum"] += (turn_count or 0) + (archived_turns or 0)
+            processed += 1
+        
+        db.query(CallRollup).delete()
+        for (company_id, granularity, start), values in buckets.items():
+            db.add(CallRollup(company_id=company_id, granularity=granularity, bucket_start=start, **values))
+        db.commit()
+        print(f"✓ {processed} llamadas procesadas en {len(buckets)} buckets")
+    except Exception as e:
+        print(f"Error reconstruyendo rollups: {e}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def fill_archive_turns(db, batch_size: int = 100):
+    """Completa assistant_turns de los archivos creados antes de la columna (sin hacer commit)"""
+    filled = 0
+    while True:
+        archives = (
+            db.query(CallArchive)
+            .filter(CallArchive.assistant_turns.is_(None))
+            .order_by(CallArchive.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not archives:
+            break
+        for archive in archives:
+            archive.assistant_turns = count_assistant_turns(archive)
+        db.flush()
+        filled += len(archives)
+    if filled:
+        print(f"✓ Turnos contados en {filled} llamadas archivadas")
+    return filled
+
+if __name__ == "__main__":
+    print("Reconstruyendo agregados de llamadas...")
+    backfill_call_rollups()
+    print("\nProceso completado.")
@@ -0,0 +1,339 @@
+"""
+Micro-benchmarks de las funciones calientes del backend, con línea base y umbral de regresión
+
+- Contexto de text_to_text: construir los mensajes (json.loads del contexto) y guardar el
+  contexto (json.dumps) con 1, 10 y 50 turnos previos
+- GroqService._check_if_user_wants_to_end
+- TwilioService.generate_twiml_for_call
+- Respuestas Pydantic de GET /api/calls (200 llamadas) y GET /api/calls/{id} (20 y 200 mensajes)
+- get_current_user: decodificar el JWT y leer el usuario de la cache
+- Resolución de empresa de /api/voice/process (cache con 500 empresas)
+
+Cada benchmark se mide con timeit (número de iteraciones automático, GC desactivado)
+--repeat veces, intercalando las repeticiones de todos los benchmarks; se guardan la mediana y
+la dispersión (MAD, desviación absoluta mediana) en µs por operación. Un bucle de calibración
+fijo mide la velocidad de la máquina en cada ejecución y la línea base se escala con ella,
+así que una máquina más lenta o más cargada no cuenta como regresión. Los datos son fijos y no se usa red ni la base de datos real (una
+SQLite temporal para la cache de empresas).
+
+Una regresión es una mediana más lenta que la de la línea base por encima del mayor de:
+- el umbral relativo (--threshold, 25 %)
+- el ruido medido: NOISE_FACTOR × la MAD más alta de las dos mediciones
+- un margen absoluto de NOISE_FLOOR_US µs (operaciones de microsegundos)
+
+La línea base depende de la máquina, así que no se versiona: se guarda en
+benchmark_results/ en la máquina (o el runner de CI) donde se compara. Solo se sale con
+código 1 si la línea base se midió en el mismo entorno (Python, plataforma y núcleos);
+si no, se informa de la diferencia sin fallar.
+
+Uso:
+    python benchmark_hotpaths.py --save-baseline      # Guardar la línea base en esta máquina
+    python benchmark_hotpaths.py                      # Medir y comparar con la línea base
+    python benchmark_hotpaths.py --filter twiml       # Solo los benchmarks que contienen "twiml"
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BACKEND_DIR, "benchmark_results", "hotpaths-baseline.json")
+REGRESSION_THRESHOLD = 0.25  # 25 % más lento que la línea base
+NOISE_FACTOR = 4  # Veces la MAD que se considera ruido
+NOISE_FLOOR_US = 0.5  # Margen absoluto para las operaciones más rápidas
+DEFAULT_REPEAT = 25
+CALIBRATION = "_calibration"
+MIN_RUN_SECONDS = 0.02
+
+_db_dir = tempfile.mkdtemp(prefix="voice-bench-")
+# Configuración fija antes de importar el backend (settings se lee al importar)
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(_db_dir, 'bench.db')}",
+    "SHARD_DATABASE_URLS": "",
+    "TTS_CACHE_DIR": os.path.join(_db_dir, "tts_cache"),
+    "GROQ_API_KEY": "benchmark",
+    "SECRET_KEY": "benchmark-secret",
+    "COMPANY_CACHE_CHECK_SECONDS": "3600",
+    "AUTH_CACHE_TTL_SECONDS": "3600",
+})
+atexit.register(shutil.rmtree, _db_dir, ignore_errors=True)
+sys.path.insert(0, BACKEND_DIR)
+
+import auth  # noqa: E402
+import main  # noqa: E402
+from database import SessionLocal  # noqa: E402
+from groq_service import GroqService  # noqa: E402
+from models import Call, CallMessage, Company, User  # noqa: E402
+from schema_setup import init_schema  # noqa: E402
+from twilio_service import TwilioService, welcome_message  # noqa: E402
+
+BUSINESS_LOGIC = (
+    "Eres el asistente de Pizzería Don Luigi. Horario: lunes a domingo de 12:00 a 23:00. "
+    "Servicio a domicilio en un radio de 5 km. Promoción: 2x1 los martes. " * 5
+)
+USER_TURN = "Hola, quisiera saber si tienen servicio a domicilio y cuánto tarda en llegar el pedido"
+ASSISTANT_TURN = (
+    "Claro, tenemos servicio a domicilio en un radio de cinco kilómetros. "
+    "El pedido tarda entre treinta y cuarenta y cinco minutos. ¿Quieres hacer un pedido?"
+)
+BASE_TIME = datetime(2026, 1, 1, 12, 0, 0)
+ACTION_URL = "https://example.com/api/twilio/gather?call_id=1099511627776"
+PARTIAL_URL = "https://example.com/api/twilio/partial?call_id=1099511627776"
+AUDIO_URL = "https://example.com/api/tts/" + "ab" * 32 + ".wav"
+
+
+# ---------- Datos ----------
+
+def _context_json(groq: GroqService, turns: int) -> str:
+    messages = groq._build_messages(USER_TURN, BUSINESS_LOGIC)
+    for _ in range(turns - 1):
+        messages.append({"role": "assistant", "content": ASSISTANT_TURN})
+        messages.append({"role": "user", "content": USER_TURN})
+    messages.append({"role": "assistant", "content": ASSISTANT_TURN})
+    return groq._dump_context(messages)
+
+
+def _calls(count: int) -> list:
+    return [
+        Call(id=i, company_id=1 + i % 5, client_id=None if i % 3 else i, start_time=BASE_TIME + timedelta(minutes=i),
+             end_time=BASE_TIME + timedelta(minutes=i + 3), rating=i % 6 or None)
+        for i in range(1, count + 1)
+    ]
+
+
+def _messages(count: int) -> tuple[list, dict]:
+    messages = [
+        CallMessage(id=i, call_id=1, role="user" if i % 2 else "assistant",
+                    content=USER_TURN if i % 2 else ASSISTANT_TURN, timestamp=BASE_TIME + timedelta(seconds=10 * i))
+        for i in range(1, count + 1)
+    ]
+    trace = {
+        "total_ms": 812.4, "stages": [["stt", 1.2, 160.3], ["llm", 162.0, 420.7], ["tts", 583.1, 210.2]],
+        "upstream": [{"op": "llm", "model": "openai/gpt-oss-120b", "ms": 418.0, "prompt_tokens": 812}],
+        "request_message_id": 1,
+    }
+    traces = {msg.id: trace for msg in messages if msg.role == "assistant"}
+    return messages, traces
+
+
+def seed_companies(count: int = 500):
+    init_schema()
+    db = SessionLocal()
+    try:
+        db.add_all(Company(name=f"Empresa {i}", identifier=f"empresa-{i}", business_logic=BUSINESS_LOGIC)
+                   for i in range(1, count + 1))
+        db.commit()
+    finally:
+        db.close()
+    main.company_resolver.warm()
+
+
+def _run_sync(coroutine):
+    """Ejecuta una corrutina que no llega a suspenderse (sin event loop)"""
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    raise RuntimeError("La corrutina se suspendió")
+
+
+# ---------- Benchmarks ----------
+
+def build_benchmarks() -> dict:
+    groq = GroqService()
+    twilio = TwilioService()
+    benchmarks = {}
+
+    for turns in (1, 10, 50):
+        context = _context_json(groq, turns)
+        messages = groq._build_messages(USER_TURN, BUSINESS_LOGIC, context)
+        benchmarks[f"text_to_text.build_messages[{turns} turnos]"] = (
+            lambda context=context: groq._build_messages(USER_TURN, BUSINESS_LOGIC, context))
+        benchmarks[f"text_to_text.dump_context[{turns} turnos]"] = (
+            lambda messages=messages: groq._dump_context(messages))
+
+    benchmarks["check_if_user_wants_to_end[sin despedida]"] = lambda: groq._check_if_user_wants_to_end(USER_TURN)
+    benchmarks["check_if_user_wants_to_end[despedida]"] = (
+        lambda: groq._check_if_user_wants_to_end("Perfecto, gracias, eso es todo"))
+
+    welcome = welcome_message("Pizzería Don Luigi")
+    benchmarks["generate_twiml_for_call[gather + say]"] = lambda: twilio.generate_twiml_for_call(
+        welcome, gather=True, action_url=ACTION_URL, partial_callback_url=PARTIAL_URL)
+    benchmarks["generate_twiml_for_call[gather + play]"] = lambda: twilio.generate_twiml_for_call(
+        welcome, gather=True, action_url=ACTION_URL, partial_callback_url=PARTIAL_URL, audio_url=AUDIO_URL)
+    benchmarks["generate_twiml_for_call[say + hangup]"] = lambda: twilio.generate_twiml_for_call(
+        ASSISTANT_TURN, gather=False)
+
+    calls = _calls(200)
+    benchmarks["get_calls.responses[200 llamadas]"] = lambda: main.build_call_responses(calls)
+    call = calls[0]
+    client = User(id=1, email="cliente@example.com", name="Cliente", phone="+5215512345678", role="client")
+    for count in (20, 200):
+        messages, traces = _messages(count)
+        context = _context_json(groq, count // 2)
+        benchmarks[f"get_call_detail.response[{count} mensajes]"] = (
+            lambda messages=messages, traces=traces, context=context: main.build_call_detail(
+                call, context, client, main.build_message_responses(messages, traces)))
+
+    user = User(id=1, email="admin@example.com", name="Admin", role="super_admin", company_id=None)
+    auth.principal_cache.put(user)
+    token = auth.create_access_token({"sub": user.email, "role": user.role})
+    credentials = auth.HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    benchmarks["jwt.decode"] = lambda: auth.jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+    benchmarks["get_current_user[cache]"] = lambda: _run_sync(auth.get_current_user(credentials, None))
+
+    seed_companies()
+    resolver = main.company_resolver
+    benchmarks["company_resolution[identifier]"] = lambda: resolver.resolve("empresa-250")
+    benchmarks["company_resolution[id]"] = lambda: resolver.resolve("250")
+    benchmarks["company_resolution[nombre]"] = lambda: resolver.resolve("Empresa 250")
+    return benchmarks
+
+
+def _calibration():
+    """Trabajo fijo de Python puro: mide la velocidad de la máquina en esta ejecución"""
+    total = 0
+    for i in range(200):
+        total += i * i
+    return total
+
+
+def measure_all(benchmarks: dict, repeat: int) -> dict:
+    """
+    Mediana y MAD del tiempo por operación (µs) de cada benchmark. Las repeticiones se
+    intercalan por rondas (todas los benchmarks en cada ronda), así que un cambio de
+    velocidad de la máquina durante la ejecución afecta a todos por igual y se refleja en la MAD.
+    """
+    timers = {}
+    for name, function in benchmarks.items():
+        timer = timeit.Timer(function)
+        number, elapsed = timer.autorange()
+        # Cada repetición dura unos MIN_RUN_SECONDS: muchas repeticiones cortas dan una mediana estable
+        timers[name] = (timer, max(1, int(number * MIN_RUN_SECONDS / max(elapsed, 1e-9))))
+    samples = {name: [] for name in benchmarks}
+    for _ in range(repeat):
+        for name, (timer, number) in timers.items():
+            samples[name].append(timer.timeit(number) / number * 1e6)
+
+    results = {}
+    for name, values in samples.items():
+        median = statistics.median(values)
+        mad = statistics.median(abs(value - median) for value in values)
+        results[name] = {"median": round(median, 3), "mad": round(mad, 3)}
+    return results
+
+
+def allowed_slowdown(base: dict, current: dict, threshold: float) -> float:
+    """µs que puede crecer la mediana sin contar como regresión (umbral, ruido o margen fijo)"""
+    noise = NOISE_FACTOR * max(base.get("mad", 0), current["mad"])
+    return max(threshold * base["median"], noise, NOISE_FLOOR_US)
+
+
+def speed_factor(baseline: dict, calibration: dict) -> float:
+    """Cuánto más lenta va la máquina que al guardar la línea base (1 = igual)"""
+    base = baseline.get("calibration")
+    if not base:
+        return 1.0
+    return calibration["median"] / base["median"]
+
+
+def _environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    # Líneas base antiguas: un solo número (mejor tiempo) por benchmark
+    baseline["benchmarks"] = {
+        name: value if isinstance(value, dict) else {"median": value, "mad": 0.0}
+        for name, value in baseline.get("benchmarks", {}).items()
+    }
+    return baseline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de las funciones calientes del backend")
+    parser.add_argument("--filter", default=None, help="Solo los benchmarks cuyo nombre contiene este texto")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=None,
+                        help=f"Fracción de regresión tolerada (por defecto la de la línea base o {REGRESSION_THRESHOLD})")
+    parser.add_argument("--save-baseline", action="store_true", help="Guardar los resultados como línea base")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    threshold = args.threshold if args.threshold is not None else baseline.get("threshold", REGRESSION_THRESHOLD)
+    base_results = baseline.get("benchmarks", {})
+    # Solo se falla contra una línea base del mismo entorno (no la de otra máquina)
+    gated = bool(baseline) and baseline.get("environment") == _environment()
+    if baseline and not gated:
+        print(f"⚠️ La línea base se midió en otro entorno ({baseline.get('environment')}): "
+              "se informa de las diferencias sin fallar")
+
+    benchmarks = {
+        name: function for name, function in build_benchmarks().items()
+        if not args.filter or args.filter in name
+    }
+    benchmarks[CALIBRATION] = _calibration
+    results = measure_all(benchmarks, args.repeat)
+    calibration = results.pop(CALIBRATION)
+    # La línea base se escala a la velocidad de la máquina en esta ejecución
+    speed = speed_factor(baseline, calibration)
+    if abs(speed - 1) > 0.05:
+        print(f"Velocidad de la máquina respecto a la línea base: {1 / speed:.2f}× (se compensa)")
+
+    regressions = []
+    print(f"{'benchmark':<46} {'µs/op':>10} {'±MAD':>7} {'base':>10} {'cambio':>8}")
+    for name, current in results.items():
+        base = base_results.get(name)
+        line = f"{name:<46} {current['median']:10.2f} {current['mad']:7.2f}"
+        if base:
+            base = {**base, "median": base["median"] * speed}
+            change = (current["median"] - base["median"]) / base["median"]
+            regressed = current["median"] - base["median"] > allowed_slowdown(base, current, threshold)
+            if regressed:
+                regressions.append(name)
+            print(f"{line} {base['median']:10.2f} {change * 100:+7.1f}% {'❌' if regressed else '✅'}")
+        else:
+            print(f"{line} {'-':>10} {'':>8}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        merged = dict(base_results) if args.filter else {}
+        merged.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "saved_at": datetime.now().isoformat(timespec="seconds"),
+                "environment": _environment(),
+                "threshold": threshold,
+                "calibration": calibration,
+                "benchmarks": merged,
+            }, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"\n✅ Línea base guardada en {args.baseline}")
+    elif regressions:
+        print(f"\n❌ {len(regressions)} benchmark(s) más lentos que la línea base "
+              f"(umbral {threshold * 100:.0f} %, ruido {NOISE_FACTOR}×MAD, margen {NOISE_FLOOR_US} µs):")
+        for name in regressions:
+            print(f"  - {name}")
+        if gated:
+            sys.exit(1)
+    elif base_results:
+        print(f"\n✅ Sin regresiones (umbral {threshold * 100:.0f} %, ruido {NOISE_FACTOR}×MAD, margen {NOISE_FLOOR_US} µs)")
+    else:
+        print(f"\nSin línea base: guárdala en esta máquina con --save-baseline ({args.baseline})")
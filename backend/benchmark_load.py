@@ -0,0 +1,452 @@
+"""
+Prueba de carga de extremo a extremo del pipeline de voz (sin red)
+
+1. Crea una base de datos temporal con una empresa y su número de Twilio
+2. Lanza fake_groq.py (STT, LLM y TTS locales con latencias configurables)
+3. Lanza el backend con uvicorn (un worker, o --workers N con serve.py) apuntando a él
+4. Simula --concurrency clientes a la vez hasta completar --calls conversaciones:
+   - voice: /api/voice/process con audio y --turns turnos por llamada
+   - twilio: /api/twilio/incoming, --turns veces /api/twilio/gather siguiendo el
+     TwiML (y descargando el audio de <Play>), y /api/twilio/status al colgar
+   - mixed: alterna ambas
+5. Informa del throughput y de p50/p95/p99 por endpoint (medido por el cliente) y
+   por etapa del turno (trazas de call_turn_traces), y guarda el resultado en JSON
+
+Uso:
+    python benchmark_load.py                                   # mixed, 10 clientes, 100 llamadas
+    python benchmark_load.py --scenario twilio --concurrency 50 --calls 500 --llm-ms 800
+    python benchmark_load.py --compare benchmark_results/load-20260101-120000.json
+    python benchmark_load.py --cassette cassettes/demo.jsonl --latency-scale 0.5   # Respuestas grabadas de Groq
+
+Con --cassette no se lanza fake_groq.py: el backend responde desde el cassette
+(groq_cassettes.py, GROQ_REPLAY_MATCH=sequence) con su latencia × --latency-scale.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+from html import unescape
+from urllib.parse import urlsplit
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmark_results")
+READY_TIMEOUT_SECONDS = 60
+COMPANY_IDENTIFIER = "loadtest"
+TWILIO_NUMBER = "+15550000001"
+PERCENTILES = (50, 95, 99)
+
+_GATHER_ACTION = re.compile(r'<Gather action="([^"]+)"')
+_PLAY = re.compile(r"<Play>([^<]+)</Play>")
+
+# Audio de relleno: fake_groq no lo decodifica, solo debe superar el tamaño mínimo
+FAKE_AUDIO = b"\x1a\x45\xdf\xa3" + bytes(range(256)) * 8
+
+SPEECH_RESULTS = [
+    "Hola, quisiera saber el horario de atención",
+    "¿Tienen servicio a domicilio?",
+    "Me gustaría agendar una cita para el jueves",
+    "¿Qué formas de pago aceptan?",
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, process: subprocess.Popen):
+    start = time.perf_counter()
+    while time.perf_counter() - start < READY_TIMEOUT_SECONDS:
+        if process.poll() is not None:
+            raise RuntimeError(f"El proceso terminó con código {process.returncode} ({url})")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"{url} no respondió en {READY_TIMEOUT_SECONDS} s")
+
+
+def _stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def percentiles(values) -> dict:
+    """p50/p95/p99 (rango más cercano), media y máximo en ms"""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    summary = {"count": len(ordered)}
+    for p in PERCENTILES:
+        index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+        summary[f"p{p}"] = round(ordered[index], 1)
+    summary["mean"] = round(statistics.fmean(ordered), 1)
+    summary["max"] = round(ordered[-1], 1)
+    return summary
+
+
+# ---------- Entorno ----------
+
+def server_environment(db_dir: str, port: int, groq_port: int, args) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(db_dir, 'load.db')}",
+        "SHARD_DATABASE_URLS": "",
+        "TTS_CACHE_DIR": os.path.join(db_dir, "tts_cache"),
+        "GROQ_API_KEY": "load-test",
+        "GROQ_BASE_URL": f"http://127.0.0.1:{groq_port}",
+        "GROQ_CASSETTE_MODE": "off",
+        "BASE_URL": f"http://127.0.0.1:{port}",
+        "TWILIO_PLAY_AUDIO": "true" if args.play_audio else "false",
+        "TWILIO_SPECULATION": "false",
+        "USAGE_FLUSH_SECONDS": "2",
+    })
+    if args.cassette:
+        # El audio y los textos de la prueba no son los grabados: se empareja solo por ruta
+        env.update({
+            "GROQ_CASSETTE_MODE": "replay",
+            "GROQ_CASSETTE": os.path.abspath(args.cassette),
+            "GROQ_REPLAY_MATCH": "sequence",
+            "GROQ_REPLAY_LATENCY_SCALE": str(args.latency_scale),
+        })
+    # Sin credenciales de Twilio: las llamadas se simulan aquí
+    for name in ("TWILIO_ACCOUNT_SID", "TWILIO_AUTH_TOKEN", "TWILIO_PHONE_NUMBER"):
+        env.pop(name, None)
+    return env
+
+
+def seed_database(env: dict):
+    """Esquema y empresa de prueba (se importa el backend con el entorno del servidor)"""
+    os.environ.update(env)
+    from database import SessionLocal
+    from models import Company, CompanyPhoneNumber
+    from schema_setup import init_schema
+
+    init_schema()
+    db = SessionLocal()
+    try:
+        company = Company(
+            name="Carga", identifier=COMPANY_IDENTIFIER,
+            business_logic="Eres el asistente de una tienda. Responde con amabilidad y brevedad.",
+        )
+        db.add(company)
+        db.flush()
+        db.add(CompanyPhoneNumber(company_id=company.id, phone_number=TWILIO_NUMBER))
+        db.commit()
+    finally:
+        db.close()
+
+
+def load_stage_traces() -> dict:
+    """Duraciones por etapa de las trazas guardadas (ms)"""
+    from database import SessionLocal
+    from models import CallTurnTrace
+
+    stages = defaultdict(list)
+    db = SessionLocal()
+    try:
+        for (trace_json,) in db.query(CallTurnTrace.trace).all():
+            trace = json.loads(trace_json)
+            stages["turn_total"].append(trace["total_ms"])
+            for name, _, duration_ms in trace.get("stages", []):
+                stages[name].append(duration_ms)
+            for upstream in trace.get("upstream", []):
+                if "ms" in upstream:
+                    stages[f"groq_{upstream['op']}"].append(upstream["ms"])
+    finally:
+        db.close()
+    return {name: percentiles(values) for name, values in sorted(stages.items())}
+
+
+# ---------- Clientes simulados ----------
+
+class LoadRecorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_samples = []
+        self.turns = 0
+        self.calls = 0
+
+    def ok(self, endpoint: str, start: float):
+        self.latencies[endpoint].append((time.perf_counter() - start) * 1000)
+
+    def fail(self, endpoint: str, message: str):
+        self.errors[endpoint] += 1
+        if len(self.error_samples) < 20:
+            self.error_samples.append(f"{endpoint}: {message}")
+
+
+async def voice_call(client: httpx.AsyncClient, recorder: LoadRecorder, turns: int):
+    call_id = None
+    for _ in range(turns):
+        data = {"company_identifier": COMPANY_IDENTIFIER}
+        if call_id is not None:
+            data["call_id"] = str(call_id)
+        start = time.perf_counter()
+        try:
+            response = await client.post("/api/voice/process", data=data,
+                                         files={"audio_file": ("audio.webm", FAKE_AUDIO, "audio/webm")})
+        except httpx.HTTPError as e:
+            recorder.fail("voice_process", repr(e))
+            return
+        if response.status_code != 200:
+            recorder.fail("voice_process", f"HTTP {response.status_code}: {response.text[:200]}")
+            return
+        recorder.ok("voice_process", start)
+        recorder.turns += 1
+        call_id = response.json()["call_id"]
+    recorder.calls += 1
+
+
+async def _twilio_post(client, recorder, endpoint: str, url: str, data: dict):
+    """POST como Twilio; devuelve el TwiML o None si falló"""
+    start = time.perf_counter()
+    try:
+        response = await client.post(url, data=data)
+    except httpx.HTTPError as e:
+        recorder.fail(endpoint, repr(e))
+        return None
+    if response.status_code != 200:
+        recorder.fail(endpoint, f"HTTP {response.status_code}: {response.text[:200]}")
+        return None
+    recorder.ok(endpoint, start)
+    return response.text
+
+
+async def _play_audio(client, recorder, twiml: str):
+    """Twilio descarga el audio de cada <Play> antes de reproducirlo"""
+    for url in _PLAY.findall(twiml):
+        start = time.perf_counter()
+        try:
+            response = await client.get(urlsplit(unescape(url)).path)
+        except httpx.HTTPError as e:
+            recorder.fail("tts_audio", repr(e))
+            continue
+        if response.status_code == 200:
+            recorder.ok("tts_audio", start)
+        else:
+            recorder.fail("tts_audio", f"HTTP {response.status_code}")
+
+
+async def twilio_call(client: httpx.AsyncClient, recorder: LoadRecorder, turns: int, index: int):
+    call_sid = f"CA{index:032x}"
+    twiml = await _twilio_post(client, recorder, "twilio_incoming", "/api/twilio/incoming",
+                               {"From": "+15559999999", "To": TWILIO_NUMBER, "CallSid": call_sid})
+    for turn in range(turns):
+        if twiml is None:
+            return
+        await _play_audio(client, recorder, twiml)
+        match = _GATHER_ACTION.search(twiml)
+        if not match:
+            recorder.fail("twilio_gather", "El TwiML no tiene <Gather> (la llamada terminó con error)")
+            return
+        action = urlsplit(unescape(match.group(1)))
+        twiml = await _twilio_post(client, recorder, "twilio_gather", f"{action.path}?{action.query}",
+                                   {"SpeechResult": SPEECH_RESULTS[(index + turn) % len(SPEECH_RESULTS)],
+                                    "CallSid": call_sid})
+        if twiml is not None:
+            recorder.turns += 1
+
+    await _twilio_post(client, recorder, "twilio_status", "/api/twilio/status",
+                       {"CallSid": call_sid, "CallStatus": "completed", "CallDuration": "30"})
+    recorder.calls += 1
+
+
+async def run_load(base_url: str, args) -> tuple[LoadRecorder, float]:
+    recorder = LoadRecorder()
+    next_call = 0
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        async def caller():
+            nonlocal next_call
+            while next_call < args.calls:
+                index = next_call
+                next_call += 1
+                scenario = args.scenario
+                if scenario == "mixed":
+                    scenario = "voice" if index % 2 == 0 else "twilio"
+                if scenario == "voice":
+                    await voice_call(client, recorder, args.turns)
+                else:
+                    await twilio_call(client, recorder, args.turns, index)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(caller() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    return recorder, elapsed
+
+
+# ---------- Resultados ----------
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def build_results(args, recorder: LoadRecorder, elapsed: float, stages: dict) -> dict:
+    requests = sum(len(values) for values in recorder.latencies.values())
+    return {
+        "label": args.label,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "config": {
+            "scenario": args.scenario, "concurrency": args.concurrency, "calls": args.calls,
+            "turns": args.turns, "workers": args.workers, "play_audio": args.play_audio,
+            "stt_ms": args.stt_ms, "llm_ms": args.llm_ms, "tts_ms": args.tts_ms, "jitter": args.jitter,
+            "cassette": args.cassette, "latency_scale": args.latency_scale if args.cassette else None,
+        },
+        "environment": {
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+        },
+        "elapsed_s": round(elapsed, 2),
+        "throughput": {
+            "calls_per_s": round(recorder.calls / elapsed, 2),
+            "turns_per_s": round(recorder.turns / elapsed, 2),
+            "requests_per_s": round(requests / elapsed, 2),
+        },
+        "endpoints": {
+            endpoint: {**percentiles(values), "errors": recorder.errors.get(endpoint, 0)}
+            for endpoint, values in sorted(recorder.latencies.items())
+        },
+        "errors": {"total": sum(recorder.errors.values()), "by_endpoint": dict(recorder.errors),
+                   "samples": recorder.error_samples},
+        "stages": stages,
+    }
+
+
+def _row(name: str, summary: dict, baseline: dict = None) -> str:
+    cells = []
+    for key in ("p50", "p95", "p99"):
+        value = summary.get(key)
+        cell = f"{value:8.1f}" if value is not None else f"{'-':>8}"
+        base = (baseline or {}).get(key)
+        if value is not None and base:
+            cell += f" ({(value - base) / base * 100:+5.1f}%)"
+        cells.append(cell)
+    return f"  {name:<20} {summary.get('count', 0):>6}  " + "  ".join(cells)
+
+
+def print_report(results: dict, baseline: dict = None):
+    baseline = baseline or {}
+    throughput = results["throughput"]
+    base_throughput = baseline.get("throughput", {})
+    print(f"\nDuración: {results['elapsed_s']} s   errores: {results['errors']['total']}")
+    for key, value in throughput.items():
+        line = f"  {key:<16} {value:8.2f}"
+        if base_throughput.get(key):
+            line += f" ({(value - base_throughput[key]) / base_throughput[key] * 100:+5.1f}%)"
+        print(line)
+
+    print("\nEndpoints (ms, cliente)      n       p50       p95       p99")
+    for name, summary in results["endpoints"].items():
+        print(_row(name, summary, baseline.get("endpoints", {}).get(name)))
+    print("\nEtapas del turno (ms, trazas)")
+    for name, summary in results["stages"].items():
+        print(_row(name, summary, baseline.get("stages", {}).get(name)))
+    for sample in results["errors"]["samples"][:5]:
+        print(f"  ❌ {sample}")
+
+
+def save_results(results: dict, output: str = None) -> str:
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return output
+
+
+def main(args) -> dict:
+    with tempfile.TemporaryDirectory() as db_dir:
+        port = _free_port()
+        groq_port = _free_port()
+        env = server_environment(db_dir, port, groq_port, args)
+        seed_database(env)
+
+        fake_groq = None if args.cassette else subprocess.Popen(
+            [sys.executable, "fake_groq.py", "--port", str(groq_port), "--stt-ms", str(args.stt_ms),
+             "--llm-ms", str(args.llm_ms), "--tts-ms", str(args.tts_ms), "--jitter", str(args.jitter),
+             "--error-rate", str(args.error_rate)],
+            cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        if args.workers > 1:
+            env.update({"PORT": str(port), "HOST": "127.0.0.1", "WEB_CONCURRENCY": str(args.workers)})
+            command = [sys.executable, "serve.py"]
+        else:
+            command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                       "--port", str(port), "--log-level", "warning"]
+        server = subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+        try:
+            if fake_groq is not None:
+                _wait_ready(f"http://127.0.0.1:{groq_port}/stats", fake_groq)
+            _wait_ready(f"http://127.0.0.1:{port}/api/health/ready", server)
+            print(f"Escenario {args.scenario}: {args.calls} llamadas × {args.turns} turnos, "
+                  f"{args.concurrency} clientes, {args.workers} worker(s)")
+            recorder, elapsed = asyncio.run(run_load(f"http://127.0.0.1:{port}", args))
+        finally:
+            # Al apagarse el servidor vacía la cola de trazas en la base de datos
+            _stop(server)
+            if fake_groq is not None:
+                _stop(fake_groq)
+
+        results = build_results(args, recorder, elapsed, load_stage_traces())
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga del pipeline de voz con Groq y Twilio simulados")
+    parser.add_argument("--scenario", choices=["voice", "twilio", "mixed"], default="mixed")
+    parser.add_argument("--concurrency", type=int, default=10, help="Clientes simultáneos")
+    parser.add_argument("--calls", type=int, default=100, help="Conversaciones en total")
+    parser.add_argument("--turns", type=int, default=3, help="Turnos por conversación")
+    parser.add_argument("--workers", type=int, default=1, help="Workers del backend (más de 1 usa serve.py)")
+    parser.add_argument("--play-audio", action="store_true", help="TWILIO_PLAY_AUDIO=true (TTS de Groq en llamadas)")
+    parser.add_argument("--stt-ms", type=float, default=150)
+    parser.add_argument("--llm-ms", type=float, default=400)
+    parser.add_argument("--tts-ms", type=float, default=200)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de errores 503 de Groq")
+    parser.add_argument("--cassette", default=None, help="Reproducir las respuestas de Groq de un cassette en vez de fake_groq.py")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Factor de las latencias grabadas (con --cassette)")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--label", default=None, help="Nombre de la ejecución en el resultado")
+    parser.add_argument("--output", default=None, help="Archivo de resultado (por defecto benchmark_results/)")
+    parser.add_argument("--compare", default=None, help="Resultado anterior con el que comparar")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar los errores del servidor")
+    args = parser.parse_args()
+
+    results = main(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    print(f"\n✅ Resultado guardado en {save_results(results, args.output)}")
@@ -0,0 +1,107 @@
+"""
+Mide el tiempo de arranque del backend
+
+- Importación: tiempo de `import main` en un proceso nuevo
+- Primera petición: desde que se lanza uvicorn hasta que /api/health/ready responde 200
+
+Cada medición usa una base de datos temporal, así que no toca voice_assistant.db.
+
+Uso:
+    python benchmark_startup.py                  # 5 arranques, objetivo 3 s
+    python benchmark_startup.py --runs 10 --target 2.5
+Sale con código 1 si la mediana del tiempo hasta la primera petición supera el objetivo.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_TARGET_SECONDS = 3.0
+READY_TIMEOUT_SECONDS = 60
+
+
+def _environment(db_dir: str) -> dict:
+    env = dict(os.environ)
+    env["DATABASE_URL"] = f"sqlite:///{os.path.join(db_dir, 'startup.db')}"
+    env["SHARD_DATABASE_URLS"] = ""
+    env["TTS_CACHE_DIR"] = os.path.join(db_dir, "tts_cache")
+    # Sin audio pregenerado: solo se mide el arranque del servidor
+    env["TWILIO_PLAY_AUDIO"] = "false"
+    env.setdefault("GROQ_API_KEY", "benchmark")
+    return env
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_import() -> float:
+    with tempfile.TemporaryDirectory() as db_dir:
+        code = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=BACKEND_DIR, env=_environment(db_dir), capture_output=True, text=True, check=True,
+        )
+        return float(output.stdout.strip().splitlines()[-1])
+
+
+def measure_first_request() -> float:
+    with tempfile.TemporaryDirectory() as db_dir:
+        port = _free_port()
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=_environment(db_dir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            url = f"http://127.0.0.1:{port}/api/health/ready"
+            while time.perf_counter() - start < READY_TIMEOUT_SECONDS:
+                if process.poll() is not None:
+                    raise RuntimeError(f"El servidor terminó con código {process.returncode}")
+                try:
+                    with urllib.request.urlopen(url, timeout=1) as response:
+                        if response.status == 200:
+                            return time.perf_counter() - start
+                except (urllib.error.URLError, ConnectionError, OSError):
+                    pass
+                time.sleep(0.01)
+            raise RuntimeError(f"El servidor no estuvo listo en {READY_TIMEOUT_SECONDS} s")
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def _summary(values) -> str:
+    return f"mediana {statistics.median(values):.2f} s   mín {min(values):.2f} s   máx {max(values):.2f} s"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiempo de arranque del backend")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target", type=float, default=STARTUP_TARGET_SECONDS,
+                        help="Objetivo en segundos para la mediana hasta la primera petición")
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    print(f"Importar main:       {_summary(imports)}")
+
+    first_requests = [measure_first_request() for _ in range(args.runs)]
+    print(f"Primera petición:    {_summary(first_requests)}")
+
+    median = statistics.median(first_requests)
+    if median > args.target:
+        print(f"❌ El arranque ({median:.2f} s) supera el objetivo de {args.target:.2f} s")
+        sys.exit(1)
+    print(f"✅ Arranque dentro del objetivo de {args.target:.2f} s")
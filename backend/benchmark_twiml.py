@@ -0,0 +1,87 @@
+"""
+Verifica que las plantillas de TwiML generan exactamente lo mismo que el SDK
+de Twilio y compara el tiempo de ambos
+
+Uso:
+    python benchmark_twiml.py                 # Verificar y medir
+    python benchmark_twiml.py --check-only    # Solo verificar (sale con código 1 si hay diferencias)
+"""
+import sys
+import timeit
+
+from twilio_service import TwilioService, welcome_message, FIXED_PROMPTS
+
+ACTION_URL = "https://example.com/api/twilio/gather?call_id=1099511627776"
+PARTIAL_URL = "https://example.com/api/twilio/partial?call_id=1099511627776"
+AUDIO_URL = "https://example.com/api/tts/" + "ab" * 32 + ".wav"
+
+# Textos con los casos delicados del escapado: entidades, comillas, saltos de línea, acentos y emojis
+GOLDEN_MESSAGES = [
+    *FIXED_PROMPTS,
+    welcome_message("Pizzería Don Luigi"),
+    welcome_message('Tacos & "Salsas" <MX>'),
+    "Nuestro horario es de 9:00 a 18:00.\nLos sábados abrimos de 10 a 14 h.\tGracias.",
+    "El total es < $500 & > $100; ¿desea 'confirmar'?",
+    "Claro 😊, aquí tienes: ]]> <![CDATA[ no es código",
+    "\r\nlínea con retorno de carro\r\n",
+    "",
+    None,
+]
+
+GOLDEN_URLS = [
+    (ACTION_URL, None, None),
+    (ACTION_URL, PARTIAL_URL, None),
+    (ACTION_URL, PARTIAL_URL, AUDIO_URL),
+    (ACTION_URL, None, AUDIO_URL),
+    ("https://example.com/api/twilio/gather?call_id=1&x=\"<a>\"\n", "https://example.com/p?a=1&b=2\t", "https://example.com/a.wav?x=1&y=<2>"),
+]
+
+
+def golden_cases():
+    for message in GOLDEN_MESSAGES:
+        for action_url, partial_url, audio_url in GOLDEN_URLS:
+            yield {"message": message, "gather": True, "action_url": action_url,
+                   "audio_url": audio_url, "partial_callback_url": partial_url}
+            yield {"message": message, "gather": False, "audio_url": audio_url}
+        yield {"message": message, "gather": True, "action_url": None}
+
+
+def check_golden(service: TwilioService) -> int:
+    failures = 0
+    total = 0
+    for case in golden_cases():
+        total += 1
+        expected = service.generate_twiml_with_sdk(**case)
+        actual = service.generate_twiml_for_call(**case)
+        if actual.encode("utf-8") != expected.encode("utf-8"):
+            failures += 1
+            print(f"✗ Diferencia en {case}")
+            print(f"  SDK:       {expected}")
+            print(f"  Plantilla: {actual}")
+    print(f"✓ {total - failures}/{total} casos idénticos al SDK")
+    return failures
+
+
+def benchmark(service: TwilioService, number: int = 20000):
+    message = welcome_message("Pizzería Don Luigi")
+    shapes = {
+        "gather + say": dict(gather=True, action_url=ACTION_URL, partial_callback_url=PARTIAL_URL),
+        "gather + play": dict(gather=True, action_url=ACTION_URL, partial_callback_url=PARTIAL_URL, audio_url=AUDIO_URL),
+        "say + hangup": dict(gather=False),
+    }
+    for name, kwargs in shapes.items():
+        sdk = min(timeit.repeat(lambda: service.generate_twiml_with_sdk(message, **kwargs), number=number, repeat=3))
+        fast = min(timeit.repeat(lambda: service.generate_twiml_for_call(message, **kwargs), number=number, repeat=3))
+        sdk_us = sdk / number * 1e6
+        fast_us = fast / number * 1e6
+        print(f"  {name:<14} SDK {sdk_us:7.2f} µs   plantilla {fast_us:6.2f} µs   ({sdk_us / fast_us:.1f}x)")
+
+
+if __name__ == "__main__":
+    service = TwilioService()
+    print("Verificando plantillas de TwiML contra el SDK...")
+    if check_golden(service):
+        sys.exit(1)
+    if "--check-only" not in sys.argv:
+        print("\nTiempo por respuesta:")
+        benchmark(service)
@@ -0,0 +1,19 @@
+"""
+Script para crear el índice de texto completo de las transcripciones e indexar los mensajes existentes
+"""
+from database import engine, Base
+from search_service import rebuild_search_index
+from sharding import shard_router
+
+def build_search_index():
+    """Crear (o reconstruir) el índice FTS5 / tsvector de call_messages"""
+    Base.metadata.create_all(bind=engine)
+    shard_router.init_schemas()
+    for shard, shard_engine in enumerate(shard_router.engines):
+        rebuild_search_index(shard_engine)
+        print(f"✓ Índice de búsqueda reconstruido (shard {shard})")
+
+if __name__ == "__main__":
+    print("Construyendo índice de búsqueda...")
+    build_search_index()
+    print("\nProceso completado.")
@@ -0,0 +1,247 @@
+"""
+Estado en memoria de las llamadas activas
+
+Cada turno de conversación necesita el contexto y su versión (context_version).
+En lugar de leer la fila de calls en cada turno, se mantiene en memoria una
+instantánea por llamada activa:
+
+- Escritura directa: el turno guarda el contexto en la base de datos (UPDATE con
+  control de versión) y, tras el commit, actualiza la instantánea. Si otro
+  proceso modificó la llamada, el UPDATE falla y la instantánea se recarga.
+- Se elimina al finalizar la llamada (end_call, despedida detectada o estado
+  terminal de Twilio) y tras ACTIVE_CALL_IDLE_SECONDS sin actividad.
+- El tamaño está acotado (ACTIVE_CALLS_MAX, se descartan las menos recientes).
+- Antes de usar la instantánea para un turno se compara su versión con la de la fila
+  (una consulta de una columna por clave primaria): si otro worker ya avanzó la
+  llamada se recarga antes de llamar al LLM, en lugar de descubrir el conflicto al
+  guardar y repetir el turno. Con CALL_AFFINITY=true (cada llamada siempre en el
+  mismo worker) la comprobación se omite.
+
+Un barrido periódico cierra en la base de datos las llamadas abandonadas: las que
+siguen sin end_time y no tienen mensajes desde hace ACTIVE_CALL_IDLE_SECONDS.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from analytics_service import record_call_ended
+from models import Call, CallMessage
+from settings import settings
+
+ACTIVE_CALLS_MAX = settings.active_calls_max
+ACTIVE_CALL_IDLE_SECONDS = settings.active_call_idle_seconds
+ACTIVE_CALL_SWEEP_SECONDS = settings.active_call_sweep_seconds
+CALL_AFFINITY = settings.call_affinity
+SWEEP_BATCH_SIZE = 500
+
+
+@dataclass(frozen=True)
+class CallState:
+    id: int
+    company_id: Optional[int]
+    context: Optional[str]
+    version: int
+    ended: bool
+
+
+def mark_call_ended(db: Session, call_id: int, end_time: datetime) -> Optional[Call]:
+    """
+    Fija end_time solo si la llamada seguía abierta y suma la llamada a los
+    rollups (sin hacer commit). Devuelve la llamada si este proceso la cerró.
+    """
+    updated = (
+        db.query(Call)
+        .filter(Call.id == call_id, Call.end_time.is_(None))
+        .update({Call.end_time: end_time}, synchronize_session=False)
+    )
+    if updated != 1:
+        return None
+    call = db.query(Call).filter(Call.id == call_id).populate_existing().first()
+    record_call_ended(db, call)
+    return call
+
+
+def close_idle_calls(db: Session, now: datetime, idle_seconds: float = ACTIVE_CALL_IDLE_SECONDS) -> List[int]:
+    """
+    Cierra las llamadas sin end_time cuya última actividad (último mensaje o
+    inicio) es anterior a now - idle_seconds. end_time queda en esa última actividad.
+    Devuelve los IDs de las llamadas cerradas.
+    """
+    cutoff = now - timedelta(seconds=idle_seconds)
+    # Solo los mensajes de llamadas abiertas: el coste no crece con el historial
+    open_calls = select(Call.id).where(Call.end_time.is_(None))
+    last_message = (
+        db.query(CallMessage.call_id, func.max(CallMessage.timestamp).label("last_at"))
+        .filter(CallMessage.call_id.in_(open_calls))
+        .group_by(CallMessage.call_id)
+        .subquery()
+    )
+    last_activity = func.coalesce(last_message.c.last_at, Call.start_time)
+
+    closed = []
+    while True:
+        rows = (
+            db.query(Call.id, last_activity)
+            .outerjoin(last_message, last_message.c.call_id == Call.id)
+            .filter(Call.end_time.is_(None), Call.archived_at.is_(None), last_activity < cutoff)
+            .order_by(Call.id)
+            .limit(SWEEP_BATCH_SIZE)
+            .all()
+        )
+        if not rows:
+            return closed
+        for call_id, last_at in rows:
+            if mark_call_ended(db, call_id, last_at or now):
+                closed.append(call_id)
+        db.commit()
+
+
+class ActiveCallStore:
+    def __init__(self, max_size: int = ACTIVE_CALLS_MAX, idle_seconds: float = ACTIVE_CALL_IDLE_SECONDS,
+                 affinity: bool = CALL_AFFINITY):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.affinity = affinity
+        self._states: "OrderedDict[int, tuple[CallState, float]]" = OrderedDict()
+        # El worker de estados de Twilio elimina llamadas desde otro hilo
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "misses": 0, "stale": 0}
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, call_id: int) -> Optional[CallState]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._states.get(call_id)
+            if entry is None:
+                return None
+            state, last_used = entry
+            if now - last_used > self.idle_seconds:
+                del self._states[call_id]
+                return None
+            self._states[call_id] = (state, now)
+            self._states.move_to_end(call_id)
+            return state
+
+    def put(self, state: CallState):
+        if state.ended:
+            self.evict(state.id)
+            return
+        with self._lock:
+            self._states[state.id] = (state, time.monotonic())
+            self._states.move_to_end(state.id)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def put_call(self, call: Call):
+        self.put(CallState(
+            id=call.id,
+            company_id=call.company_id,
+            context=call.conversation_context,
+            version=call.context_version or 0,
+            ended=call.end_time is not None,
+        ))
+
+    def saved(self, state: CallState, context: Optional[str], ended: bool = False):
+        """Registra un turno ya confirmado en la base de datos"""
+        self.put(replace(state, context=context, version=state.version + 1, ended=ended))
+
+    def evict(self, call_id: int):
+        with self._lock:
+            self._states.pop(call_id, None)
+
+    def load(self, db: Session, call_id: int, verify: bool = False) -> Optional[CallState]:
+        """
+        Instantánea de la llamada: de memoria si está activa, si no de la base de datos.
+        Con verify (antes de un turno) la de memoria solo se usa si su versión sigue
+        siendo la de la base de datos, salvo con afinidad de llamada por worker.
+        """
+        state = self.get(call_id)
+        if state is not None and verify and not self.affinity:
+            version = db.query(Call.context_version).filter(Call.id == call_id).scalar()
+            if (version or 0) != state.version:
+                self.stats["stale"] += 1
+                self.evict(call_id)
+                state = None
+        if state is not None:
+            self.stats["hits"] += 1
+            return state
+
+        self.stats["misses"] += 1
+        row = (
+            db.query(Call.id, Call.company_id, Call.conversation_context, Call.context_version, Call.end_time)
+            .filter(Call.id == call_id)
+            .first()
+        )
+        if row is None:
+            return None
+        state = CallState(
+            id=row.id,
+            company_id=row.company_id,
+            context=row.conversation_context,
+            version=row.context_version or 0,
+            ended=row.end_time is not None,
+        )
+        self.put(state)
+        return state
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [call_id for call_id, (_, last_used) in self._states.items() if last_used < cutoff]
+            for call_id in idle:
+                del self._states[call_id]
+        return len(idle)
+
+    # ---------- Barrido de llamadas abandonadas ----------
+
+    def start_sweeper(self, session_factories, interval: float = ACTIVE_CALL_SWEEP_SECONDS):
+        self._task = asyncio.create_task(self._sweep_loop(session_factories, interval))
+
+    async def stop_sweeper(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def sweep(self, session_factories) -> int:
+        """Cierra las llamadas abandonadas de todos los shards"""
+        self.evict_idle()
+        closed = 0
+        now = datetime.utcnow()
+        for session_factory in session_factories:
+            db = session_factory()
+            try:
+                for call_id in close_idle_calls(db, now, self.idle_seconds):
+                    self.evict(call_id)
+                    closed += 1
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+        return closed
+
+    async def _sweep_loop(self, session_factories, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # SQLAlchemy es síncrono: barrer fuera del event loop
+                closed = await asyncio.to_thread(self.sweep, session_factories)
+                if closed:
+                    print(f"✓ {closed} llamadas inactivas cerradas")
+            except Exception as e:
+                print(f"❌ Error cerrando llamadas inactivas: {e}")
@@ -0,0 +1,147 @@
+"""
+Secuenciación de los turnos de conversación de una llamada
+
+Dos peticiones simultáneas para la misma llamada (doble envío desde VoiceChat o
+reintentos de Twilio en /api/twilio/gather) leerían el mismo conversation_context
+y se sobrescribirían. Para evitarlo:
+
+- Dentro del proceso, los turnos de una llamada se ejecutan de uno en uno (lock por call_id)
+- Entre procesos, el contexto se guarda con concurrencia optimista: calls.context_version
+  se incrementa en cada turno y el UPDATE solo se aplica si la versión no cambió.
+  Si otro proceso se adelantó, el turno se repite sobre el contexto nuevo.
+- Un turno idéntico (misma llamada y misma huella de entrada) que llega mientras el
+  primero está en curso, o hasta TURN_DEDUP_SECONDS después, devuelve ese mismo
+  resultado sin repetir la llamada al LLM. La huella no usa la versión actual del
+  contexto (cambia en cuanto el primer turno se guarda): en Twilio incluye la versión
+  de la que partió el turno, que viaja en la URL del <Gather>.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from call_state import ActiveCallStore, CallState
+from metrics import TURN_CONFLICTS, TURNS_IN_FLIGHT, TURNS_QUEUED, current_company, tracked
+from models import Call
+from settings import settings
+
+TURN_MAX_ATTEMPTS = 3
+# Tiempo que se conserva el resultado de un turno para los reintentos que llegan tarde
+TURN_DEDUP_SECONDS = settings.turn_dedup_seconds
+
+
+class ConcurrentTurnError(Exception):
+    """El contexto de la llamada cambió en otro proceso en todos los intentos"""
+
+
+def save_context(db: Session, call_id: int, expected_version: int, context_json: str) -> bool:
+    """
+    Guarda el contexto si la versión sigue siendo expected_version (sin hacer commit).
+    Devuelve False si otro turno lo modificó antes.
+    """
+    updated = (
+        db.query(Call)
+        .filter(Call.id == call_id, Call.context_version == expected_version)
+        .update(
+            {Call.conversation_context: context_json, Call.context_version: expected_version + 1},
+            synchronize_session=False,
+        )
+    )
+    return updated == 1
+
+
+async def run_versioned_turn(
+    db: Session,
+    active_calls: ActiveCallStore,
+    call_id: int,
+    turn: Callable[[CallState], Awaitable[Tuple[Any, str]]],
+    max_attempts: int = TURN_MAX_ATTEMPTS,
+) -> Tuple[CallState, Any, str]:
+    """
+    Ejecuta turn(estado) -> (resultado, contexto_json) sobre el estado de la llamada
+    (de memoria si está activa) y guarda el contexto con control de versión. turn
+    puede agregar mensajes a la sesión: si hay conflicto se descartan con un
+    rollback, el estado se recarga de la base de datos y el turno se repite.
+    Devuelve (estado usado, resultado, contexto_json) con los cambios pendientes de
+    commit; tras el commit hay que llamar a active_calls.saved().
+    """
+    # La versión se comprueba antes del LLM: si otro worker avanzó la llamada se recarga ya
+    state = active_calls.load(db, call_id, verify=True)
+    for _ in range(max_attempts):
+        if state is None:
+            raise ValueError(f"Llamada {call_id} no encontrada")
+
+        result, context_json = await turn(state)
+        if save_context(db, call_id, state.version, context_json):
+            return state, result, context_json
+        db.rollback()
+        TURN_CONFLICTS.labels(current_company()).inc()
+        active_calls.evict(call_id)
+        state = active_calls.load(db, call_id)
+
+    raise ConcurrentTurnError(f"No se pudo guardar el turno de la llamada {call_id}: el contexto cambió en otro proceso")
+
+
+class CallTurnCoordinator:
+    def __init__(self, dedup_seconds: float = TURN_DEDUP_SECONDS):
+        self.dedup_seconds = dedup_seconds
+        self._locks: Dict[int, list] = {}  # call_id -> [asyncio.Lock, número de usuarios]
+        self._turns: Dict[Tuple[int, Hashable], asyncio.Future] = {}
+        self.stats = {"turns": 0, "joined": 0}
+
+    @asynccontextmanager
+    async def lock(self, call_id: int):
+        """Lock por llamada; se elimina cuando nadie lo usa"""
+        entry = self._locks.get(call_id)
+        if entry is None:
+            entry = self._locks[call_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            with tracked(TURNS_QUEUED):
+                await entry[0].acquire()
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(call_id, None)
+
+    async def run(self, call_id: int, fingerprint: Hashable, work: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Ejecuta work() como turno de la llamada. Si ya hay (o acaba de haber) un turno
+        con la misma huella, espera su resultado. Devuelve (resultado, reutilizado).
+        work debe tomar lock(call_id) para la parte que lee y guarda el contexto.
+        """
+        key = (call_id, fingerprint)
+        pending = self._turns.get(key)
+        if pending is not None:
+            self.stats["joined"] += 1
+            return await asyncio.shield(pending), True
+
+        future = asyncio.get_running_loop().create_future()
+        # Evita avisos de "exception never retrieved" si nadie se unió al turno
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._turns[key] = future
+        self.stats["turns"] += 1
+        try:
+            with tracked(TURNS_IN_FLIGHT):
+                result = await work()
+        except BaseException as e:
+            # Los errores no se conservan: un reintento posterior vuelve a intentarlo
+            self._turns.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                future.set_exception(ConcurrentTurnError("El turno original se canceló"))
+            else:
+                future.set_exception(e)
+            raise
+
+        future.set_result(result)
+        asyncio.get_running_loop().call_later(self.dedup_seconds, self._forget, key, future)
+        return result, False
+
+    def _forget(self, key, future: Optional[asyncio.Future]):
+        if self._turns.get(key) is future:
+            del self._turns[key]
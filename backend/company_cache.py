@@ -0,0 +1,168 @@
+"""
+Resolución de empresas en memoria para los endpoints públicos de voz
+
+Mantiene una foto inmutable de todas las empresas indexada por identifier, id,
+nombre y número de Twilio. Los cambios en este proceso la invalidan al instante; los cambios de
+otros workers se detectan con el contador de versión de la tabla cache_versions,
+que se consulta como máximo cada COMPANY_CACHE_CHECK_SECONDS.
+"""
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import CacheVersion, Company, CompanyPhoneNumber
+from settings import settings
+
+COMPANY_CACHE_NAME = "companies"
+COMPANY_CACHE_CHECK_SECONDS = settings.company_cache_check_seconds
+
+
+_E164_PATTERN = re.compile(r"^\+[1-9]\d{1,14}$")
+
+
+def normalize_phone_number(phone_number: Optional[str]) -> Optional[str]:
+    """Normaliza un número a E.164 (+5215512345678). Devuelve None si no es válido"""
+    if not phone_number:
+        return None
+    cleaned = re.sub(r"[\s\-().]", "", phone_number)
+    if cleaned.startswith("00"):
+        cleaned = "+" + cleaned[2:]
+    return cleaned if _E164_PATTERN.match(cleaned) else None
+
+
+@dataclass(frozen=True)
+class CompanySnapshot:
+    id: int
+    name: str
+    identifier: Optional[str]
+    description: Optional[str]
+    business_logic: Optional[str]
+    daily_budget_usd: Optional[float] = None
+    budget_action: Optional[str] = None
+
+
+def bump_version(db: Session, name: str):
+    """
+    Incrementa el contador de la cache (dentro de la transacción del cambio, sin commit).
+    INSERT ... ON CONFLICT: dos workers que crean la fila a la vez no chocan con la clave única.
+    """
+    dialect = db.get_bind().dialect.name
+    insert = pg_insert if dialect == "postgresql" else sqlite_insert
+    stmt = insert(CacheVersion).values(name=name, version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["name"],
+        set_={"version": CacheVersion.version + 1}
+    )
+    db.execute(stmt)
+
+
+def read_version(db: Session, name: str) -> int:
+    version = db.query(CacheVersion.version).filter(CacheVersion.name == name).scalar()
+    return version or 0
+
+
+class CompanyResolver:
+    def __init__(self, check_interval: float = COMPANY_CACHE_CHECK_SECONDS):
+        self.check_interval = check_interval
+        self._by_identifier: Dict[str, CompanySnapshot] = {}
+        self._by_id: Dict[int, CompanySnapshot] = {}
+        self._by_name: Dict[str, CompanySnapshot] = {}
+        self._by_phone: Dict[str, CompanySnapshot] = {}
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _reload(self, db: Session, version: int):
+        by_identifier, by_id, by_name = {}, {}, {}
+        for company in db.query(Company).all():
+            snapshot = CompanySnapshot(
+                id=company.id,
+                name=company.name,
+                identifier=company.identifier,
+                description=company.description,
+                business_logic=company.business_logic,
+                daily_budget_usd=company.daily_budget_usd,
+                budget_action=company.budget_action,
+            )
+            by_id[company.id] = snapshot
+            if company.identifier:
+                by_identifier[company.identifier] = snapshot
+            if company.name:
+                by_name[company.name] = snapshot
+        by_phone = {}
+        for phone_number, company_id in db.query(CompanyPhoneNumber.phone_number, CompanyPhoneNumber.company_id).all():
+            if company_id in by_id:
+                by_phone[phone_number] = by_id[company_id]
+        self._by_identifier, self._by_id, self._by_name, self._by_phone = by_identifier, by_id, by_name, by_phone
+        self._version = version
+
+    def _refresh_if_needed(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._version is not None and now - self._checked_at < self.check_interval:
+                return
+            db = SessionLocal()
+            try:
+                version = read_version(db, COMPANY_CACHE_NAME)
+                if version != self._version:
+                    self._reload(db, version)
+            finally:
+                db.close()
+            self._checked_at = time.monotonic()
+
+    def warm(self):
+        """Carga la cache (se llama al arrancar para que la primera request no espere)"""
+        self._refresh_if_needed()
+
+    def resolve(self, company_identifier: str) -> Optional[CompanySnapshot]:
+        """Busca por identifier, luego por id y por último por nombre (igual que antes con 3 queries)"""
+        self._refresh_if_needed()
+        company = self._by_identifier.get(company_identifier.strip())
+        if company is None:
+            try:
+                company = self._by_id.get(int(company_identifier))
+            except ValueError:
+                pass
+        if company is None:
+            company = self._by_name.get(company_identifier)
+        return company
+
+    def get(self, company_id: int) -> Optional[CompanySnapshot]:
+        self._refresh_if_needed()
+        return self._by_id.get(company_id)
+
+    def resolve_phone_number(self, phone_number: Optional[str]) -> Optional[CompanySnapshot]:
+        """Empresa asignada a un número de Twilio (el parámetro To del webhook)"""
+        self._refresh_if_needed()
+        normalized = normalize_phone_number(phone_number)
+        return self._by_phone.get(normalized) if normalized else None
+
+    def has_phone_numbers(self) -> bool:
+        self._refresh_if_needed()
+        return bool(self._by_phone)
+
+    def first(self) -> Optional[CompanySnapshot]:
+        """Empresa con el menor ID (comportamiento anterior de una sola empresa)"""
+        self._refresh_if_needed()
+        return self._by_id[min(self._by_id)] if self._by_id else None
+
+    def invalidate(self, db: Session):
+        """
+        Marca la cache como obsoleta en todos los workers. Llamar antes del commit
+        que crea o modifica una empresa o sus números de teléfono.
+        """
+        bump_version(db, COMPANY_CACHE_NAME)
+        with self._lock:
+            self._version = None
+
+
+company_resolver = CompanyResolver()
@@ -0,0 +1,177 @@
+"""
+Exportación masiva de transcripciones (NDJSON / CSV) en streaming
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from itertools import groupby
+from typing import Iterator, List, Optional
+
+from sqlalchemy.orm import sessionmaker
+
+from database import SessionLocal
+from models import Call, CallMessage
+from archive_service import load_archive
+
+# Número de filas que se leen de la base de datos en cada lote
+EXPORT_BATCH_SIZE = 500
+
+CSV_COLUMNS = [
+    "call_id", "company_id", "client_id", "start_time", "end_time", "rating",
+    "message_id", "role", "content", "timestamp",
+]
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _iter_call_rows(
+    session_factory: sessionmaker,
+    company_id: Optional[int] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+) -> Iterator[tuple]:
+    """
+    Recorre las llamadas y sus mensajes en lotes usando yield_per.
+    Devuelve tuplas (call, message) donde message es un dict o None.
+    Abre su propia sesión porque el generador se consume después de que
+    termina el handler (la sesión de Depends(get_db) ya estaría cerrada).
+    """
+    db = session_factory()
+    try:
+        query = (
+            db.query(Call, CallMessage)
+            .outerjoin(CallMessage, CallMessage.call_id == Call.id)
+        )
+        if company_id is not None:
+            query = query.filter(Call.company_id == company_id)
+        if start_date is not None:
+            query = query.filter(Call.start_time >= start_date)
+        if end_date is not None:
+            query = query.filter(Call.start_time < end_date)
+
+        query = query.order_by(Call.id, CallMessage.timestamp, CallMessage.id)
+        # yield_per activa stream_results (cursor del lado del servidor en Postgres)
+        # y lee las filas en lotes en lugar de cargarlas todas en memoria
+        for call, message in query.yield_per(EXPORT_BATCH_SIZE):
+            if message is not None:
+                yield call, {
+                    "id": message.id,
+                    "role": message.role,
+                    "content": message.content,
+                    "timestamp": _iso(message.timestamp),
+                }
+            elif call.archived_at is not None:
+                # Llamada archivada: los mensajes están en call_archives
+                archived = load_archive(db, call.id)
+                archived_messages = archived["messages"] if archived else []
+                for archived_message in archived_messages:
+                    yield call, archived_message
+                if not archived_messages:
+                    yield call, None
+            else:
+                yield call, None
+    finally:
+        db.close()
+
+
+def _call_dict(call: Call) -> dict:
+    return {
+        "id": call.id,
+        "company_id": call.company_id,
+        "client_id": call.client_id,
+        "start_time": _iso(call.start_time),
+        "end_time": _iso(call.end_time),
+        "rating": call.rating,
+    }
+
+
+def _iter_ndjson(rows: Iterator[tuple]) -> Iterator[str]:
+    """Una línea JSON por llamada, con sus mensajes incluidos"""
+    for _, group in groupby(rows, key=lambda row: row[0].id):
+        messages = []
+        call = None
+        for call, message in group:
+            if message is not None:
+                messages.append(message)
+        record = _call_dict(call)
+        record["messages"] = messages
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def _iter_csv(rows: Iterator[tuple]) -> Iterator[str]:
+    """Una fila CSV por mensaje (las llamadas sin mensajes generan una fila vacía)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for call, message in rows:
+        writer.writerow([
+            call.id, call.company_id, call.client_id,
+            _iso(call.start_time), _iso(call.end_time), call.rating,
+            message["id"] if message else None,
+            message["role"] if message else None,
+            message["content"] if message else None,
+            message["timestamp"] if message else None,
+        ])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+def _gzip_stream(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Comprime al vuelo con formato gzip"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _batched_bytes(chunks: Iterator[str], min_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Agrupa fragmentos pequeños para no enviar un chunk HTTP por fila"""
+    pending = []
+    size = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        pending.append(data)
+        size += len(data)
+        if size >= min_size:
+            yield b"".join(pending)
+            pending = []
+            size = 0
+    if pending:
+        yield b"".join(pending)
+
+
+def stream_export(
+    export_format: str = "ndjson",
+    company_id: Optional[int] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    compress: bool = False,
+    session_factories: Optional[List[sessionmaker]] = None,
+) -> Iterator[bytes]:
+    """
+    Genera la exportación completa como un iterador de bytes.
+    La memoria usada es constante sin importar cuántas llamadas se exporten.
+    """
+    session_factories = session_factories or [SessionLocal]
+    # Los shards se recorren uno tras otro; cada llamada vive en un solo shard
+    rows = (
+        row
+        for session_factory in session_factories
+        for row in _iter_call_rows(session_factory, company_id, start_date, end_date)
+    )
+    if export_format == "csv":
+        chunks = _iter_csv(rows)
+    else:
+        chunks = _iter_ndjson(rows)
+
+    output = _batched_bytes(chunks)
+    if compress:
+        output = _gzip_stream(output)
+    return output
@@ -0,0 +1,175 @@
+"""
+Servidor local compatible con la API de Groq para pruebas de carga (sin red)
+
+Responde a las mismas rutas que usa el SDK de Groq con latencias configurables:
+- POST /openai/v1/audio/transcriptions (STT, verbose_json)
+- POST /openai/v1/chat/completions (LLM, con o sin stream)
+- POST /openai/v1/audio/speech (TTS, WAV de silencio)
+
+Para apuntar el backend a este servidor: GROQ_BASE_URL=http://127.0.0.1:<puerto>
+
+Uso:
+    python fake_groq.py --port 9100 --stt-ms 150 --llm-ms 400 --tts-ms 200 --jitter 0.2
+    python fake_groq.py --port 9100 --llm-ttft-ms 150 --stream-chunks 20
+"""
+import argparse
+import asyncio
+import io
+import json
+import random
+import time
+import uuid
+import wave
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+TRANSCRIPTS = [
+    "Hola, quisiera saber el horario de atención",
+    "¿Tienen servicio a domicilio en mi colonia?",
+    "Me gustaría agendar una cita para el jueves",
+    "¿Cuánto cuesta el paquete básico?",
+    "¿Qué formas de pago aceptan?",
+    "Necesito cambiar la dirección de mi pedido",
+]
+
+REPLY = (
+    "Claro, con gusto te ayudo. Nuestro horario es de lunes a viernes de nueve a seis "
+    "y los sábados de diez a dos. ¿Hay algo más en lo que pueda ayudarte?"
+)
+
+
+def _silence_wav(seconds: float = 0.5, rate: int = 8000) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b"\x00\x00" * int(seconds * rate))
+    return buffer.getvalue()
+
+
+def create_app(
+    stt_ms: float = 150,
+    llm_ms: float = 400,
+    tts_ms: float = 200,
+    jitter: float = 0.2,
+    llm_ttft_ms: float = 150,
+    stream_chunks: int = 20,
+    error_rate: float = 0.0,
+    seed: int = 0,
+) -> FastAPI:
+    """App de FastAPI que imita a Groq; las latencias varían ±jitter (fracción)"""
+    app = FastAPI(title="Fake Groq")
+    rng = random.Random(seed)
+    wav_bytes = _silence_wav()
+    app.state.requests = {"stt": 0, "llm": 0, "tts": 0, "errors": 0}
+
+    async def delay(ms: float):
+        await asyncio.sleep(max(0.0, ms * (1 + rng.uniform(-jitter, jitter))) / 1000)
+
+    def injected_error(operation: str):
+        app.state.requests[operation] += 1
+        if error_rate and rng.random() < error_rate:
+            app.state.requests["errors"] += 1
+            return JSONResponse(status_code=503, content={"error": {"message": "fake_groq: error inyectado"}})
+        return None
+
+    def groq_id() -> dict:
+        return {"id": f"req_{uuid.uuid4().hex[:24]}"}
+
+    @app.post("/openai/v1/audio/transcriptions")
+    async def transcriptions(request: Request):
+        await request.form()
+        error = injected_error("stt")
+        if error:
+            return error
+        await delay(stt_ms)
+        text = rng.choice(TRANSCRIPTS)
+        return {"text": text, "language": "es", "duration": 2.5, "segments": [], "x_groq": groq_id()}
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        error = injected_error("llm")
+        if error:
+            return error
+        model = body.get("model", "openai/gpt-oss-120b")
+        prompt_tokens = sum(len(str(message.get("content", ""))) // 4 for message in body.get("messages", []))
+        completion_tokens = len(REPLY) // 4
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await delay(llm_ms)
+            return {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": REPLY}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+                "x_groq": groq_id(),
+            }
+
+        words = REPLY.split(" ")
+        size = max(1, len(words) // max(1, stream_chunks))
+        chunks = [" ".join(words[i:i + size]) + " " for i in range(0, len(words), size)]
+        per_chunk_ms = max(0.0, llm_ms - llm_ttft_ms) / len(chunks)
+
+        async def events():
+            await delay(llm_ttft_ms)
+            for index, text in enumerate(chunks):
+                if index:
+                    await delay(per_chunk_ms)
+                chunk = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            final = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "x_groq": {**groq_id(), "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}},
+            }
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/openai/v1/audio/speech")
+    async def speech(request: Request):
+        await request.body()
+        error = injected_error("tts")
+        if error:
+            return error
+        await delay(tts_ms)
+        return Response(content=wav_bytes, media_type="audio/wav", headers={"x-request-id": groq_id()["id"]})
+
+    @app.get("/stats")
+    async def stats():
+        return app.state.requests
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Servidor local que imita la API de Groq")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--stt-ms", type=float, default=150)
+    parser.add_argument("--llm-ms", type=float, default=400)
+    parser.add_argument("--tts-ms", type=float, default=200)
+    parser.add_argument("--jitter", type=float, default=0.2, help="Variación de las latencias (fracción)")
+    parser.add_argument("--llm-ttft-ms", type=float, default=150, help="Tiempo hasta el primer token con stream")
+    parser.add_argument("--stream-chunks", type=int, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de peticiones que responden 503")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake = create_app(
+        stt_ms=args.stt_ms, llm_ms=args.llm_ms, tts_ms=args.tts_ms, jitter=args.jitter,
+        llm_ttft_ms=args.llm_ttft_ms, stream_chunks=args.stream_chunks,
+        error_rate=args.error_rate, seed=args.seed,
+    )
+    uvicorn.run(fake, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,325 @@
+"""
+Grabación y reproducción de las llamadas a Groq (cassettes), a nivel de transporte HTTP
+
+Con GROQ_CASSETTE_MODE el cliente de Groq de GroqService usa un transporte de httpx propio:
+- record: las peticiones van a Groq (o a GROQ_BASE_URL) y cada intercambio de STT, LLM
+  o TTS se añade a GROQ_CASSETTE (JSON Lines) con su latencia original. No se guardan
+  las cabeceras de autenticación y la API key se borra de todo el texto guardado.
+- replay: no hay red; cada petición se responde desde el cassette tras esperar su
+  latencia original × GROQ_REPLAY_LATENCY_SCALE (0 = sin espera).
+
+En replay las peticiones se emparejan por GROQ_REPLAY_MATCH:
+- exact: método, ruta y huella del cuerpo (JSON normalizado, o el multipart sin su
+  boundary aleatorio). Las repeticiones de una misma petición se responden en el orden
+  grabado (y después se repite la última). Si falta una petición responde 404, de modo
+  que un cambio en los prompts o en los parámetros se detecta como error.
+- sequence: solo método y ruta, en el orden grabado y en bucle (pruebas de carga con
+  entradas distintas de las grabadas).
+
+Las respuestas se guardan completas (el backend no usa streaming con Groq).
+
+Uso:
+    GROQ_CASSETTE_MODE=record GROQ_CASSETTE=cassettes/demo.jsonl uvicorn main:app
+    GROQ_CASSETTE_MODE=replay GROQ_CASSETTE=cassettes/demo.jsonl GROQ_REPLAY_LATENCY_SCALE=0 uvicorn main:app
+    python groq_cassettes.py info cassettes/demo.jsonl     # Intercambios y latencias por operación
+    python groq_cassettes.py check cassettes/demo.jsonl    # Buscar secretos antes de compartirlo
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+from settings import settings
+
+CASSETTE_OFF = "off"
+CASSETTE_RECORD = "record"
+CASSETTE_REPLAY = "replay"
+MATCH_EXACT = "exact"
+MATCH_SEQUENCE = "sequence"
+
+REDACTED = "[REDACTED]"
+# Claves de Groq (gsk_...) y tokens Bearer que pudieran aparecer en cuerpos o cabeceras
+_SECRET_PATTERN = re.compile(r"gsk_[A-Za-z0-9]{8,}|Bearer\s+[A-Za-z0-9._\-]+")
+# Cabeceras que no se guardan: credenciales y las que dejan de ser ciertas al guardar el cuerpo decodificado
+_DROPPED_HEADERS = {
+    "authorization", "cookie", "set-cookie", "x-api-key",
+    "content-encoding", "content-length", "transfer-encoding", "connection",
+}
+_TEXT_TYPES = ("application/json", "text/")
+
+OPERATIONS = {
+    "/audio/transcriptions": "stt",
+    "/chat/completions": "llm",
+    "/audio/speech": "tts",
+}
+
+
+def _operation(path: str) -> str:
+    for suffix, operation in OPERATIONS.items():
+        if path.endswith(suffix):
+            return operation
+    return "other"
+
+
+def _operation_path(path: str) -> str:
+    """Ruta sin el prefijo de la base URL (/openai/v1, un proxy...): /chat/completions"""
+    for suffix in OPERATIONS:
+        if path.endswith(suffix):
+            return suffix
+    return path
+
+
+def _route(url: httpx.URL) -> str:
+    """Ruta de la petición sin el prefijo de la base URL, con su query"""
+    path = _operation_path(url.path)
+    return path + (f"?{url.query.decode()}" if url.query else "")
+
+
+def body_fingerprint(content_type: str, body: bytes) -> str:
+    """Huella estable del cuerpo: JSON con las claves ordenadas, multipart sin su boundary"""
+    if content_type.startswith("application/json"):
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False).encode("utf-8")
+        except ValueError:
+            pass
+    elif content_type.startswith("multipart/form-data"):
+        match = re.search(r"boundary=\"?([^\";]+)", content_type)
+        if match:
+            body = body.replace(match.group(1).encode(), b"BOUNDARY")
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def _encode_body(content_type: str, body: bytes) -> dict:
+    if content_type.startswith(_TEXT_TYPES):
+        try:
+            return {"text": body.decode("utf-8")}
+        except UnicodeDecodeError:
+            pass
+    return {"base64": base64.b64encode(body).decode("ascii")}
+
+
+def _decode_body(stored: dict) -> bytes:
+    if "text" in stored:
+        return stored["text"].encode("utf-8")
+    return base64.b64decode(stored.get("base64", ""))
+
+
+class _Scrubber:
+    def __init__(self, secrets: List[str]):
+        self.secrets = [secret for secret in secrets if secret]
+
+    def text(self, value: str) -> str:
+        for secret in self.secrets:
+            value = value.replace(secret, REDACTED)
+        return _SECRET_PATTERN.sub(REDACTED, value)
+
+    def headers(self, headers: httpx.Headers) -> Dict[str, str]:
+        return {name: self.text(value) for name, value in headers.items() if name.lower() not in _DROPPED_HEADERS}
+
+
+class CassetteRecorder(httpx.BaseTransport):
+    """Envía las peticiones con el transporte real y añade cada intercambio al cassette"""
+
+    def __init__(self, path: str, transport: Optional[httpx.BaseTransport] = None, secrets: Optional[List[str]] = None):
+        self.path = path
+        self.transport = transport or httpx.HTTPTransport()
+        self.scrubber = _Scrubber(secrets if secrets is not None else [settings.groq_api_key])
+        self.recorded = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = request.read()
+        start = time.perf_counter()
+        response = self.transport.handle_request(request)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+
+        self._append(request, body, response, content, elapsed_ms)
+        headers = [(name, value) for name, value in response.headers.multi_items()
+                   if name.lower() not in ("content-encoding", "content-length", "transfer-encoding")]
+        return httpx.Response(response.status_code, headers=headers, content=content, request=request,
+                              extensions={"http_version": response.extensions.get("http_version", b"HTTP/1.1")})
+
+    def _append(self, request: httpx.Request, body: bytes, response: httpx.Response, content: bytes, elapsed_ms: float):
+        request_type = request.headers.get("content-type", "")
+        response_type = response.headers.get("content-type", "")
+        stored_request = {
+            "method": request.method,
+            "path": self.scrubber.text(_route(request.url)),
+            "content_type": re.sub(r"boundary=\S+", "boundary=BOUNDARY", request_type),
+            "fingerprint": body_fingerprint(request_type, body),
+            "size": len(body),
+        }
+        # El JSON de chat y TTS se guarda para poder leerlo; el audio de STT solo por su huella
+        if request_type.startswith("application/json"):
+            stored_request["body"] = self.scrubber.text(body.decode("utf-8", errors="replace"))
+        stored_response = {
+            "status": response.status_code,
+            "headers": self.scrubber.headers(response.headers),
+            **_encode_body(response_type, content),
+        }
+        if "text" in stored_response:
+            stored_response["text"] = self.scrubber.text(stored_response["text"])
+        interaction = {
+            "operation": _operation(request.url.path),
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "elapsed_ms": elapsed_ms,
+            "request": stored_request,
+            "response": stored_response,
+        }
+        line = json.dumps(interaction, ensure_ascii=False) + "\n"
+        # Una sola escritura en modo append: varios workers pueden grabar en el mismo archivo
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+            self.recorded += 1
+
+    def close(self):
+        self.transport.close()
+
+
+def load_cassette(path: str) -> List[dict]:
+    interactions = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                interactions.append(json.loads(line))
+            except ValueError:
+                # Última línea a medias si la grabación se cortó
+                print(f"⚠️ Cassette {path}: línea {number} inválida, se ignora")
+    return interactions
+
+
+class CassettePlayer(httpx.BaseTransport):
+    """Responde desde el cassette sin red, con la latencia grabada × latency_scale"""
+
+    def __init__(self, path: str, match: str = MATCH_EXACT, latency_scale: float = 1.0):
+        self.path = path
+        self.match = (match or MATCH_EXACT).lower()
+        self.latency_scale = max(0.0, latency_scale)
+        self.interactions = load_cassette(path)
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._queues: Dict[tuple, deque] = defaultdict(deque)
+        self._last: Dict[tuple, dict] = {}
+        for interaction in self.interactions:
+            self._queues[self._key_of(interaction["request"])].append(interaction)
+        print(f"✅ Cassette de Groq {path}: {len(self.interactions)} intercambios (replay {self.match}, "
+              f"latencia × {self.latency_scale:g})")
+
+    def _key_of(self, stored: dict) -> tuple:
+        # _operation_path también normaliza los cassettes grabados con la ruta completa
+        path = _operation_path(stored["path"].split("?", 1)[0])
+        if self.match == MATCH_SEQUENCE:
+            return stored["method"], path
+        return stored["method"], path, stored["fingerprint"]
+
+    def _next(self, key: tuple) -> Optional[dict]:
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue:
+                interaction = queue.popleft()
+                if self.match == MATCH_SEQUENCE:
+                    queue.append(interaction)  # En bucle
+                self._last[key] = interaction
+                return interaction
+            return self._last.get(key)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = request.read()
+        key = (request.method, _operation_path(request.url.path))
+        if self.match != MATCH_SEQUENCE:
+            key += (body_fingerprint(request.headers.get("content-type", ""), body),)
+        interaction = self._next(key)
+        if interaction is None:
+            self.stats["misses"] += 1
+            message = f"Cassette sin respuesta para {request.method} {request.url.path} (huella {key[-1]})"
+            print(f"❌ {message}")
+            return httpx.Response(404, json={"error": {"message": message, "type": "cassette_miss"}}, request=request)
+
+        self.stats["hits"] += 1
+        if self.latency_scale:
+            # Hilo de to_thread: la espera no bloquea el event loop
+            time.sleep(interaction["elapsed_ms"] / 1000 * self.latency_scale)
+        stored = interaction["response"]
+        return httpx.Response(stored["status"], headers=stored.get("headers", {}), content=_decode_body(stored),
+                              request=request)
+
+
+def build_transport(
+    mode: str = settings.groq_cassette_mode,
+    path: Optional[str] = settings.groq_cassette,
+) -> Optional[httpx.BaseTransport]:
+    """Transporte para el cliente de Groq según la configuración (None = HTTP normal)"""
+    mode = (mode or CASSETTE_OFF).lower()
+    if mode == CASSETTE_OFF:
+        return None
+    if not path:
+        raise Exception("GROQ_CASSETTE es obligatorio con GROQ_CASSETTE_MODE=record|replay")
+    if mode == CASSETTE_RECORD:
+        print(f"✅ Grabando las llamadas a Groq en {path}")
+        return CassetteRecorder(path)
+    if mode == CASSETTE_REPLAY:
+        return CassettePlayer(path, settings.groq_replay_match, settings.groq_replay_latency_scale)
+    raise Exception(f"GROQ_CASSETTE_MODE inválido: {mode} (off, record o replay)")
+
+
+# ---------- CLI ----------
+
+def print_info(path: str):
+    interactions = load_cassette(path)
+    by_operation = defaultdict(list)
+    for interaction in interactions:
+        by_operation[interaction.get("operation", "other")].append(interaction)
+    print(f"{path}: {len(interactions)} intercambios")
+    print(f"  {'operación':<10} {'n':>5} {'errores':>8} {'p50 ms':>9} {'media ms':>9} {'máx ms':>9}")
+    for operation, items in sorted(by_operation.items()):
+        latencies = sorted(item["elapsed_ms"] for item in items)
+        errors = sum(1 for item in items if item["response"]["status"] >= 400)
+        print(f"  {operation:<10} {len(items):>5} {errors:>8} {statistics.median(latencies):9.1f} "
+              f"{statistics.fmean(latencies):9.1f} {latencies[-1]:9.1f}")
+
+
+def check_secrets(path: str) -> int:
+    """Cuenta las líneas con algo que parezca una clave o una cabecera de autenticación"""
+    found = 0
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            lower = line.lower()
+            if _SECRET_PATTERN.search(line) or '"authorization"' in lower or '"set-cookie"' in lower:
+                found += 1
+                print(f"❌ Línea {number}: posible secreto")
+    if not found:
+        print(f"✅ {path}: sin secretos")
+    return found
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cassettes de las llamadas a Groq")
+    parser.add_argument("command", choices=["info", "check"])
+    parser.add_argument("cassette")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        print_info(args.cassette)
+    elif check_secrets(args.cassette):
+        sys.exit(1)
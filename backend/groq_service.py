@@ -1,26 +1,136 @@
+import asyncio
 import base64
 import io
 import json
+import time
 from datetime import datetime
-from groq import Groq
-import os
-from dotenv import load_dotenv
+from typing import Optional
 
-load_dotenv()
+from metrics import UPSTREAM_ERRORS, UPSTREAM_RETRIES, current_company
+from settings import settings
+from turn_traces import current_trace
+from usage_accounting import UsageMeter
 
-try:
-    from openai import OpenAI as OpenAIClient
-except ImportError:
-    OpenAIClient = None
+# Errores de Groq que vale la pena reintentar (además de los de conexión y timeout)
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+RETRY_BACKOFF_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 8
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Respeta Retry-After si Groq lo envía; si no, espera exponencial"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get("retry-after")), RETRY_MAX_DELAY_SECONDS)
+        except (TypeError, ValueError):
+            pass
+    return min(RETRY_BACKOFF_SECONDS * 2 ** attempt, RETRY_MAX_DELAY_SECONDS)
+
+
+def _upstream_details(response) -> dict:
+    """ID de la petición en Groq y tokens consumidos (si la respuesta los trae)"""
+    details = {}
+    x_groq = getattr(response, "x_groq", None)
+    if isinstance(x_groq, dict):
+        details["request_id"] = x_groq.get("id")
+    elif x_groq is not None:
+        details["request_id"] = getattr(x_groq, "id", None)
+    headers = getattr(response, "headers", None)
+    if not details.get("request_id") and headers is not None:
+        details["request_id"] = headers.get("x-request-id")
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        details["prompt_tokens"] = getattr(usage, "prompt_tokens", None)
+        details["completion_tokens"] = getattr(usage, "completion_tokens", None)
+    return details
+
+
+def _usage(operation: str, request: dict, response) -> dict:
+    """Unidades facturables de una petición: tokens, segundos de audio o caracteres"""
+    if operation == "llm":
+        usage = getattr(response, "usage", None)
+        return {
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None),
+        }
+    if operation == "stt":
+        return {"audio_seconds": getattr(response, "duration", None)}
+    if operation == "tts":
+        return {"tts_characters": len(request.get("input") or "")}
+    return {}
+
+
+def _is_retryable(error: Exception) -> bool:
+    import groq
+
+    if isinstance(error, groq.APIConnectionError):
+        return True
+    if isinstance(error, groq.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
 
 
 class GroqService:
-    def __init__(self):
-        self.groq_key = os.getenv("GROQ_API_KEY")
+    LLM_MODEL = "openai/gpt-oss-120b"
+
+    def __init__(self, usage_meter: Optional[UsageMeter] = None):
+        self.groq_key = settings.groq_api_key
         if not self.groq_key:
             raise Exception("GROQ_API_KEY no está configurada en el archivo .env")
 
-        self.client = Groq(api_key=self.groq_key)
+        self.max_retries = settings.groq_max_retries
+        self.usage_meter = usage_meter
+        self._client = None
+
+    @property
+    def client(self):
+        """Cliente de Groq; el SDK se importa con la primera petición para no retrasar el arranque"""
+        if self._client is None:
+            from groq import DefaultHttpxClient, Groq
+
+            from groq_cassettes import build_transport
+
+            # Con GROQ_CASSETTE_MODE las peticiones se graban o se reproducen desde un cassette
+            transport = build_transport()
+            http_client = DefaultHttpxClient(transport=transport) if transport is not None else None
+            # Los reintentos los hace _request para poder contarlos
+            self._client = Groq(api_key=self.groq_key, base_url=settings.groq_base_url, max_retries=0,
+                                http_client=http_client)
+        return self._client
+
+    def _request(self, operation: str, create, **kwargs):
+        """
+        Llama a create(**kwargs) del SDK reintentando los errores transitorios
+        (conexión, 408, 409, 429 y 5xx) hasta max_retries veces. Es síncrono:
+        desde el event loop se ejecuta con asyncio.to_thread.
+        """
+        attempt = 0
+        start = time.perf_counter()
+        while True:
+            try:
+                response = create(**kwargs)
+            except Exception as e:
+                if attempt < self.max_retries and _is_retryable(e):
+                    UPSTREAM_RETRIES.labels("groq", operation, current_company()).inc()
+                    time.sleep(_retry_delay(e, attempt))
+                    attempt += 1
+                    continue
+                UPSTREAM_ERRORS.labels("groq", operation, current_company()).inc()
+                raise
+
+            if self.usage_meter is not None:
+                self.usage_meter.record(kwargs.get("model"), _usage(operation, kwargs, response))
+            trace = current_trace()
+            if trace is not None:
+                trace.add_upstream(
+                    operation,
+                    model=kwargs.get("model"),
+                    ms=round((time.perf_counter() - start) * 1000, 1),
+                    attempts=attempt + 1 if attempt else None,
+                    **_upstream_details(response),
+                )
+            return response
 
     # =============================================================
     # SPEECH → TEXT (Whisper Large v3 Turbo)
@@ -33,7 +143,10 @@ class GroqService:
             if len(audio_data) < 50:
                 raise Exception("El archivo de audio es demasiado corto")
 
-            transcription = self.client.audio.transcriptions.create(
+            transcription = await asyncio.to_thread(
+                self._request,
+                "stt",
+                self.client.audio.transcriptions.create,
                 file=("audio.webm", audio_data),
                 model="whisper-large-v3",
                 temperature=0,
@@ -56,51 +169,26 @@ class GroqService:
         - respuesta_texto: str - La respuesta del modelo
         - contexto_json_actualizado: str - JSON con el contexto actualizado de la conversación
         - should_end_call: bool - True si el usuario quiere terminar la conversación
+        
+        Si la empresa superó su presupuesto diario se usa un modelo más barato o se
+        lanza BudgetExceededError (según budget_action).
         """
+        model = self.usage_meter.route_llm_model(self.LLM_MODEL) if self.usage_meter else self.LLM_MODEL
         try:
             if not self.client:
                 raise Exception("Cliente de Groq no inicializado")
 
-            # Cargar contexto JSON existente o crear uno nuevo
-            previous_messages = []
-            if conversation_context_json:
-                try:
-                    context = json.loads(conversation_context_json)
-                    all_loaded_messages = context.get("messages", [])
-                    # Obtener solo los mensajes de usuario y asistente (excluir system)
-                    previous_messages = [msg for msg in all_loaded_messages if msg.get("role") in ["user", "assistant"]]
-                except (json.JSONDecodeError, TypeError, AttributeError):
-                    previous_messages = []
-            
-            # Construir la lista de mensajes: system message primero, luego mensajes previos, luego mensaje actual
-            messages = []
-            
-            # Siempre agregar el system message primero
-            messages.append({
-                "role": "system",
-                "content": f"""Eres un asistente de voz profesional y amigable para una empresa.
-
-Lógica del negocio y cómo debes actuar:
-{business_logic}
-
-Responde de manera natural, concisa y útil. Tu respuesta debe ser apropiada para ser convertida a voz. Mantén el contexto de la conversación anterior."""
-            })
-            
-            # Agregar mensajes previos de la conversación
-            messages.extend(previous_messages)
-            
-            # Agregar el mensaje actual del usuario
-            messages.append({
-                "role": "user",
-                "content": user_message
-            })
+            messages = self._build_messages(user_message, business_logic, conversation_context_json)
 
             # Detectar si el usuario quiere terminar la conversación
             should_end_call = self._check_if_user_wants_to_end(user_message)
 
-            # Usar GPT OSS 120B
-            completion = self.client.chat.completions.create(
-                model="openai/gpt-oss-120b",
+            # Usar GPT OSS 120B o el modelo del presupuesto (el cliente es síncrono: se ejecuta en un hilo para no bloquear el event loop)
+            completion = await asyncio.to_thread(
+                self._request,
+                "llm",
+                self.client.chat.completions.create,
+                model=model,
                 messages=messages,
                 temperature=1,
                 max_completion_tokens=8192,
@@ -116,19 +204,58 @@ Responde de manera natural, concisa y útil. Tu respuesta debe ser apropiada par
                 "role": "assistant",
                 "content": response_text
             })
-            
-            # Actualizar el contexto JSON
-            updated_context = {
-                "messages": messages,
-                "last_updated": datetime.now().isoformat()
-            }
-            context_json = json.dumps(updated_context, ensure_ascii=False)
+            context_json = self._dump_context(messages)
 
             return response_text, context_json, should_end_call
 
         except Exception as e:
             raise Exception(f"Error en text to text: {str(e)}")
     
+    def _build_messages(self, user_message: str, business_logic: str, conversation_context_json: str = None) -> list:
+        """Mensajes para el LLM: system, los turnos previos del contexto JSON y el mensaje actual"""
+        # Cargar contexto JSON existente o crear uno nuevo
+        previous_messages = []
+        if conversation_context_json:
+            try:
+                context = json.loads(conversation_context_json)
+                all_loaded_messages = context.get("messages", [])
+                # Obtener solo los mensajes de usuario y asistente (excluir system)
+                previous_messages = [msg for msg in all_loaded_messages if msg.get("role") in ["user", "assistant"]]
+            except (json.JSONDecodeError, TypeError, AttributeError):
+                previous_messages = []
+        
+        # Construir la lista de mensajes: system message primero, luego mensajes previos, luego mensaje actual
+        messages = []
+        
+        # Siempre agregar el system message primero
+        messages.append({
+            "role": "system",
+            "content": f"""Eres un asistente de voz profesional y amigable para una empresa.
+
+Lógica del negocio y cómo debes actuar:
+{business_logic}
+
+Responde de manera natural, concisa y útil. Tu respuesta debe ser apropiada para ser convertida a voz. Mantén el contexto de la conversación anterior."""
+        })
+        
+        # Agregar mensajes previos de la conversación
+        messages.extend(previous_messages)
+        
+        # Agregar el mensaje actual del usuario
+        messages.append({
+            "role": "user",
+            "content": user_message
+        })
+        return messages
+
+    def _dump_context(self, messages: list) -> str:
+        """Contexto JSON de la conversación que se guarda en calls.conversation_context"""
+        updated_context = {
+            "messages": messages,
+            "last_updated": datetime.now().isoformat()
+        }
+        return json.dumps(updated_context, ensure_ascii=False)
+
     def _check_if_user_wants_to_end(self, user_message: str) -> bool:
         """
         Detecta si el usuario quiere terminar la conversación
@@ -166,21 +293,37 @@ Responde de manera natural, concisa y útil. Tu respuesta debe ser apropiada par
     # =============================================================
     # TEXT → SPEECH (PlayAI TTS) – CORREGIDO
     # =============================================================
+    TTS_MODEL = "playai-tts"
+    TTS_VOICE = "Mikail-PlayAI"
+    TTS_FORMAT = "wav"
+
     async def text_to_speech(self, text: str) -> str:
         """
         Convierte texto a audio usando Groq PlayAI TTS (sin streaming, usando .read())
         Devuelve audio en Base64
         """
+        audio_bytes = await asyncio.to_thread(self.synthesize_speech, text)
+
+        # Codificar a Base64 para enviarlo por WebSocket/HTTP
+        return base64.b64encode(audio_bytes).decode("utf-8")
+
+    def synthesize_speech(self, text: str) -> bytes:
+        """
+        Versión síncrona de text_to_speech que devuelve los bytes WAV.
+        Se usa desde hilos (cache de audio para Twilio) para no bloquear el event loop.
+        """
         try:
             if not self.groq_key:
                 raise Exception("GROQ_API_KEY no está configurada")
 
-            client = Groq(api_key=self.groq_key)
+            client = self.client
 
-            response = client.audio.speech.create(
-                model="playai-tts",
-                voice="Mikail-PlayAI",
-                response_format="wav",
+            response = self._request(
+                "tts",
+                client.audio.speech.create,
+                model=self.TTS_MODEL,
+                voice=self.TTS_VOICE,
+                response_format=self.TTS_FORMAT,
                 input=text
             )
 
@@ -190,8 +333,7 @@ Responde de manera natural, concisa y útil. Tu respuesta debe ser apropiada par
             if not audio_bytes:
                 raise Exception("No se obtuvo audio de la respuesta TTS")
 
-            # Codificar a Base64 para enviarlo por WebSocket/HTTP
-            return base64.b64encode(audio_bytes).decode("utf-8")
+            return audio_bytes
 
         except Exception as e:
             error_msg = str(e)
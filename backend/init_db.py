@@ -1,11 +1,10 @@
 """
 Script para inicializar la base de datos y crear el primer usuario administrador
 """
-from database import SessionLocal, engine, Base
+from database import SessionLocal
 from models import User
 from auth import get_password_hash
-
-Base.metadata.create_all(bind=engine)
+from schema_setup import init_schema
 
 def create_super_admin():
     db = SessionLocal()
@@ -37,6 +36,7 @@ def create_super_admin():
 
 if __name__ == "__main__":
     print("Inicializando base de datos...")
+    init_schema()
     create_super_admin()
     print("\nBase de datos inicializada correctamente.")
 
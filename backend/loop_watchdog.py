@@ -0,0 +1,220 @@
+"""
+Detector de bloqueos del event loop (opcional, LOOP_WATCHDOG=log|strict)
+
+Una llamada síncrona dentro de un endpoint async (bcrypt, consultas de SQLAlchemy,
+el SDK de Groq...) detiene el event loop y con él todas las peticiones del worker.
+
+- Un latido en el event loop se despierta cada LOOP_WATCHDOG_INTERVAL_MS y mide con
+  qué retraso lo hace (event_loop_lag_seconds)
+- Un hilo vigila el latido: si lleva más de LOOP_BLOCK_THRESHOLD_MS sin llegar, captura
+  la pila del hilo del event loop y la ruta de la petición que se estaba ejecutando
+- Cuando el loop se libera se cuenta el bloqueo por ruta (event_loop_blocks_total,
+  event_loop_blocked_seconds_total) y se imprime con su pila
+
+Los bloqueos de menos de umbral + intervalo pueden terminar antes de que el hilo los
+vea: se cuentan igual, con ruta "unknown" y sin pila.
+
+En modo strict (pruebas y desarrollo) la petición que bloqueó el loop responde 500
+en lugar de su respuesta normal, para que la regresión no pase desapercibida.
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+
+from metrics import EVENT_LOOP_BLOCKED_SECONDS, EVENT_LOOP_BLOCKS, EVENT_LOOP_LAG
+from settings import settings
+
+WATCHDOG_OFF = "off"
+WATCHDOG_LOG = "log"
+WATCHDOG_STRICT = "strict"
+
+STACK_LIMIT = 20  # Frames más internos de la pila que se guardan
+RECENT_BLOCKS = 100
+
+
+class _RequestRecord:
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.blocks = []  # Duración en ms de cada bloqueo durante la petición
+        self.blocked = False  # Lo marca el vigilante en cuanto ve el bloqueo, antes de que termine
+
+    @property
+    def route(self) -> str:
+        # El router de Starlette guarda la ruta en el mismo scope al resolverla
+        route = self.scope.get("route")
+        if route is None:
+            return "unmatched"
+        return f"{self.scope.get('method', '')} {getattr(route, 'path', route)}".strip()
+
+
+class _Capture:
+    def __init__(self, route: str, detail: str, stack: str, record: Optional[_RequestRecord]):
+        self.route = route
+        self.detail = detail
+        self.stack = stack
+        self.record = record
+
+
+class LoopWatchdog:
+    def __init__(
+        self,
+        mode: str = settings.loop_watchdog,
+        threshold_ms: float = settings.loop_block_threshold_ms,
+        interval_ms: float = settings.loop_watchdog_interval_ms,
+    ):
+        self.mode = (mode or WATCHDOG_OFF).lower()
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.blocks = deque(maxlen=RECENT_BLOCKS)
+        self.stats = {"blocks": 0, "failed_requests": 0}
+        self._requests: Dict[asyncio.Task, _RequestRecord] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._beat = 0.0
+        self._capture: Optional[Tuple[float, _Capture]] = None  # (latido, captura) en una sola asignación
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in (WATCHDOG_LOG, WATCHDOG_STRICT)
+
+    @property
+    def strict(self) -> bool:
+        return self.mode == WATCHDOG_STRICT
+
+    # ---------- Ciclo de vida ----------
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        print(f"✅ Detector de bloqueos del event loop activo ({self.mode}, umbral {self.threshold * 1000:.0f} ms)")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+
+    # ---------- Latido (event loop) ----------
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - self._beat - self.interval)
+            EVENT_LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                self._finish_block(lag)
+            self._beat = now
+
+    def _finish_block(self, lag: float):
+        captured = self._capture
+        capture = captured[1] if captured is not None and captured[0] == self._beat else None
+        route = capture.route if capture else "unknown"
+        blocked_ms = round(lag * 1000, 1)
+
+        EVENT_LOOP_BLOCKS.labels(route).inc()
+        EVENT_LOOP_BLOCKED_SECONDS.labels(route).inc(lag)
+        self.stats["blocks"] += 1
+        self.blocks.append({
+            "route": route,
+            "blocked_ms": blocked_ms,
+            "detail": capture.detail if capture else None,
+            "stack": capture.stack if capture else None,
+            "at": time.time(),
+        })
+        if capture and capture.record is not None:
+            capture.record.blocks.append(blocked_ms)
+
+        where = capture.detail if capture else "callback no identificado (terminó antes de capturar la pila)"
+        message = f"⚠️ Event loop bloqueado {blocked_ms:.0f} ms en {where}"
+        if capture:
+            message += f"\n{capture.stack.rstrip()}"
+        print(message)
+
+    # ---------- Vigilante (hilo aparte) ----------
+
+    def _watch(self):
+        while not self._stopping.wait(self.interval):
+            beat = self._beat
+            captured = self._capture
+            if captured is not None and captured[0] == beat:
+                continue  # Este bloqueo ya se capturó
+            if time.perf_counter() - beat - self.interval > self.threshold:
+                self._capture = (beat, self._take_capture())
+
+    def _take_capture(self) -> _Capture:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT)) if frame else ""
+        task = asyncio.current_task(self._loop)
+        record = self._requests.get(task) if task is not None else None
+        if record is not None:
+            record.blocked = True
+            return _Capture(record.route, f"{record.route} ({record.scope.get('path')})", stack, record)
+        if task is not None:
+            return _Capture("background", f"tarea {task.get_name()}", stack, None)
+        return _Capture("background", "callback del event loop", stack, None)
+
+
+class LoopWatchdogMiddleware:
+    """Asocia cada petición a su tarea para atribuirle los bloqueos; en strict responde 500"""
+
+    def __init__(self, app, watchdog: LoopWatchdog):
+        self.app = app
+        self.watchdog = watchdog
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.watchdog._task is None:
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        record = _RequestRecord(scope)
+        self.watchdog._requests[task] = record
+        replaced = False
+
+        async def guarded_send(message):
+            nonlocal replaced
+            if replaced:
+                return
+            if self.watchdog.strict and message["type"] == "http.response.start" and record.blocked:
+                replaced = True
+                self.watchdog.stats["failed_requests"] += 1
+                blocked_ms = max(record.blocks) if record.blocks else self.watchdog.threshold * 1000
+                response = JSONResponse(status_code=500, content={
+                    "detail": f"La petición bloqueó el event loop {blocked_ms:.0f} ms (LOOP_WATCHDOG=strict)",
+                    "route": record.route,
+                })
+                await response(scope, receive, send)
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, receive, guarded_send)
+        finally:
+            self.watchdog._requests.pop(task, None)
+
+
+loop_watchdog = LoopWatchdog()
@@ -1,27 +1,139 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, defer
 from typing import Optional
+from datetime import datetime, timedelta
+import asyncio
+import hashlib
 import os
-from dotenv import load_dotenv
 
-from database import SessionLocal, engine, Base
-from models import User, Company, Document, Call, CallMessage
+from database import SessionLocal, engine, get_db
+from settings import settings
+from models import User, Company, CompanyPhoneNumber, Document, Call, CallMessage, ProfileCapture, RequestProfile
 from schemas import (
     UserCreate, UserLogin, CompanyUserCreate, CompanyCreate, CompanyUpdate, DocumentCreate,
-    CallCreate, CallMessageCreate, CallResponse, CallDetailResponse, UserResponse
+    CallCreate, CallMessageCreate, CallMessageResponse, CallResponse, CallDetailResponse, UserResponse,
+    PhoneNumberCreate, PhoneNumberResponse, ProfileCaptureCreate, ProfileCaptureResponse, RequestProfileResponse
+)
+from auth import (
+    get_current_user, create_access_token, hash_password_async, verify_password_async, invalidate_user,
+    shutdown_password_executor
 )
-from auth import get_current_user, create_access_token, verify_password, get_password_hash
 from groq_service import GroqService
-from twilio_service import TwilioService
-from fastapi.responses import Response
+from twilio_service import (
+    TwilioService, FIXED_PROMPTS, welcome_message, PROMPT_NO_COMPANIES, PROMPT_NUMBER_NOT_ASSIGNED,
+    PROMPT_ERROR, PROMPT_CALL_NOT_FOUND, PROMPT_COMPANY_NOT_CONFIGURED, PROMPT_REPEAT, PROMPT_PROCESSING_ERROR,
+    PROMPT_SERVICE_UNAVAILABLE
+)
+from tts_cache import TTSAudioCache
+from twilio_speculation import SpeculativeResponder, SPECULATION_ENABLED, normalize_transcript
+from call_turns import CallTurnCoordinator, ConcurrentTurnError, run_versioned_turn
+from call_state import ActiveCallStore, mark_call_ended
+from export_service import stream_export
+from analytics_service import record_call_ended, record_call_change, get_rollups, summarize
+from search_service import search_shards
+from schema_setup import init_schema, schema_init_enabled
+from archive_service import load_archive
+from sharding import shard_router, ShardSessions
+from company_cache import company_resolver, normalize_phone_number
+from twilio_status import StatusIngestor
+from turn_traces import TraceWriter, current_trace, load_traces, start_trace
+from usage_accounting import BudgetExceededError, UsageMeter, bind_usage, get_call_usage, get_company_usage
+from loop_watchdog import LoopWatchdogMiddleware, loop_watchdog
+from request_profiler import (
+    PROFILE_CAPTURE_TTL_MINUTES, PROFILE_MAX_REQUESTS, ProfilingMiddleware, request_profiler
+)
+import metrics
+from fastapi.responses import Response, StreamingResponse, FileResponse, JSONResponse
+from fastapi import Request
+from sqlalchemy import text
+
+# Estado en memoria del proceso (sin efectos secundarios al importar)
+active_calls = ActiveCallStore()
+twilio_status_ingestor = StatusIngestor(shard_router, on_call_ended=active_calls.evict)
+call_turns = CallTurnCoordinator()
+turn_trace_writer = TraceWriter(shard_router)
+usage_meter = UsageMeter(shard_router, SessionLocal)
+
+# Clientes de servicios externos: se crean en lifespan (create_services)
+groq_service: Optional[GroqService] = None
+twilio_service: Optional[TwilioService] = None
+tts_cache: Optional[TTSAudioCache] = None
+speculative_responder: Optional[SpeculativeResponder] = None
 
-load_dotenv()
+# Reproducir en las llamadas audio generado con Groq (<Play>) en lugar de la voz de Twilio (<Say>)
+TWILIO_PLAY_AUDIO = settings.twilio_play_audio
 
-Base.metadata.create_all(bind=engine)
+def create_services():
+    """Crea los clientes de Groq y Twilio y lo que depende de ellos"""
+    global groq_service, twilio_service, tts_cache, speculative_responder
+    groq_service = GroqService(usage_meter=usage_meter)
+    twilio_service = TwilioService()
+    tts_cache = TTSAudioCache(groq_service)
+    speculative_responder = SpeculativeResponder(groq_service)
 
-app = FastAPI(title="Voice Assistant API")
+def warm_up():
+    """Comprueba la conexión con cada shard y carga las caches antes de aceptar tráfico"""
+    for shard_engine in shard_router.engines:
+        with shard_engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    company_resolver.warm()
+    usage_meter.refresh_spent()
+
+async def pregenerate_twilio_audio():
+    """Genera el audio de los mensajes fijos y de bienvenida de cada empresa"""
+    try:
+        texts = list(FIXED_PROMPTS)
+        db = SessionLocal()
+        try:
+            texts.extend(welcome_message(name) for (name,) in db.query(Company.name).all())
+        finally:
+            db.close()
+        await tts_cache.pregenerate(texts)
+    except Exception as e:
+        print(f"⚠️ Error generando audio por adelantado: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    loop_watchdog.start()
+    if schema_init_enabled():
+        await asyncio.to_thread(init_schema)
+    create_services()
+    await asyncio.to_thread(warm_up)
+    
+    twilio_status_ingestor.start()
+    turn_trace_writer.start()
+    usage_meter.start()
+    request_profiler.start()
+    active_calls.start_sweeper(shard_router.sessionmakers)
+    pregenerate_task = asyncio.create_task(pregenerate_twilio_audio()) if TWILIO_PLAY_AUDIO else None
+    app.state.ready = True
+    print(f"✅ Worker {os.getpid()} listo")
+    
+    yield
+    
+    # Apagado: dejar de recibir tráfico nuevo y vaciar las colas antes de cerrar conexiones
+    app.state.ready = False
+    if pregenerate_task:
+        pregenerate_task.cancel()
+    await active_calls.stop_sweeper()
+    await twilio_status_ingestor.stop()
+    await turn_trace_writer.stop()
+    await usage_meter.stop()
+    await request_profiler.stop()
+    await asyncio.to_thread(shutdown_password_executor)
+    # El motor principal (usuarios, empresas y shard 0) y los de los demás shards
+    engine.dispose()
+    for shard_engine in shard_router.engines:
+        if shard_engine is not engine:
+            shard_engine.dispose()
+    await loop_watchdog.stop()
+    metrics.mark_worker_stopped(os.getpid())
+
+app = FastAPI(title="Voice Assistant API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -31,17 +143,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(ProfilingMiddleware, profiler=request_profiler, router=app.router)
+
+if loop_watchdog.enabled:
+    app.add_middleware(LoopWatchdogMiddleware, watchdog=loop_watchdog)
+
 security = HTTPBearer()
 
-def get_db():
-    db = SessionLocal()
+def get_shards(db: Session = Depends(get_db)):
+    """Sesiones de los shards de llamadas (sin sharding todas son la sesión global)"""
+    shards = ShardSessions(db)
     try:
-        yield db
+        yield shards
     finally:
-        db.close()
+        shards.close()
+
+# ==================== HEALTH ====================
+
+@app.get("/api/health/live")
+async def liveness():
+    """El proceso responde"""
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+async def readiness(request: Request):
+    """200 cuando el worker terminó el arranque (esquema, clientes y caches); 503 mientras arranca o se apaga"""
+    if not getattr(request.app.state, "ready", False):
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ready", "pid": os.getpid()}
 
-groq_service = GroqService()
-twilio_service = TwilioService()
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Métricas en formato Prometheus (latencia por etapa, errores, turnos en curso)"""
+    body, content_type = metrics.render_latest()
+    return Response(content=body, media_type=content_type)
 
 # ==================== AUTH ====================
 
@@ -53,7 +188,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Email ya registrado")
     
     # Crear usuario
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await hash_password_async(user_data.password)
     user = User(
         email=user_data.email,
         password_hash=hashed_password,
@@ -65,6 +200,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
     db.add(user)
     db.commit()
     db.refresh(user)
+    invalidate_user(user.email)
     
     token = create_access_token({"sub": user.email, "role": user.role})
     return {
@@ -83,9 +219,18 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
 @app.post("/api/auth/login")
 async def login(credentials: UserLogin, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.email == credentials.email).first()
-    if not user or not verify_password(credentials.password, user.password_hash):
+    if not user:
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
+    valid, new_hash = await verify_password_async(credentials.password, user.password_hash)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Credenciales inválidas")
+    
+    # Actualizar el hash si se cambió BCRYPT_ROUNDS
+    if new_hash:
+        user.password_hash = new_hash
+        db.commit()
+    
     token = create_access_token({"sub": user.email, "role": user.role})
     return {
         "access_token": token,
@@ -142,7 +287,7 @@ async def create_user(
         raise HTTPException(status_code=400, detail="Rol inválido. Debe ser 'company_admin' o 'client'")
     
     # Crear usuario con el rol especificado
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await hash_password_async(user_data.password)
     user = User(
         email=user_data.email,
         password_hash=hashed_password,
@@ -154,6 +299,7 @@ async def create_user(
     db.add(user)
     db.commit()
     db.refresh(user)
+    invalidate_user(user.email)
     
     return UserResponse(
         id=user.id,
@@ -217,6 +363,7 @@ async def create_company(
     
     company = Company(**company_data.dict())
     db.add(company)
+    company_resolver.invalidate(db)
     db.commit()
     db.refresh(company)
     return company
@@ -261,10 +408,77 @@ async def update_company(
         if hasattr(company, field):
             setattr(company, field, value)
     
+    company_resolver.invalidate(db)
     db.commit()
     db.refresh(company)
     return company
 
+@app.get("/api/companies/{company_id}/phone-numbers")
+async def get_company_phone_numbers(
+    company_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Listar los números de Twilio de una empresa"""
+    if current_user.role != "super_admin" and current_user.company_id != company_id:
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    numbers = db.query(CompanyPhoneNumber).filter(CompanyPhoneNumber.company_id == company_id).all()
+    return [PhoneNumberResponse.model_validate(number) for number in numbers]
+
+@app.post("/api/companies/{company_id}/phone-numbers")
+async def add_company_phone_number(
+    company_id: int,
+    phone_data: PhoneNumberCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Asignar un número de Twilio a una empresa (solo super_admin)"""
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    company = db.query(Company).filter(Company.id == company_id).first()
+    if not company:
+        raise HTTPException(status_code=404, detail="Empresa no encontrada")
+    
+    phone_number = normalize_phone_number(phone_data.phone_number)
+    if not phone_number:
+        raise HTTPException(status_code=400, detail="Número inválido. Usa formato E.164 (ej: +5215512345678)")
+    
+    existing = db.query(CompanyPhoneNumber).filter(CompanyPhoneNumber.phone_number == phone_number).first()
+    if existing:
+        raise HTTPException(status_code=400, detail="El número ya está asignado a una empresa")
+    
+    number = CompanyPhoneNumber(company_id=company_id, phone_number=phone_number)
+    db.add(number)
+    company_resolver.invalidate(db)
+    db.commit()
+    db.refresh(number)
+    return PhoneNumberResponse.model_validate(number)
+
+@app.delete("/api/companies/{company_id}/phone-numbers/{number_id}")
+async def delete_company_phone_number(
+    company_id: int,
+    number_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Quitar un número de Twilio de una empresa (solo super_admin)"""
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    number = db.query(CompanyPhoneNumber).filter(
+        CompanyPhoneNumber.id == number_id,
+        CompanyPhoneNumber.company_id == company_id
+    ).first()
+    if not number:
+        raise HTTPException(status_code=404, detail="Número no encontrado")
+    
+    db.delete(number)
+    company_resolver.invalidate(db)
+    db.commit()
+    return {"ok": True}
+
 # ==================== DOCUMENTS ====================
 
 @app.post("/api/documents")
@@ -311,11 +525,46 @@ async def get_documents(
 
 # ==================== CALLS ====================
 
+def build_call_responses(calls) -> list:
+    """Respuesta de GET /api/calls a partir de las filas de calls"""
+    return [CallResponse(
+        id=call.id,
+        company_id=call.company_id,
+        client_id=call.client_id,
+        start_time=call.start_time,
+        end_time=call.end_time,
+        rating=call.rating
+    ) for call in calls]
+
+def build_message_responses(messages, traces: dict) -> list:
+    """Mensajes de GET /api/calls/{id} con la traza del turno en los del asistente"""
+    return [CallMessageResponse(
+        id=msg.id,
+        role=msg.role,
+        content=msg.content,
+        timestamp=msg.timestamp,
+        trace=traces.get(msg.id)
+    ) for msg in messages]
+
+def build_call_detail(call, conversation_context: Optional[str], client: Optional[User], messages: list) -> CallDetailResponse:
+    return CallDetailResponse(
+        id=call.id,
+        company_id=call.company_id,
+        client_id=call.client_id,
+        start_time=call.start_time,
+        end_time=call.end_time,
+        rating=call.rating,
+        conversation_context=conversation_context,
+        client_name=client.name if client else None,
+        client_phone=client.phone if client else None,
+        messages=messages
+    )
+
 @app.post("/api/calls")
 async def create_call(
     call_data: CallCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    shards: ShardSessions = Depends(get_shards)
 ):
     if current_user.role != "client":
         raise HTTPException(status_code=403, detail="Solo clientes pueden crear llamadas")
@@ -323,6 +572,7 @@ async def create_call(
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="Cliente no asociado a una empresa")
     
+    db = shards.for_company(current_user.company_id)
     call = Call(
         company_id=current_user.company_id,
         client_id=current_user.id,
@@ -337,34 +587,68 @@ async def create_call(
 @app.get("/api/calls")
 async def get_calls(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    shards: ShardSessions = Depends(get_shards)
 ):
     if current_user.role == "super_admin":
-        calls = db.query(Call).all()
+        calls = [call for db in shards.all() for call in db.query(Call).all()]
     elif current_user.role == "company_admin" and current_user.company_id:
+        db = shards.for_company(current_user.company_id)
         calls = db.query(Call).filter(Call.company_id == current_user.company_id).order_by(Call.start_time.desc()).all()
     elif current_user.role == "client":
+        db = shards.for_company(current_user.company_id)
         calls = db.query(Call).filter(Call.client_id == current_user.id).order_by(Call.start_time.desc()).all()
     else:
         raise HTTPException(status_code=403, detail="No autorizado")
     
-    from schemas import CallResponse
-    return [CallResponse(
-        id=call.id,
-        company_id=call.company_id,
-        client_id=call.client_id,
-        start_time=call.start_time,
-        end_time=call.end_time,
-        rating=call.rating
-    ) for call in calls]
+    return build_call_responses(calls)
+
+@app.get("/api/calls/export")
+async def export_calls(
+    current_user: User = Depends(get_current_user),
+    format: str = Query("ndjson"),
+    company_id: Optional[int] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    gzip: bool = False
+):
+    """Exportar llamadas y sus mensajes en streaming (NDJSON o CSV)"""
+    if format not in ["ndjson", "csv"]:
+        raise HTTPException(status_code=400, detail="Formato inválido. Debe ser 'ndjson' o 'csv'")
+    
+    if current_user.role == "company_admin" and current_user.company_id:
+        # Un administrador de empresa solo puede exportar su propia empresa
+        if company_id is not None and company_id != current_user.company_id:
+            raise HTTPException(status_code=403, detail="No autorizado")
+        company_id = current_user.company_id
+    elif current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"calls.{format}" + (".gz" if gzip else "")
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if gzip:
+        media_type = "application/gzip"
+    
+    if company_id is not None:
+        session_factories = [shard_router.sessionmakers[shard_router.shard_for_company(company_id)]]
+    else:
+        session_factories = shard_router.sessionmakers
+    
+    return StreamingResponse(
+        stream_export(format, company_id, start_date, end_date, compress=gzip, session_factories=session_factories),
+        media_type=media_type,
+        headers=headers
+    )
 
 @app.get("/api/calls/{call_id}")
 async def get_call_detail(
     call_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    shards: ShardSessions = Depends(get_shards)
 ):
-    call = db.query(Call).filter(Call.id == call_id).first()
+    call_db = shards.for_call(call_id)
+    call = call_db.query(Call).filter(Call.id == call_id).first()
     if not call:
         raise HTTPException(status_code=404, detail="Llamada no encontrada")
     
@@ -374,34 +658,34 @@ async def get_call_detail(
     if current_user.role == "company_admin" and call.company_id != current_user.company_id:
         raise HTTPException(status_code=403, detail="No autorizado")
     
-    messages = db.query(CallMessage).filter(CallMessage.call_id == call_id).order_by(CallMessage.timestamp).all()
+    conversation_context = getattr(call, 'conversation_context', None)
     
-    from schemas import CallMessageResponse
-    return CallDetailResponse(
-        id=call.id,
-        company_id=call.company_id,
-        client_id=call.client_id,
-        start_time=call.start_time,
-        end_time=call.end_time,
-        rating=call.rating,
-        conversation_context=getattr(call, 'conversation_context', None),
-        client_name=call.client.name if call.client else None,
-        client_phone=call.client.phone if call.client else None,
-        messages=[CallMessageResponse(
-            id=msg.id,
-            role=msg.role,
-            content=msg.content,
-            timestamp=msg.timestamp
-        ) for msg in messages]
-    )
+    # Las llamadas archivadas guardan mensajes y contexto en call_archives
+    archived = load_archive(call_db, call_id) if call.archived_at else None
+    if archived:
+        conversation_context = archived["conversation_context"]
+        messages = [CallMessageResponse(**msg) for msg in archived["messages"]]
+    else:
+        # Tiempos de cada turno, en el mensaje del asistente
+        traces = load_traces(call_db, call_id)
+        messages = build_message_responses(
+            call_db.query(CallMessage).filter(CallMessage.call_id == call_id).order_by(CallMessage.timestamp).all(),
+            traces
+        )
+    
+    # El cliente vive en la base global, no en el shard de la llamada
+    client = db.query(User).filter(User.id == call.client_id).first() if call.client_id else None
+    
+    return build_call_detail(call, conversation_context, client, messages)
 
 @app.post("/api/calls/{call_id}/messages")
 async def add_message(
     call_id: int,
     message_data: CallMessageCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    shards: ShardSessions = Depends(get_shards)
 ):
+    db = shards.for_call(call_id)
     call = db.query(Call).filter(Call.id == call_id).first()
     if not call:
         raise HTTPException(status_code=404, detail="Llamada no encontrada")
@@ -421,22 +705,227 @@ async def add_message(
 async def end_call(
     call_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    shards: ShardSessions = Depends(get_shards),
     rating: int = Query(None)
 ):
+    db = shards.for_call(call_id)
     call = db.query(Call).filter(Call.id == call_id).first()
     if not call:
         raise HTTPException(status_code=404, detail="Llamada no encontrada")
     
-    from datetime import datetime
+    previous_end_time = call.end_time
+    previous_rating = call.rating
     call.end_time = datetime.utcnow()
     if rating is not None:
         call.rating = rating
+    
+    # Actualizar los agregados de analítica en la misma transacción
+    if previous_end_time is not None:
+        record_call_change(db, call, previous_rating, previous_end_time)
+    else:
+        record_call_ended(db, call)
     db.commit()
     db.refresh(call)
+    active_calls.evict(call_id)
     
     return call
 
+# ==================== ANALYTICS ====================
+
+@app.get("/api/analytics/calls")
+async def get_call_analytics(
+    current_user: User = Depends(get_current_user),
+    shards: ShardSessions = Depends(get_shards),
+    granularity: str = Query("day"),
+    company_id: Optional[int] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None
+):
+    """Métricas agregadas de llamadas por hora o día (lee los rollups, no las llamadas)"""
+    if granularity not in ["hour", "day"]:
+        raise HTTPException(status_code=400, detail="Granularidad inválida. Debe ser 'hour' o 'day'")
+    
+    if current_user.role == "company_admin" and current_user.company_id:
+        if company_id is not None and company_id != current_user.company_id:
+            raise HTTPException(status_code=403, detail="No autorizado")
+        company_id = current_user.company_id
+    elif current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    sessions = [shards.for_company(company_id)] if company_id is not None else shards.all()
+    rollups = [rollup for db in sessions for rollup in get_rollups(db, granularity, company_id, start_date, end_date)]
+    return {"granularity": granularity, **summarize(rollups)}
+
+@app.get("/api/usage")
+async def get_usage(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    company_id: Optional[int] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None
+):
+    """Uso y coste estimado de Groq por empresa, día y modelo"""
+    if current_user.role == "company_admin" and current_user.company_id:
+        if company_id is not None and company_id != current_user.company_id:
+            raise HTTPException(status_code=403, detail="No autorizado")
+        company_id = current_user.company_id
+    elif current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    usage = get_company_usage(db, company_id, start_date, end_date)
+    if company_id is not None:
+        company = company_resolver.get(company_id)
+        usage["budget"] = {
+            "daily_budget_usd": company.daily_budget_usd if company else None,
+            "budget_action": company.budget_action if company else None,
+            "spent_today_usd": round(usage_meter.spent_today(company_id), 6),
+        }
+    return usage
+
+@app.get("/api/calls/{call_id}/usage")
+async def get_call_usage_detail(
+    call_id: int,
+    current_user: User = Depends(get_current_user),
+    shards: ShardSessions = Depends(get_shards)
+):
+    """Uso y coste estimado de Groq de una llamada, por modelo"""
+    call_db = shards.for_call(call_id)
+    call = call_db.query(Call.company_id).filter(Call.id == call_id).first()
+    if not call:
+        raise HTTPException(status_code=404, detail="Llamada no encontrada")
+    if current_user.role == "company_admin" and call.company_id != current_user.company_id:
+        raise HTTPException(status_code=403, detail="No autorizado")
+    if current_user.role not in ("super_admin", "company_admin"):
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    return get_call_usage(call_db, call_id)
+
+# ==================== SEARCH ====================
+
+@app.get("/api/search/messages")
+async def search_call_messages(
+    q: str = Query(..., min_length=1),
+    current_user: User = Depends(get_current_user),
+    shards: ShardSessions = Depends(get_shards),
+    company_id: Optional[int] = None,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100)
+):
+    """Búsqueda de texto completo en las transcripciones, ordenada por relevancia"""
+    if current_user.role == "company_admin" and current_user.company_id:
+        if company_id is not None and company_id != current_user.company_id:
+            raise HTTPException(status_code=403, detail="No autorizado")
+        company_id = current_user.company_id
+    elif current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    sessions = [shards.for_company(company_id)] if company_id is not None else list(shards.all())
+    results = search_shards(sessions, q, company_id, page, page_size)
+    return {"query": q, "page": page, "page_size": page_size, "results": results}
+
+# ==================== PROFILING ====================
+
+@app.post("/api/profiling/captures")
+async def create_profile_capture(
+    capture_data: ProfileCaptureCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Perfilar las próximas N peticiones que cumplan el filtro de ruta y/o empresa (solo super_admin)"""
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    if capture_data.requests > PROFILE_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"Máximo {PROFILE_MAX_REQUESTS} peticiones por captura")
+    
+    company_label = None
+    if capture_data.company:
+        company = company_resolver.resolve(capture_data.company)
+        if not company:
+            raise HTTPException(status_code=404, detail="Empresa no encontrada")
+        # Misma etiqueta que usan las métricas (metrics.set_company)
+        company_label = company.identifier or str(company.id)
+    
+    minutes = min(capture_data.expires_minutes or PROFILE_CAPTURE_TTL_MINUTES, PROFILE_CAPTURE_TTL_MINUTES)
+    now = datetime.utcnow()
+    capture = ProfileCapture(
+        route=capture_data.route or None,
+        company=company_label,
+        requested=capture_data.requests,
+        remaining=capture_data.requests,
+        created_by=current_user.id,
+        created_at=now,
+        expires_at=now + timedelta(minutes=minutes)
+    )
+    db.add(capture)
+    db.commit()
+    db.refresh(capture)
+    request_profiler.add_capture(capture)
+    return ProfileCaptureResponse.model_validate(capture)
+
+@app.get("/api/profiling/captures")
+async def list_profile_captures(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Capturas de perfilado recientes (solo super_admin)"""
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    captures = db.query(ProfileCapture).order_by(ProfileCapture.id.desc()).limit(100).all()
+    return [ProfileCaptureResponse.model_validate(capture) for capture in captures]
+
+@app.delete("/api/profiling/captures/{capture_id}")
+async def cancel_profile_capture(
+    capture_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Cancelar una captura: no se perfilan más peticiones para ella (solo super_admin)"""
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    capture = db.query(ProfileCapture).filter(ProfileCapture.id == capture_id).first()
+    if not capture:
+        raise HTTPException(status_code=404, detail="Captura no encontrada")
+    
+    capture.remaining = 0
+    db.commit()
+    request_profiler.remove_capture(capture_id)
+    return {"ok": True}
+
+@app.get("/api/profiling/profiles")
+async def list_request_profiles(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    capture_id: Optional[int] = None
+):
+    """Perfiles guardados, del más reciente al más antiguo (solo super_admin)"""
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    query = db.query(RequestProfile).options(defer(RequestProfile.collapsed))
+    if capture_id is not None:
+        query = query.filter(RequestProfile.capture_id == capture_id)
+    profiles = query.order_by(RequestProfile.id.desc()).all()
+    return [RequestProfileResponse.model_validate(profile) for profile in profiles]
+
+@app.get("/api/profiling/profiles/{profile_id}")
+async def download_request_profile(
+    profile_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Descargar un perfil como pilas colapsadas (flamegraph.pl, speedscope) (solo super_admin)"""
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    profile = db.query(RequestProfile).filter(RequestProfile.id == profile_id).first()
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    
+    headers = {"Content-Disposition": f'attachment; filename="profile-{profile_id}.collapsed"'}
+    return Response(content=profile.collapsed or "", media_type="text/plain; charset=utf-8", headers=headers)
+
 # ==================== VOICE ASSISTANT ====================
 
 @app.post("/api/voice/process")
@@ -444,33 +933,29 @@ async def process_voice(
     audio_file: UploadFile = File(...),
     call_id: Optional[str] = Form(None),
     company_identifier: str = Form(...),  # ID o nombre de la empresa - REQUERIDO
-    db: Session = Depends(get_db)
+    shards: ShardSessions = Depends(get_shards)
 ):
     """Endpoint público para procesar audio. No requiere autenticación."""
     
     if not company_identifier or not company_identifier.strip():
         raise HTTPException(status_code=400, detail="company_identifier es requerido")
     
-    # Buscar la empresa por identificador único, ID o nombre
-    company = None
-    # Primero buscar por identifier (campo único)
-    company = db.query(Company).filter(Company.identifier == company_identifier.strip()).first()
+    start_trace()
     
-    if not company:
-        # Si no se encuentra por identifier, intentar por ID
-        try:
-            company_id = int(company_identifier)
-            company = db.query(Company).filter(Company.id == company_id).first()
-        except ValueError:
-            pass
-    
-    if not company:
-        # Si no se encuentra por ID, buscar por nombre
-        company = db.query(Company).filter(Company.name == company_identifier).first()
+    # Buscar la empresa por identificador único, ID o nombre (cache en memoria)
+    with metrics.stage("company_resolution"):
+        company = company_resolver.resolve(company_identifier)
+        metrics.set_company(company)
     
     if not company:
         raise HTTPException(status_code=404, detail="Empresa no encontrada. Verifica el identificador.")
     
+    # Empresas que superaron su presupuesto diario en modo throttle (sin consultar la base de datos)
+    try:
+        usage_meter.check_budget(company)
+    except BudgetExceededError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    
     # Convertir call_id a int si existe
     call_id_int = None
     if call_id and call_id.strip():
@@ -479,27 +964,34 @@ async def process_voice(
         except ValueError:
             raise HTTPException(status_code=400, detail="call_id inválido")
     
+    # Las llamadas y sus mensajes viven en el shard de la empresa
+    call_db = shards.for_company(company.id) if call_id_int is None else shards.for_call(call_id_int)
+    
     # Obtener o crear llamada (sin cliente asociado)
     if call_id_int is None:
-        from datetime import datetime
         call = Call(
             company_id=company.id,
             client_id=None,  # Llamada anónima
             start_time=datetime.utcnow()
         )
-        db.add(call)
-        db.commit()
-        db.refresh(call)
-        call_id_int = call.id
-    else:
-        call = db.query(Call).filter(Call.id == call_id_int).first()
-        if not call:
-            raise HTTPException(status_code=404, detail="Llamada no encontrada")
-        # Verificar que la llamada pertenece a la empresa correcta
-        if call.company_id != company.id:
-            raise HTTPException(status_code=400, detail="La llamada no pertenece a esta empresa")
+        call_db.add(call)
+        with metrics.stage("db_commit"):
+            call_db.commit()
+        call_db.refresh(call)
+        active_calls.put_call(call)
         call_id_int = call.id
     
+    # El uso de Groq del turno se atribuye a esta llamada
+    bind_usage(company, call_id_int)
+    
+    # Estado de la llamada (en memoria si está activa)
+    call_state = active_calls.load(call_db, call_id_int)
+    if not call_state:
+        raise HTTPException(status_code=404, detail="Llamada no encontrada")
+    # Verificar que la llamada pertenece a la empresa correcta
+    if call_state.company_id != company.id:
+        raise HTTPException(status_code=400, detail="La llamada no pertenece a esta empresa")
+    
     # Obtener lógica de negocio de la empresa
     if not company.business_logic:
         raise HTTPException(status_code=400, detail="La empresa no tiene lógica de negocio configurada")
@@ -507,7 +999,8 @@ async def process_voice(
     business_logic = company.business_logic
     
     # Leer audio
-    audio_data = await audio_file.read()
+    with metrics.stage("upload_read"):
+        audio_data = await audio_file.read()
     
     # Validar que el audio tenga contenido
     if not audio_data or len(audio_data) == 0:
@@ -517,51 +1010,68 @@ async def process_voice(
         raise HTTPException(status_code=400, detail="El archivo de audio es demasiado corto. Graba al menos 0.01 segundos de audio.")
     
     # Procesar con Groq
-    try:
+    async def process_turn():
         # 1. Speech to Text (Whisper)
-        transcript = await groq_service.speech_to_text(audio_data)
+        with metrics.stage("stt"):
+            transcript = await groq_service.speech_to_text(audio_data)
         
-        # Guardar mensaje del cliente
-        client_message = CallMessage(
-            call_id=call_id_int,
-            role="client",
-            content=transcript
-        )
-        db.add(client_message)
-        db.commit()
-        db.refresh(client_message)
+        turn_messages = {}
         
-        # Obtener la llamada y su contexto JSON
-        call = db.query(Call).filter(Call.id == call_id_int).first()
-        
-        # 2. Text to Text (GPT OSS 120B) con la lógica de negocio y el contexto JSON
-        response_text, context_json, should_end_call = await groq_service.text_to_text(
-            transcript, 
-            business_logic,
-            conversation_context_json=call.conversation_context if call else None
-        )
-        
-        # Guardar mensaje del asistente
-        assistant_message = CallMessage(
-            call_id=call_id_int,
-            role="assistant",
-            content=response_text
-        )
-        db.add(assistant_message)
+        async def generate_response(state):
+            # 2. Text to Text (GPT OSS 120B) con la lógica de negocio y el contexto JSON
+            with metrics.stage("llm"):
+                response_text, context_json, should_end_call = await groq_service.text_to_text(
+                    transcript, 
+                    business_logic,
+                    conversation_context_json=state.context
+                )
+            
+            # Guardar mensaje del asistente
+            turn_messages["assistant"] = CallMessage(
+                call_id=call_id_int,
+                role="assistant",
+                content=response_text
+            )
+            call_db.add(turn_messages["assistant"])
+            return (response_text, should_end_call), context_json
         
-        # Actualizar el contexto JSON en la llamada
-        if call:
-            call.conversation_context = context_json
+        # Los turnos de una llamada se procesan de uno en uno sobre el contexto más reciente
+        async with call_turns.lock(call_id_int):
+            # Guardar mensaje del cliente
+            client_message = CallMessage(
+                call_id=call_id_int,
+                role="client",
+                content=transcript
+            )
+            call_db.add(client_message)
+            with metrics.stage("db_commit"):
+                # flush antes del commit: así el ID se lee sin recargar el objeto
+                call_db.flush()
+                client_message_id = client_message.id
+                call_db.commit()
+            
+            state, (response_text, should_end_call), context_json = await run_versioned_turn(
+                call_db, active_calls, call_id_int, generate_response
+            )
             
             # Si el usuario quiere terminar, marcar la llamada como finalizada
             if should_end_call:
-                from datetime import datetime
-                call.end_time = datetime.utcnow()
-        
-        db.commit()
+                mark_call_ended(call_db, call_id_int, datetime.utcnow())
+            
+            with metrics.stage("db_commit"):
+                call_db.flush()
+                assistant_message_id = turn_messages["assistant"].id
+                call_db.commit()
+            active_calls.saved(state, context_json, ended=should_end_call)
         
         # 3. Text to Speech (PlayAI TTS)
-        audio_response = await groq_service.text_to_speech(response_text)
+        with metrics.stage("tts"):
+            audio_response = await groq_service.text_to_speech(response_text)
+        
+        # La traza se guarda en segundo plano, sin retrasar la respuesta
+        trace = current_trace()
+        trace.attach(call_id_int, client_message_id, assistant_message_id)
+        turn_trace_writer.submit(trace)
         
         return {
             "call_id": call_id_int,
@@ -570,7 +1080,19 @@ async def process_voice(
             "audio_response": audio_response,  # Base64 encoded audio
             "call_ended": should_end_call  # Indica si la conversación terminó
         }
+    
+    try:
+        # Un doble envío del mismo audio (los mismos bytes) se une al turno en curso o reutiliza su resultado
+        fingerprint = hashlib.sha256(audio_data).hexdigest()
+        result, _ = await call_turns.run(call_id_int, fingerprint, process_turn)
+        return result
+    except ConcurrentTurnError as e:
+        metrics.TURN_ERRORS.labels("voice_process", metrics.current_company()).inc()
+        raise HTTPException(status_code=409, detail=str(e))
+    except BudgetExceededError as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
+        metrics.TURN_ERRORS.labels("voice_process", metrics.current_company()).inc()
         import traceback
         error_detail = f"Error procesando audio: {str(e)}"
         print(f"Error completo: {traceback.format_exc()}")
@@ -579,12 +1101,68 @@ async def process_voice(
 
 # ==================== TWILIO INTEGRATION ====================
 
+# URLs de los webhooks calculadas una sola vez (BASE_URL no cambia en tiempo de ejecución)
+BASE_URL = settings.base_url
+GATHER_URL_PREFIX = f"{BASE_URL}/api/twilio/gather?call_id="
+PARTIAL_URL_PREFIX = f"{BASE_URL}/api/twilio/partial?call_id="
+TTS_URL_PREFIX = f"{BASE_URL}/api/tts/"
+
+def gather_urls(call_id: int, turn: int) -> dict:
+    """
+    URLs del <Gather> de una llamada: resultado final y parciales (prefetch especulativo).
+    turn es la versión del contexto sobre la que empieza el siguiente turno: los reintentos
+    de Twilio repiten la misma URL y se reconocen aunque el turno ya se haya guardado.
+    """
+    urls = {"action_url": f"{GATHER_URL_PREFIX}{call_id}&turn={turn}"}
+    if SPECULATION_ENABLED:
+        urls["partial_callback_url"] = f"{PARTIAL_URL_PREFIX}{call_id}"
+    return urls
+
+async def twiml_response(message: str, gather: bool = False, action_url: str = None, partial_callback_url: str = None) -> Response:
+    """
+    Genera la respuesta TwiML. Si el audio del mensaje está en cache (o se
+    sintetiza a tiempo) se reproduce con <Play>; si no, se usa <Say>.
+    """
+    audio_url = None
+    if TWILIO_PLAY_AUDIO:
+        with metrics.stage("tts"):
+            clip_hash = await tts_cache.ensure(message)
+        if clip_hash:
+            audio_url = f"{TTS_URL_PREFIX}{clip_hash}.wav"
+    with metrics.stage("twiml_render"):
+        twiml = twilio_service.generate_twiml_for_call(
+            message,
+            gather=gather,
+            action_url=action_url,
+            audio_url=audio_url,
+            partial_callback_url=partial_callback_url
+        )
+    return Response(content=twiml, media_type="application/xml")
+
+
+@app.get("/api/tts/{clip_hash}.wav")
+async def get_tts_audio(clip_hash: str, request: Request):
+    """
+    Sirve un clip de audio sintetizado. El nombre es el hash del contenido,
+    así que el archivo nunca cambia y se puede cachear indefinidamente.
+    """
+    path = tts_cache.clip_path(clip_hash)
+    if not path:
+        raise HTTPException(status_code=404, detail="Audio no encontrado")
+    
+    etag = f'"{clip_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="audio/wav", headers=headers)
+
+
 @app.post("/api/twilio/incoming")
 async def twilio_incoming_call(
     From: str = Form(None),
     To: str = Form(None),
     CallSid: str = Form(None),
-    db: Session = Depends(get_db)
+    shards: ShardSessions = Depends(get_shards)
 ):
     """
     Endpoint para recibir llamadas entrantes de Twilio
@@ -598,179 +1176,272 @@ async def twilio_incoming_call(
         
         print(f"📞 Llamada entrante de {caller_number} a {called_number} (SID: {call_sid})")
         
-        # Buscar empresa por número de teléfono de Twilio (puedes configurar qué número corresponde a qué empresa)
-        # Por ahora, vamos a usar la primera empresa o una lógica específica
-        # Puedes configurar un mapeo de números Twilio a empresas en la base de datos
+        # Buscar la empresa por el número de Twilio al que se llamó (mapa en memoria)
+        with metrics.stage("company_resolution"):
+            company = company_resolver.resolve_phone_number(To)
+            if not company and not company_resolver.has_phone_numbers():
+                # Sin números configurados se mantiene el modo de una sola empresa
+                company = company_resolver.first()
+            metrics.set_company(company)
         
-        company = db.query(Company).first()  # Por ahora usar la primera empresa
+        if not company and company_resolver.has_phone_numbers():
+            return await twiml_response(
+                PROMPT_NUMBER_NOT_ASSIGNED,
+                gather=False
+            )
         
         if not company:
-            twiml = twilio_service.generate_twiml_for_call(
-                "Lo sentimos, no hay empresas configuradas en el sistema.",
+            return await twiml_response(
+                PROMPT_NO_COMPANIES,
                 gather=False
             )
-            return Response(content=twiml, media_type="application/xml")
         
-        # Crear una nueva llamada en la base de datos
-        from datetime import datetime
+        bind_usage(company)
+        try:
+            usage_meter.check_budget(company)
+        except BudgetExceededError:
+            return await twiml_response(
+                PROMPT_SERVICE_UNAVAILABLE,
+                gather=False
+            )
+        
+        # Crear una nueva llamada en la base de datos (shard de la empresa)
+        call_db = shards.for_company(company.id)
         call = Call(
             company_id=company.id,
             client_id=None,  # Llamada telefónica anónima
-            start_time=datetime.utcnow()
+            start_time=datetime.utcnow(),
+            twilio_call_sid=CallSid
         )
-        db.add(call)
-        db.commit()
-        db.refresh(call)
+        call_db.add(call)
+        with metrics.stage("db_commit"):
+            call_db.commit()
+        call_db.refresh(call)
+        active_calls.put_call(call)
         
-        # Guardar el CallSid de Twilio para referencia futura (podrías agregar un campo twilio_call_sid al modelo Call)
         print(f"✅ Llamada creada en BD: Call ID {call.id} para empresa {company.name}")
         
         # Generar mensaje de bienvenida usando la lógica de negocio
-        welcome_message = f"Hola, bienvenido a {company.name}. ¿En qué puedo ayudarte hoy?"
+        welcome_text = welcome_message(company.name)
         
         # Generar TwiML con Gather para recibir respuesta del usuario
-        action_url = f"{os.getenv('BASE_URL', 'http://localhost:8000')}/api/twilio/gather?call_id={call.id}"
-        twiml = twilio_service.generate_twiml_for_call(
-            welcome_message,
+        return await twiml_response(
+            welcome_text,
             gather=True,
-            action_url=action_url
+            **gather_urls(call.id, call.context_version)
         )
-        
-        return Response(content=twiml, media_type="application/xml")
     
     except Exception as e:
+        metrics.TURN_ERRORS.labels("twilio_incoming", metrics.current_company()).inc()
         import traceback
         print(f"❌ Error en twilio_incoming_call: {traceback.format_exc()}")
-        error_twiml = twilio_service.generate_twiml_for_call(
-            "Lo sentimos, ha ocurrido un error. Por favor, intenta más tarde.",
+        return await twiml_response(
+            PROMPT_ERROR,
             gather=False
         )
-        return Response(content=error_twiml, media_type="application/xml")
 
 
 @app.post("/api/twilio/gather")
 async def twilio_gather_audio(
     SpeechResult: str = Form(None),
     call_id: int = Query(...),
-    db: Session = Depends(get_db)
+    turn: Optional[int] = Query(None),
+    shards: ShardSessions = Depends(get_shards)
 ):
     """
     Endpoint para procesar el audio recibido de Twilio (usando speech recognition de Twilio)
     Twilio ya convierte el audio a texto usando su propio servicio de speech-to-text
     """
     try:
-        # Obtener la llamada
-        call = db.query(Call).filter(Call.id == call_id).first()
-        if not call:
-            twiml = twilio_service.generate_twiml_for_call(
-                "Error: Llamada no encontrada.",
+        start_trace()
+        
+        # Obtener la llamada (en memoria si está activa)
+        call_db = shards.for_call(call_id)
+        call_state = active_calls.load(call_db, call_id)
+        if not call_state:
+            return await twiml_response(
+                PROMPT_CALL_NOT_FOUND,
                 gather=False
             )
-            return Response(content=twiml, media_type="application/xml")
         
-        company = db.query(Company).filter(Company.id == call.company_id).first()
+        with metrics.stage("company_resolution"):
+            company = company_resolver.get(call_state.company_id)
+            metrics.set_company(company)
         if not company or not company.business_logic:
-            twiml = twilio_service.generate_twiml_for_call(
-                "Error: Empresa no encontrada o sin configuración.",
+            return await twiml_response(
+                PROMPT_COMPANY_NOT_CONFIGURED,
+                gather=False
+            )
+        
+        bind_usage(company, call_id)
+        try:
+            usage_meter.check_budget(company)
+        except BudgetExceededError:
+            return await twiml_response(
+                PROMPT_SERVICE_UNAVAILABLE,
                 gather=False
             )
-            return Response(content=twiml, media_type="application/xml")
         
         # Twilio ya convirtió el audio a texto
         user_message = SpeechResult or ""
         
         if not user_message or user_message.strip() == "":
             # Si no hay mensaje, pedir de nuevo
-            action_url = f"{os.getenv('BASE_URL', 'http://localhost:8000')}/api/twilio/gather?call_id={call_id}"
-            twiml = twilio_service.generate_twiml_for_call(
-                "No pude escucharte. Por favor, repite tu pregunta.",
+            return await twiml_response(
+                PROMPT_REPEAT,
                 gather=True,
-                action_url=action_url
+                **gather_urls(call_id, call_state.version)
             )
-            return Response(content=twiml, media_type="application/xml")
         
         print(f"💬 Mensaje recibido de Twilio (Call {call_id}): {user_message}")
         
-        # Guardar mensaje del usuario
-        user_call_message = CallMessage(
-            call_id=call_id,
-            role="user",
-            content=user_message
-        )
-        db.add(user_call_message)
+        turn_messages = {}
         
-        # Obtener contexto de conversación
-        conversation_context_json = call.conversation_context if hasattr(call, 'conversation_context') else None
-        
-        # Procesar con Groq (text-to-text)
-        response_text, context_json, should_end_call = await groq_service.text_to_text(
-            user_message,
-            company.business_logic,
-            conversation_context_json=conversation_context_json
-        )
-        
-        print(f"🤖 Respuesta del asistente: {response_text}")
+        async def generate_response(state):
+            # Guardar mensaje del usuario
+            turn_messages["user"] = CallMessage(
+                call_id=call_id,
+                role="user",
+                content=user_message
+            )
+            call_db.add(turn_messages["user"])
+            
+            # Obtener contexto de conversación
+            conversation_context_json = state.context
+            
+            # Reutilizar la respuesta especulativa si se calculó con un parcial equivalente.
+            # Su espera se mide aparte (llm_prefetch) para que "llm" sea solo la latencia real de Groq
+            with metrics.stage("llm_prefetch"):
+                prefetched = await speculative_responder.take(call_id, user_message, conversation_context_json)
+            if prefetched:
+                response_text, context_json, should_end_call = prefetched
+            else:
+                with metrics.stage("llm"):
+                    # Procesar con Groq (text-to-text)
+                    response_text, context_json, should_end_call = await groq_service.text_to_text(
+                        user_message,
+                        company.business_logic,
+                        conversation_context_json=conversation_context_json
+                    )
+            
+            print(f"🤖 Respuesta del asistente{' (prefetch)' if prefetched else ''}: {response_text}")
+            current_trace().info["prefetched"] = bool(prefetched)
+            
+            # Guardar mensaje del asistente
+            turn_messages["assistant"] = CallMessage(
+                call_id=call_id,
+                role="assistant",
+                content=response_text
+            )
+            call_db.add(turn_messages["assistant"])
+            return (response_text, should_end_call), context_json
         
-        # Guardar mensaje del asistente
-        assistant_message = CallMessage(
-            call_id=call_id,
-            role="assistant",
-            content=response_text
-        )
-        db.add(assistant_message)
+        async def process_turn():
+            # Los turnos de una llamada se procesan de uno en uno sobre el contexto más reciente
+            async with call_turns.lock(call_id):
+                state, (response_text, should_end_call), context_json = await run_versioned_turn(
+                    call_db, active_calls, call_id, generate_response
+                )
+                
+                # Si la conversación debe terminar, finalizar la llamada
+                if should_end_call:
+                    mark_call_ended(call_db, call_id, datetime.utcnow())
+                with metrics.stage("db_commit"):
+                    call_db.flush()
+                    current_trace().attach(call_id, turn_messages["user"].id, turn_messages["assistant"].id)
+                    call_db.commit()
+                active_calls.saved(state, context_json, ended=should_end_call)
+            
+            if should_end_call:
+                speculative_responder.forget(call_id)
+            return response_text, should_end_call, state.version + 1
         
-        # Actualizar contexto de conversación
-        call.conversation_context = context_json
+        # Un reintento de Twilio (mismo <Gather> y mismo texto) reutiliza el turno aunque ya se haya guardado:
+        # la versión de la que partió el turno viaja en la URL y no cambia con el commit
+        start_version = turn if turn is not None else call_state.version
+        fingerprint = (start_version, normalize_transcript(user_message))
+        (response_text, should_end_call, next_version), _ = await call_turns.run(call_id, fingerprint, process_turn)
         
-        # Si la conversación debe terminar, finalizar la llamada
         if should_end_call:
-            from datetime import datetime
-            call.end_time = datetime.utcnow()
-            db.commit()
-            
-            twiml = twilio_service.generate_twiml_for_call(
+            response = await twiml_response(
                 response_text,
                 gather=False
             )
-            return Response(content=twiml, media_type="application/xml")
-        
-        db.commit()
-        
-        # Generar respuesta con Gather para continuar la conversación
-        action_url = f"{os.getenv('BASE_URL', 'http://localhost:8000')}/api/twilio/gather?call_id={call_id}"
-        twiml = twilio_service.generate_twiml_for_call(
-            response_text,
-            gather=True,
-            action_url=action_url
-        )
+        else:
+            # Generar respuesta con Gather para continuar la conversación
+            response = await twiml_response(
+                response_text,
+                gather=True,
+                **gather_urls(call_id, next_version)
+            )
         
-        return Response(content=twiml, media_type="application/xml")
+        # La traza (si este request procesó el turno) se guarda en segundo plano
+        turn_trace_writer.submit(current_trace())
+        return response
     
+    except BudgetExceededError:
+        # La empresa superó su presupuesto durante el turno (route_llm_model en modo throttle)
+        return await twiml_response(
+            PROMPT_SERVICE_UNAVAILABLE,
+            gather=False
+        )
     except Exception as e:
+        metrics.TURN_ERRORS.labels("twilio_gather", metrics.current_company()).inc()
         import traceback
         print(f"❌ Error en twilio_gather_audio: {traceback.format_exc()}")
-        error_twiml = twilio_service.generate_twiml_for_call(
-            "Lo sentimos, ha ocurrido un error procesando tu mensaje. Por favor, intenta de nuevo.",
+        return await twiml_response(
+            PROMPT_PROCESSING_ERROR,
             gather=False
         )
-        return Response(content=error_twiml, media_type="application/xml")
+
+
+@app.post("/api/twilio/partial")
+async def twilio_partial_speech(
+    StableSpeechResult: str = Form(None),
+    call_id: int = Query(...),
+    shards: ShardSessions = Depends(get_shards)
+):
+    """
+    Resultados parciales del reconocimiento de voz de Twilio (partialResultCallback).
+    Con la parte estable de la transcripción se lanza una respuesta especulativa
+    del LLM que /api/twilio/gather reutiliza si el resultado final coincide.
+    """
+    try:
+        # Descartar rápido los parciales que no cambian nada (llegan varias veces por segundo)
+        if not speculative_responder.wants(call_id, StableSpeechResult):
+            return Response(content="OK", media_type="text/plain")
+        
+        call_state = active_calls.load(shards.for_call(call_id), call_id)
+        if not call_state or call_state.ended:
+            return Response(content="OK", media_type="text/plain")
+        
+        company = company_resolver.get(call_state.company_id)
+        metrics.set_company(company)
+        bind_usage(company, call_id)
+        if company and company.business_logic:
+            speculative_responder.start(call_id, StableSpeechResult, company.business_logic, call_state.context)
+        
+        return Response(content="OK", media_type="text/plain")
+    
+    except Exception as e:
+        print(f"❌ Error en twilio_partial_speech: {str(e)}")
+        return Response(content="OK", media_type="text/plain")
 
 
 @app.post("/api/twilio/status")
 async def twilio_call_status(
     CallSid: str = Form(None),
     CallStatus: str = Form(None),
-    CallDuration: str = Form(None),
-    db: Session = Depends(get_db)
+    CallDuration: str = Form(None)
 ):
     """
     Webhook para recibir actualizaciones del estado de la llamada (cuando termina, etc.)
+    Solo encola el evento; un worker en segundo plano lo aplica a la llamada en lotes.
     """
     try:
-        print(f"📊 Estado de llamada Twilio - SID: {CallSid}, Status: {CallStatus}, Duration: {CallDuration}")
-        
-        # Aquí podrías actualizar el estado de la llamada en la BD si tienes un campo para el CallSid
-        # Por ahora solo logueamos
+        if not twilio_status_ingestor.submit(CallSid, CallStatus, CallDuration):
+            # Cola llena: responder con error para que Twilio reintente
+            return Response(content="Busy", media_type="text/plain", status_code=503)
         
         return Response(content="OK", media_type="text/plain")
     
@@ -780,6 +1451,7 @@ async def twilio_call_status(
 
 
 if __name__ == "__main__":
+    # Desarrollo: un solo proceso. En producción usa serve.py (varios workers)
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
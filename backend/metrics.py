@@ -0,0 +1,145 @@
+"""
+Métricas de Prometheus del pipeline de voz (GET /metrics)
+
+- voice_stage_seconds: duración de cada etapa de un turno (resolución de empresa,
+  lectura del audio, STT, LLM, TTS, commit en la base de datos, TwiML)
+- voice_upstream_errors_total / voice_upstream_retries_total: fallos y reintentos de Groq
+- voice_turn_errors_total / voice_turn_conflicts_total: turnos fallidos y repetidos por
+  conflicto de versión del contexto
+- voice_turns_in_flight / voice_turns_queued: turnos en curso y esperando el lock de su llamada
+- twilio_status_queue_depth: eventos de estado de Twilio pendientes
+- event_loop_lag_seconds / event_loop_blocks_total: retraso del event loop y bloqueos
+  detectados por ruta (solo con LOOP_WATCHDOG activo, ver loop_watchdog.py)
+
+Casi todas llevan la etiqueta company (identifier de la empresa). El endpoint la fija una
+vez por petición con set_company(); se propaga sola a tareas e hilos (contextvars).
+Si la petición tiene una traza de turno abierta (turn_traces), stage() también la anota ahí.
+
+Con varios workers (serve.py) cada proceso escribe sus valores en
+PROMETHEUS_MULTIPROC_DIR y /metrics devuelve la suma de todos.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, List
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+from turn_traces import current_trace
+
+UNKNOWN_COMPANY = "unknown"
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram(
+    "voice_stage_seconds", "Duración de cada etapa de un turno de voz",
+    ["stage", "company"], buckets=STAGE_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    "voice_upstream_errors_total", "Peticiones a servicios externos que fallaron tras los reintentos",
+    ["service", "operation", "company"],
+)
+UPSTREAM_RETRIES = Counter(
+    "voice_upstream_retries_total", "Reintentos de peticiones a servicios externos",
+    ["service", "operation", "company"],
+)
+TURN_ERRORS = Counter(
+    "voice_turn_errors_total", "Turnos que terminaron con error", ["endpoint", "company"],
+)
+TURN_CONFLICTS = Counter(
+    "voice_turn_conflicts_total", "Turnos repetidos porque otro proceso cambió el contexto", ["company"],
+)
+TURNS_IN_FLIGHT = Gauge(
+    "voice_turns_in_flight", "Turnos de conversación en curso", ["company"], multiprocess_mode="livesum",
+)
+TURNS_QUEUED = Gauge(
+    "voice_turns_queued", "Turnos esperando a que termine el anterior de su llamada", ["company"],
+    multiprocess_mode="livesum",
+)
+STATUS_QUEUE_DEPTH = Gauge(
+    "twilio_status_queue_depth", "Eventos de estado de Twilio pendientes de aplicar", multiprocess_mode="livesum",
+)
+
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "Retraso del event loop respecto al latido esperado", buckets=LOOP_LAG_BUCKETS,
+)
+EVENT_LOOP_BLOCKS = Counter(
+    "event_loop_blocks_total", "Veces que un callback bloqueó el event loop más del umbral", ["route"],
+)
+EVENT_LOOP_BLOCKED_SECONDS = Counter(
+    "event_loop_blocked_seconds_total", "Tiempo total con el event loop bloqueado", ["route"],
+)
+
+_company: ContextVar[str] = ContextVar("metrics_company", default=UNKNOWN_COMPANY)
+
+
+_company_listeners: List[Callable[[str], None]] = []
+
+
+def on_company(listener: Callable[[str], None]) -> None:
+    """Registra una función que se llama (en la tarea de la petición) al identificar su empresa"""
+    if listener not in _company_listeners:
+        _company_listeners.append(listener)
+
+
+def set_company(company) -> None:
+    """Etiqueta con esta empresa las métricas del resto de la petición"""
+    if company is not None:
+        _company.set(company.identifier or str(company.id))
+        for listener in _company_listeners:
+            listener(_company.get())
+
+
+def current_company() -> str:
+    return _company.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Mide la duración del bloque como la etapa name de la empresa actual"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        STAGE_SECONDS.labels(name, _company.get()).observe(end - start)
+        trace = current_trace()
+        if trace is not None:
+            trace.add_stage(name, start, end)
+
+
+@contextmanager
+def tracked(gauge: Gauge):
+    """Suma 1 al gauge de la empresa actual mientras dura el bloque"""
+    child = gauge.labels(_company.get())
+    child.inc()
+    try:
+        yield
+    finally:
+        child.dec()
+
+
+def multiprocess_enabled() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def render_latest() -> tuple[bytes, str]:
+    """Cuerpo y Content-Type de /metrics"""
+    if multiprocess_enabled():
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_worker_stopped(pid: int) -> None:
+    """Descarta los gauges de un worker que se apaga (modo multiproceso)"""
+    if multiprocess_enabled():
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
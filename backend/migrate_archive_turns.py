@@ -0,0 +1,47 @@
+"""
+Script para migrar la base de datos y agregar la columna assistant_turns a la
+tabla call_archives (turnos de las llamadas archivadas para reconstruir los rollups)
+
+Los archivos existentes se completan descomprimiendo su blob.
+"""
+from sqlalchemy import text
+from sharding import shard_router
+from backfill_call_rollups import fill_archive_turns
+
+def migrate_archives_table(engine, session_factory):
+    """Agregar assistant_turns a call_archives y contarlos en los archivos existentes"""
+    with engine.connect() as conn:
+        try:
+            result = conn.execute(text("PRAGMA table_info(call_archives)"))
+            columns = [row[1] for row in result]
+            
+            if "assistant_turns" not in columns:
+                print("Agregando columna 'assistant_turns'...")
+                conn.execute(text("ALTER TABLE call_archives ADD COLUMN assistant_turns INTEGER"))
+                conn.commit()
+                print("✓ Columna 'assistant_turns' agregada")
+            else:
+                print("Columna 'assistant_turns' ya existe")
+            
+        except Exception as e:
+            print(f"Error durante la migración: {e}")
+            conn.rollback()
+            raise
+    
+    db = session_factory()
+    try:
+        fill_archive_turns(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    print("Iniciando migración de base de datos...")
+    for shard, (shard_engine, session_factory) in enumerate(zip(shard_router.engines, shard_router.sessionmakers)):
+        print(f"\nShard {shard}:")
+        migrate_archives_table(shard_engine, session_factory)
+    print("\n✓ Migración completada exitosamente")
+    print("\nBase de datos actualizada correctamente.")
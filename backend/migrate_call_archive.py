@@ -0,0 +1,36 @@
+"""
+Script para migrar la base de datos y agregar las columnas de archivado (retention_days y archived_at)
+"""
+from sqlalchemy import text
+from database import engine
+
+def migrate_archive_columns():
+    """Agregar companies.retention_days y calls.archived_at"""
+    with engine.connect() as conn:
+        try:
+            for table, column, column_type in [
+                ("companies", "retention_days", "INTEGER"),
+                ("calls", "archived_at", "DATETIME"),
+            ]:
+                result = conn.execute(text(f"PRAGMA table_info({table})"))
+                columns = [row[1] for row in result]
+                
+                if column not in columns:
+                    print(f"Agregando columna '{table}.{column}'...")
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+                    conn.commit()
+                    print(f"✓ Columna '{table}.{column}' agregada")
+                else:
+                    print(f"Columna '{table}.{column}' ya existe")
+            
+            print("\n✓ Migración completada exitosamente")
+            
+        except Exception as e:
+            print(f"Error durante la migración: {e}")
+            conn.rollback()
+            raise
+
+if __name__ == "__main__":
+    print("Iniciando migración de base de datos...")
+    migrate_archive_columns()
+    print("\nBase de datos actualizada correctamente.")
@@ -0,0 +1,34 @@
+"""
+Script para migrar la base de datos y agregar la columna context_version a la
+tabla calls (control de concurrencia de los turnos de conversación)
+"""
+from sqlalchemy import text
+from sharding import shard_router
+
+def migrate_calls_table(engine):
+    """Agregar context_version a la tabla calls (las llamadas existentes empiezan en 0)"""
+    with engine.connect() as conn:
+        try:
+            result = conn.execute(text("PRAGMA table_info(calls)"))
+            columns = [row[1] for row in result]
+            
+            if "context_version" not in columns:
+                print("Agregando columna 'context_version'...")
+                conn.execute(text("ALTER TABLE calls ADD COLUMN context_version INTEGER NOT NULL DEFAULT 0"))
+                conn.commit()
+                print("✓ Columna 'context_version' agregada")
+            else:
+                print("Columna 'context_version' ya existe")
+            
+        except Exception as e:
+            print(f"Error durante la migración: {e}")
+            conn.rollback()
+            raise
+
+if __name__ == "__main__":
+    print("Iniciando migración de base de datos...")
+    for shard, shard_engine in enumerate(shard_router.engines):
+        print(f"\nShard {shard}:")
+        migrate_calls_table(shard_engine)
+    print("\n✓ Migración completada exitosamente")
+    print("\nBase de datos actualizada correctamente.")
@@ -0,0 +1,44 @@
+"""
+Script para migrar la base de datos y agregar los campos de Twilio a la tabla calls
+(twilio_call_sid, twilio_status, twilio_duration). La tabla company_phone_numbers
+se crea automáticamente al iniciar el servidor.
+"""
+from sqlalchemy import text
+from sharding import shard_router
+
+def migrate_calls_table(engine):
+    """Agregar las columnas de Twilio a la tabla calls (twilio_call_sid con índice)"""
+    with engine.connect() as conn:
+        try:
+            result = conn.execute(text("PRAGMA table_info(calls)"))
+            columns = [row[1] for row in result]
+            
+            for column, column_type in [
+                ("twilio_call_sid", "TEXT"),
+                ("twilio_status", "TEXT"),
+                ("twilio_duration", "INTEGER"),
+            ]:
+                if column not in columns:
+                    print(f"Agregando columna '{column}'...")
+                    conn.execute(text(f"ALTER TABLE calls ADD COLUMN {column} {column_type}"))
+                    conn.commit()
+                    print(f"✓ Columna '{column}' agregada")
+                else:
+                    print(f"Columna '{column}' ya existe")
+            
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_calls_twilio_call_sid ON calls(twilio_call_sid)"))
+            conn.commit()
+            print("✓ Índice para 'twilio_call_sid' creado")
+            
+        except Exception as e:
+            print(f"Error durante la migración: {e}")
+            conn.rollback()
+            raise
+
+if __name__ == "__main__":
+    print("Iniciando migración de base de datos...")
+    for shard, shard_engine in enumerate(shard_router.engines):
+        print(f"\nShard {shard}:")
+        migrate_calls_table(shard_engine)
+    print("\n✓ Migración completada exitosamente")
+    print("\nBase de datos actualizada correctamente.")
@@ -0,0 +1,39 @@
+"""
+Script para migrar la base de datos y agregar los presupuestos de uso de Groq
+(daily_budget_usd y budget_action) a la tabla companies
+
+Las tablas call_usage y company_usage_rollups se crean solas al arrancar el servidor.
+"""
+from sqlalchemy import text
+from database import engine
+
+def migrate_budget_columns():
+    """Agregar companies.daily_budget_usd y companies.budget_action"""
+    with engine.connect() as conn:
+        try:
+            result = conn.execute(text("PRAGMA table_info(companies)"))
+            columns = [row[1] for row in result]
+            
+            for column, column_type in [
+                ("daily_budget_usd", "FLOAT"),
+                ("budget_action", "VARCHAR"),
+            ]:
+                if column not in columns:
+                    print(f"Agregando columna 'companies.{column}'...")
+                    conn.execute(text(f"ALTER TABLE companies ADD COLUMN {column} {column_type}"))
+                    conn.commit()
+                    print(f"✓ Columna 'companies.{column}' agregada")
+                else:
+                    print(f"Columna 'companies.{column}' ya existe")
+            
+            print("\n✓ Migración completada exitosamente")
+            
+        except Exception as e:
+            print(f"Error durante la migración: {e}")
+            conn.rollback()
+            raise
+
+if __name__ == "__main__":
+    print("Iniciando migración de base de datos...")
+    migrate_budget_columns()
+    print("\nBase de datos actualizada correctamente.")
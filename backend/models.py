@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Enum, Float, UniqueConstraint, LargeBinary
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import enum
@@ -32,11 +32,26 @@ class Company(Base):
     identifier = Column(String, unique=True, index=True)  # Identificador único para llamadas públicas
     description = Column(Text, nullable=True)
     business_logic = Column(Text, nullable=True)  # Lógica de negocio, personalidad, catálogo, ofertas
+    retention_days = Column(Integer, nullable=True)  # Días antes de archivar llamadas finalizadas (None = nunca)
+    daily_budget_usd = Column(Float, nullable=True)  # Gasto diario máximo en Groq (None = sin límite)
+    budget_action = Column(String, nullable=True)  # Al superarlo: downgrade (modelo más barato) o throttle (rechazar turnos)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     users = relationship("User", back_populates="company")
     documents = relationship("Document", back_populates="company")
     calls = relationship("Call", back_populates="company")
+    phone_numbers = relationship("CompanyPhoneNumber", back_populates="company", cascade="all, delete-orphan")
+
+class CompanyPhoneNumber(Base):
+    """Números de Twilio (E.164) que enrutan llamadas entrantes a una empresa"""
+    __tablename__ = "company_phone_numbers"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer, ForeignKey("companies.id"), index=True)
+    phone_number = Column(String, unique=True, index=True)  # Formato E.164, ej: +5215512345678
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    company = relationship("Company", back_populates="phone_numbers")
 
 class Document(Base):
     __tablename__ = "documents"
@@ -51,6 +66,8 @@ class Document(Base):
 
 class Call(Base):
     __tablename__ = "calls"
+    # AUTOINCREMENT permite fijar el rango de IDs de cada shard en sqlite_sequence
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
     company_id = Column(Integer, ForeignKey("companies.id"))
@@ -59,6 +76,11 @@ class Call(Base):
     end_time = Column(DateTime, nullable=True)
     rating = Column(Integer, nullable=True)  # 1-5
     conversation_context = Column(Text, nullable=True)  # JSON con el contexto de conversación para GPT OSS 120B
+    context_version = Column(Integer, nullable=False, default=0, server_default="0")  # Se incrementa en cada turno (concurrencia optimista)
+    archived_at = Column(DateTime, nullable=True)  # Si tiene valor, los mensajes y el contexto están en call_archives
+    twilio_call_sid = Column(String, nullable=True, index=True)  # CallSid de Twilio para los webhooks posteriores
+    twilio_status = Column(String, nullable=True)  # Último estado recibido en /api/twilio/status
+    twilio_duration = Column(Integer, nullable=True)  # Duración reportada por Twilio (segundos)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     company = relationship("Company", back_populates="calls")
@@ -76,3 +98,123 @@ class CallMessage(Base):
     
     call = relationship("Call", back_populates="messages")
 
+
+class CallRollup(Base):
+    """Agregados de llamadas por empresa y por hora/día, actualizados al finalizar cada llamada"""
+    __tablename__ = "call_rollups"
+    __table_args__ = (
+        UniqueConstraint("company_id", "granularity", "bucket_start", name="uq_call_rollups_bucket"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer, ForeignKey("companies.id"), index=True)
+    granularity = Column(String)  # hour, day
+    bucket_start = Column(DateTime, index=True)
+    call_count = Column(Integer, default=0)
+    rated_count = Column(Integer, default=0)
+    rating_sum = Column(Integer, default=0)
+    duration_sum = Column(Float, default=0.0)  # Segundos
+    turn_sum = Column(Integer, default=0)
+
+class CallArchive(Base):
+    """Mensajes y contexto de una llamada archivada, comprimidos en un solo blob"""
+    __tablename__ = "call_archives"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    call_id = Column(Integer, ForeignKey("calls.id"), unique=True, index=True)
+    company_id = Column(Integer, ForeignKey("companies.id"), index=True)
+    codec = Column(String)  # zstd, gzip
+    payload = Column(LargeBinary)
+    message_count = Column(Integer)
+    assistant_turns = Column(Integer, nullable=True)  # Turnos del asistente (rollups de analítica)
+    raw_size = Column(Integer)
+    compressed_size = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class CallTurnTrace(Base):
+    """Tiempos de un turno (etapas, modelo, tokens e IDs de Groq) ligados a su par de mensajes"""
+    __tablename__ = "call_turn_traces"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    call_id = Column(Integer, ForeignKey("calls.id"), index=True)
+    request_message_id = Column(Integer, nullable=True)  # Mensaje del cliente/usuario
+    response_message_id = Column(Integer, index=True)  # Mensaje del asistente
+    trace = Column(Text)  # JSON compacto
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class _UsageCounters:
+    """Contadores de uso de Groq compartidos por los rollups de uso"""
+    requests = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    audio_seconds = Column(Float, default=0.0)  # Audio transcrito (STT)
+    tts_characters = Column(Integer, default=0)
+    cost_usd = Column(Float, default=0.0)
+
+class CallUsage(_UsageCounters, Base):
+    """Uso de Groq de una llamada por modelo (vive en el shard de la llamada)"""
+    __tablename__ = "call_usage"
+    __table_args__ = (
+        UniqueConstraint("call_id", "model", name="uq_call_usage_model"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    call_id = Column(Integer, ForeignKey("calls.id"), index=True)
+    company_id = Column(Integer, ForeignKey("companies.id"), index=True)
+    model = Column(String)
+
+class CompanyUsageRollup(_UsageCounters, Base):
+    """Uso de Groq por empresa, día y modelo (base global: se consulta para los presupuestos)"""
+    __tablename__ = "company_usage_rollups"
+    __table_args__ = (
+        UniqueConstraint("company_id", "day", "model", name="uq_company_usage_day_model"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer, ForeignKey("companies.id"), index=True)
+    day = Column(DateTime, index=True)
+    model = Column(String)
+
+class ShardMap(Base):
+    """Asignación de cada empresa a un shard de llamadas (solo en la base de datos global)"""
+    __tablename__ = "shard_map"
+    
+    company_id = Column(Integer, ForeignKey("companies.id"), primary_key=True)
+    shard = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ProfileCapture(Base):
+    """Petición de perfilado de las próximas N peticiones que cumplan un filtro (super_admin)"""
+    __tablename__ = "profile_captures"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    route = Column(String, nullable=True)  # Plantilla (/api/calls/{call_id}) o prefijo de la ruta
+    company = Column(String, nullable=True)  # identifier de la empresa (o su ID si no tiene)
+    requested = Column(Integer, nullable=False)
+    remaining = Column(Integer, nullable=False)
+    created_by = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
+
+class RequestProfile(Base):
+    """Perfil de muestreo de una petición en formato de pilas colapsadas (flame graph)"""
+    __tablename__ = "request_profiles"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    capture_id = Column(Integer, ForeignKey("profile_captures.id"), index=True)
+    method = Column(String)
+    route = Column(String)
+    path = Column(String)
+    company = Column(String)
+    status_code = Column(Integer)
+    duration_ms = Column(Float)
+    samples = Column(Integer)
+    collapsed = Column(Text)  # "marco;marco;marco muestras" por línea
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class CacheVersion(Base):
+    """Contador de versión por cache en memoria, para invalidar entre workers"""
+    __tablename__ = "cache_versions"
+    
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
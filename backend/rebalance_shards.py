@@ -0,0 +1,185 @@
+"""
+Script para mover una empresa (sus llamadas, mensajes, archivos y rollups) a otro shard
+
+Uso:
+    python rebalance_shards.py <company_id> <shard_destino> [--force] [--no-wait]
+
+Pasos:
+1. Se actualiza shard_map: las llamadas nuevas de la empresa se crean en el shard destino.
+2. Se espera SHARD_MAP_TTL_SECONDS para que todos los workers recarguen el mapa.
+3. Se copian las llamadas del shard origen al destino y se borran del origen.
+4. Las llamadas activas (sin end_time) siguen en el shard origen: se espera a que terminen
+   (hasta ACTIVE_CALL_WAIT_SECONDS) y se mueven en cuanto lo hacen.
+
+Las llamadas movidas reciben un ID nuevo dentro del rango del shard destino
+(sus mensajes también; las trazas de turnos se ligan a los IDs nuevos).
+La contribución de cada llamada a los rollups se resta del origen y se suma al destino
+en las mismas transacciones que la copian y la borran.
+Con --force las llamadas activas se mueven sin esperar; con --no-wait no se espera ni a
+los workers ni a las llamadas activas (vuelve a ejecutar el script cuando terminen).
+"""
+import sys
+import time
+from database import SessionLocal, engine, Base
+from models import Call, CallArchive, CallMessage, CallRollup, CallTurnTrace, CallUsage, Company
+from analytics_service import move_call_rollups
+from archive_service import count_assistant_turns
+from sharding import shard_router, SHARD_MAP_TTL_SECONDS
+
+ACTIVE_CALL_WAIT_SECONDS = 30 * 60
+ACTIVE_CALL_POLL_SECONDS = 10
+
+def _move_call(source_db, target_db, call):
+    """Copia una llamada con sus mensajes y su archivo al shard destino y devuelve el nuevo ID"""
+    new_call = Call(
+        company_id=call.company_id,
+        client_id=call.client_id,
+        start_time=call.start_time,
+        end_time=call.end_time,
+        rating=call.rating,
+        conversation_context=call.conversation_context,
+        archived_at=call.archived_at,
+        twilio_call_sid=call.twilio_call_sid,
+        twilio_status=call.twilio_status,
+        twilio_duration=call.twilio_duration,
+        created_at=call.created_at
+    )
+    target_db.add(new_call)
+    target_db.flush()
+    
+    messages = source_db.query(CallMessage).filter(CallMessage.call_id == call.id).order_by(CallMessage.id).all()
+    new_messages = [
+        CallMessage(call_id=new_call.id, role=msg.role, content=msg.content, timestamp=msg.timestamp)
+        for msg in messages
+    ]
+    target_db.add_all(new_messages)
+    target_db.flush()
+    message_ids = {msg.id: new_msg.id for msg, new_msg in zip(messages, new_messages)}
+    
+    traces = source_db.query(CallTurnTrace).filter(CallTurnTrace.call_id == call.id).all()
+    for trace in traces:
+        target_db.add(CallTurnTrace(
+            call_id=new_call.id,
+            request_message_id=message_ids.get(trace.request_message_id),
+            response_message_id=message_ids.get(trace.response_message_id),
+            trace=trace.trace,
+            created_at=trace.created_at
+        ))
+    
+    for usage in source_db.query(CallUsage).filter(CallUsage.call_id == call.id).all():
+        target_db.add(CallUsage(
+            call_id=new_call.id,
+            company_id=usage.company_id,
+            model=usage.model,
+            requests=usage.requests,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            audio_seconds=usage.audio_seconds,
+            tts_characters=usage.tts_characters,
+            cost_usd=usage.cost_usd
+        ))
+    
+    archive = source_db.query(CallArchive).filter(CallArchive.call_id == call.id).first()
+    turns = sum(1 for msg in messages if msg.role == "assistant")
+    if archive:
+        turns += archive.assistant_turns if archive.assistant_turns is not None else count_assistant_turns(archive)
+        target_db.add(CallArchive(
+            call_id=new_call.id,
+            company_id=archive.company_id,
+            codec=archive.codec,
+            payload=archive.payload,
+            message_count=archive.message_count,
+            assistant_turns=archive.assistant_turns,
+            raw_size=archive.raw_size,
+            compressed_size=archive.compressed_size,
+            created_at=archive.created_at
+        ))
+    move_call_rollups(source_db, target_db, call, turns)
+    target_db.commit()
+    
+    # Solo se borra del origen cuando la copia ya está confirmada en el destino
+    source_db.query(CallMessage).filter(CallMessage.call_id == call.id).delete(synchronize_session=False)
+    source_db.query(CallTurnTrace).filter(CallTurnTrace.call_id == call.id).delete(synchronize_session=False)
+    source_db.query(CallUsage).filter(CallUsage.call_id == call.id).delete(synchronize_session=False)
+    source_db.query(CallArchive).filter(CallArchive.call_id == call.id).delete(synchronize_session=False)
+    source_db.delete(call)
+    source_db.commit()
+    return new_call.id
+
+def rebalance_company(company_id: int, target_shard: int, force: bool = False, wait: bool = True):
+    if not 0 <= target_shard < shard_router.shard_count:
+        raise Exception(f"Shard inválido: hay {shard_router.shard_count} shards (0-{shard_router.shard_count - 1})")
+    
+    Base.metadata.create_all(bind=engine)
+    shard_router.init_schemas()
+    db = SessionLocal()
+    try:
+        company = db.query(Company).filter(Company.id == company_id).first()
+        if not company:
+            raise Exception(f"Empresa {company_id} no encontrada")
+        
+        source_shard = shard_router.shard_for_company(company_id)
+        if source_shard != target_shard:
+            shard_router.set_company_shard(db, company_id, target_shard)
+            print(f"✓ Empresa '{company.name}' asignada al shard {target_shard} (antes {source_shard})")
+            if wait:
+                print(f"Esperando {SHARD_MAP_TTL_SECONDS:.0f}s para que los workers recarguen el mapa...")
+                time.sleep(SHARD_MAP_TTL_SECONDS)
+    finally:
+        db.close()
+    
+    # Mover lo que quede de la empresa en cualquier otro shard; las llamadas activas
+    # se mueven en cuanto terminan para que no se queden en el shard antiguo
+    deadline = time.monotonic() + (ACTIVE_CALL_WAIT_SECONDS if wait else 0)
+    while True:
+        active = _move_company_calls(company_id, target_shard, force)
+        if not active or time.monotonic() >= deadline:
+            break
+        print(f"Esperando a que terminen {active} llamadas activas...")
+        time.sleep(ACTIVE_CALL_POLL_SECONDS)
+    if active:
+        print(f"⚠️  {active} llamadas activas no se movieron (usa --force o vuelve a ejecutar cuando terminen)")
+
+def _move_company_calls(company_id: int, target_shard: int, force: bool) -> int:
+    """Mueve las llamadas de la empresa que están fuera del shard destino; devuelve cuántas siguen activas"""
+    active = 0
+    target_db = shard_router.sessionmakers[target_shard]()
+    try:
+        for shard, session_factory in enumerate(shard_router.sessionmakers):
+            if shard == target_shard:
+                continue
+            source_db = session_factory()
+            try:
+                calls = source_db.query(Call).filter(Call.company_id == company_id).order_by(Call.id).all()
+                moved = 0
+                for call in calls:
+                    if call.end_time is None and not force:
+                        active += 1
+                        continue
+                    new_id = _move_call(source_db, target_db, call)
+                    moved += 1
+                    print(f"  Llamada {call.id} -> {new_id}")
+                
+                # Buckets que se quedaron a cero al restar las llamadas movidas
+                source_db.query(CallRollup).filter(
+                    CallRollup.company_id == company_id,
+                    CallRollup.call_count <= 0
+                ).delete(synchronize_session=False)
+                source_db.commit()
+                
+                if moved:
+                    print(f"✓ Shard {shard}: {moved} llamadas movidas")
+            finally:
+                source_db.close()
+    finally:
+        target_db.close()
+    return active
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 2:
+        print(__doc__)
+        sys.exit(1)
+    print("Rebalanceando shards...")
+    rebalance_company(int(args[0]), int(args[1]), force="--force" in sys.argv, wait="--no-wait" not in sys.argv)
+    print("\nProceso completado.")
@@ -0,0 +1,408 @@
+"""
+Perfilado de peticiones bajo demanda (super_admin)
+
+Un super_admin pide perfilar las próximas N peticiones que cumplan un filtro de ruta
+y/o empresa (tabla profile_captures). Cada worker relee las capturas activas cada
+PROFILE_CHECK_SECONDS; sin capturas activas el intervalo se duplica hasta
+PROFILE_IDLE_CHECK_SECONDS y el middleware no hace nada más.
+
+Mientras una petición que cumple el filtro está en curso, un hilo muestrea cada
+PROFILE_SAMPLE_INTERVAL_MS dónde está:
+
+- [cpu]: ejecutándose en el event loop (pila real del hilo del loop)
+- [hilo]: esperando a una función en asyncio.to_thread (pila del hilo que la ejecuta)
+- [espera]: esperando otra cosa (pila de corrutinas hasta el await)
+
+Si todas las capturas de la ruta filtran por empresa, no se muestrea hasta que el
+endpoint identifica la empresa (metrics.set_company) y solo si cumple alguna. Al
+terminar la petición se descuenta de la captura y se guarda el perfil como pilas colapsadas
+("marco;marco;marco muestras" por línea), el formato de flamegraph.pl y speedscope.
+
+Límites de sobrecarga: como mucho PROFILE_MAX_CONCURRENT peticiones perfiladas a la
+vez por worker, PROFILE_MAX_SECONDS por petición, PROFILE_MAX_STACKS pilas distintas
+por perfil, y el muestreador alarga su intervalo para no pasar de PROFILE_MAX_OVERHEAD
+del tiempo. Se conservan los últimos PROFILE_RETENTION_COUNT perfiles, durante como
+mucho PROFILE_RETENTION_HOURS.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from starlette.routing import Match
+
+from database import SessionLocal
+from metrics import current_company, on_company
+from models import ProfileCapture, RequestProfile
+from settings import settings
+
+PROFILE_MAX_REQUESTS = settings.profile_max_requests
+PROFILE_SAMPLE_INTERVAL_MS = settings.profile_sample_interval_ms
+PROFILE_MAX_OVERHEAD = settings.profile_max_overhead
+PROFILE_MAX_CONCURRENT = settings.profile_max_concurrent
+PROFILE_MAX_SECONDS = settings.profile_max_seconds
+PROFILE_MAX_STACKS = settings.profile_max_stacks
+PROFILE_RETENTION_COUNT = settings.profile_retention_count
+PROFILE_RETENTION_HOURS = settings.profile_retention_hours
+PROFILE_CAPTURE_TTL_MINUTES = settings.profile_capture_ttl_minutes
+PROFILE_CHECK_SECONDS = settings.profile_check_seconds
+PROFILE_IDLE_CHECK_SECONDS = settings.profile_idle_check_seconds
+
+OTHER_STACKS = "[otras pilas]"
+
+
+@dataclass(frozen=True)
+class _ActiveCapture:
+    id: int
+    route: Optional[str]
+    company: Optional[str]
+
+    def matches_route(self, route_path: str, path: str) -> bool:
+        return self.route is None or self.route == route_path or path.startswith(self.route)
+
+    def matches_company(self, company: str) -> bool:
+        return self.company is None or self.company == company
+
+
+class _RequestProfile:
+    def __init__(self, captures: List[_ActiveCapture], method: str, route: str, path: str):
+        self.captures = captures
+        self.method = method
+        self.route = route
+        self.path = path
+        self.started = time.perf_counter()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.status_code: Optional[int] = None
+
+    def add(self, frames: List[str]):
+        stack = ";".join(frames)
+        if stack not in self.stacks and len(self.stacks) >= PROFILE_MAX_STACKS:
+            stack = OTHER_STACKS
+        self.stacks[stack] += 1
+        self.samples += 1
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+# ---------- Pilas ----------
+
+def _label(frame) -> str:
+    code = frame.f_code
+    folder, filename = os.path.split(code.co_filename)
+    return f"{code.co_name} ({os.path.basename(folder)}/{filename}:{frame.f_lineno})".replace(";", ",")
+
+
+def _is_frame(frame, filename: str, name: str) -> bool:
+    return frame.f_code.co_name == name and frame.f_code.co_filename.endswith(filename)
+
+
+def _thread_frames(frame, stop) -> List:
+    """Frames de la pila de un hilo, de la raíz a la hoja, a partir del primero tras stop"""
+    frames = []
+    while frame is not None and not stop(frame):
+        frames.append(frame)
+        frame = frame.f_back
+    return frames[::-1] if frame is not None else []
+
+
+def _coroutine_frames(task: asyncio.Task) -> List:
+    """Frames de las corrutinas de una tarea suspendida, hasta el await en el que espera"""
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+
+def _worker_stacks(current_frames: dict, loop_thread_id: int) -> Dict[int, List]:
+    """Pila de cada hilo del executor por id de la función que ejecuta (la de asyncio.to_thread)"""
+    stacks = {}
+    for thread_id, frame in current_frames.items():
+        if thread_id == loop_thread_id:
+            continue
+        run_frame = frame
+        while run_frame is not None and not _is_frame(run_frame, os.path.join("concurrent", "futures", "thread.py"), "run"):
+            run_frame = run_frame.f_back
+        if run_frame is None:
+            continue
+        work_item = run_frame.f_locals.get("self")
+        if work_item is not None:
+            stacks[id(work_item.fn)] = _thread_frames(frame, lambda f, stop=run_frame: f is stop)
+    return stacks
+
+
+class RequestProfiler:
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self.captures: List[_ActiveCapture] = []
+        self._active: Dict[asyncio.Task, _RequestProfile] = {}
+        self._waiting: Dict[asyncio.Task, _RequestProfile] = {}  # Esperando a conocer la empresa
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._pending_saves = set()
+        self.stats = {"profiled": 0, "saved": 0, "skipped_busy": 0, "samples": 0, "sampler_seconds": 0.0}
+
+    # ---------- Ciclo de vida ----------
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopping.clear()
+        on_company(self.company_resolved)
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+        self._thread = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._refresh_task is None:
+            return
+        self._refresh_task.cancel()
+        try:
+            await self._refresh_task
+        except asyncio.CancelledError:
+            pass
+        self._refresh_task = None
+        self._stopping.set()
+        self._wake.set()
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+        if self._pending_saves:
+            await asyncio.gather(*self._pending_saves, return_exceptions=True)
+
+    async def _refresh_loop(self):
+        interval = PROFILE_CHECK_SECONDS
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f"❌ Error leyendo las capturas de perfilado: {e}")
+            # Sin capturas activas se consulta cada vez menos (las creadas en este worker se activan al momento)
+            interval = PROFILE_CHECK_SECONDS if self.captures else min(interval * 2, PROFILE_IDLE_CHECK_SECONDS)
+            await asyncio.sleep(interval)
+
+    def refresh(self):
+        """Relee las capturas que aún tienen peticiones pendientes"""
+        db = self.session_factory()
+        try:
+            rows = (
+                db.query(ProfileCapture)
+                .filter(ProfileCapture.remaining > 0, ProfileCapture.expires_at > datetime.utcnow())
+                .all()
+            )
+            self.captures = [_ActiveCapture(row.id, row.route, row.company) for row in rows]
+        finally:
+            db.close()
+
+    def add_capture(self, capture: ProfileCapture):
+        """Activa en este worker una captura recién creada (los demás la verán al releer)"""
+        self.captures = self.captures + [_ActiveCapture(capture.id, capture.route, capture.company)]
+
+    def remove_capture(self, capture_id: int):
+        self.captures = [capture for capture in self.captures if capture.id != capture_id]
+
+    # ---------- Peticiones ----------
+
+    def begin(self, task: asyncio.Task, method: str, route: str, path: str) -> Optional[_RequestProfile]:
+        captures = [capture for capture in self.captures if capture.matches_route(route, path)]
+        if not captures:
+            return None
+        profile = _RequestProfile(captures, method, route, path)
+        if all(capture.company is not None for capture in captures):
+            # Se empieza a muestrear en company_resolved, si la empresa cumple el filtro
+            self._waiting[task] = profile
+            return profile
+        if len(self._active) >= PROFILE_MAX_CONCURRENT:
+            self.stats["skipped_busy"] += 1
+            return None
+        self._active[task] = profile
+        self._wake.set()
+        return profile
+
+    def company_resolved(self, company: str):
+        """Empieza a muestrear la petición en curso si esperaba su empresa y esta cumple alguna captura"""
+        if not self._waiting or threading.get_ident() != self._loop_thread_id:
+            return
+        task = asyncio.current_task()
+        profile = self._waiting.pop(task, None)
+        if profile is None:
+            return
+        profile.captures = [capture for capture in profile.captures if capture.matches_company(company)]
+        if not profile.captures:
+            return
+        if len(self._active) >= PROFILE_MAX_CONCURRENT:
+            self.stats["skipped_busy"] += 1
+            profile.captures = []
+            return
+        self._active[task] = profile
+        self._wake.set()
+
+    def finish(self, task: asyncio.Task, profile: _RequestProfile):
+        """Deja de muestrear y guarda el perfil en segundo plano si la empresa cumple el filtro"""
+        self._active.pop(task, None)
+        self._waiting.pop(task, None)
+        duration_ms = round((time.perf_counter() - profile.started) * 1000, 1)
+        company = current_company()
+        captures = [capture for capture in profile.captures if capture.matches_company(company)]
+        if not captures or not profile.samples:
+            return
+        self.stats["profiled"] += 1
+        save = asyncio.create_task(asyncio.to_thread(self.save, captures, profile, company, duration_ms))
+        self._pending_saves.add(save)
+        save.add_done_callback(self._saved)
+
+    def _saved(self, task: asyncio.Task):
+        self._pending_saves.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"❌ Error guardando un perfil de petición: {task.exception()}")
+
+    def save(self, captures: List[_ActiveCapture], profile: _RequestProfile, company: str, duration_ms: float):
+        """Descuenta la petición de la primera captura con cupo y guarda el perfil"""
+        db = self.session_factory()
+        try:
+            for capture in captures:
+                claimed = (
+                    db.query(ProfileCapture)
+                    .filter(ProfileCapture.id == capture.id, ProfileCapture.remaining > 0)
+                    .update({ProfileCapture.remaining: ProfileCapture.remaining - 1}, synchronize_session=False)
+                )
+                if claimed:
+                    break
+            else:
+                return  # Otros workers completaron ya las capturas
+            db.add(RequestProfile(
+                capture_id=capture.id, method=profile.method, route=profile.route, path=profile.path,
+                company=company, status_code=profile.status_code, duration_ms=duration_ms,
+                samples=profile.samples, collapsed=profile.collapsed(),
+            ))
+            prune_profiles(db)
+            db.commit()
+            self.stats["saved"] += 1
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    # ---------- Muestreo (hilo aparte) ----------
+
+    def _sample_loop(self):
+        interval = PROFILE_SAMPLE_INTERVAL_MS / 1000
+        while not self._stopping.is_set():
+            if not self._active:
+                self._wake.clear()
+                if not self._active:  # begin() pudo llegar entre la comprobación y clear()
+                    self._wake.wait()
+                continue
+            start = time.perf_counter()
+            try:
+                self._sample()
+            except Exception as e:
+                print(f"⚠️ Error tomando una muestra de perfilado: {e}")
+            cost = time.perf_counter() - start
+            self.stats["sampler_seconds"] += cost
+            # Espera lo necesario para que el muestreo no pase de PROFILE_MAX_OVERHEAD del tiempo
+            self._stopping.wait(max(interval, cost * (1 / PROFILE_MAX_OVERHEAD - 1)))
+
+    def _sample(self):
+        current_frames = sys._current_frames()
+        running = asyncio.current_task(self._loop)
+        workers = None
+        now = time.perf_counter()
+
+        for task, profile in list(self._active.items()):
+            if now - profile.started > PROFILE_MAX_SECONDS:
+                continue
+            if task is running:
+                frames = _thread_frames(
+                    current_frames.get(self._loop_thread_id),
+                    lambda f: _is_frame(f, os.path.join("asyncio", "events.py"), "_run"),
+                )
+                profile.add(["[cpu]"] + [_label(f) for f in frames])
+                continue
+
+            frames = _coroutine_frames(task)
+            if not frames:
+                continue
+            labels = [_label(f) for f in frames]
+            leaf = frames[-1]
+            if _is_frame(leaf, os.path.join("asyncio", "threads.py"), "to_thread"):
+                if workers is None:
+                    workers = _worker_stacks(current_frames, self._loop_thread_id)
+                func_call = leaf.f_locals.get("func_call")
+                thread_frames = workers.get(id(func_call)) if func_call is not None else None
+                if thread_frames:
+                    profile.add(["[hilo]"] + labels + [_label(f) for f in thread_frames])
+                    continue
+            profile.add(["[espera]"] + labels)
+        self.stats["samples"] += 1
+
+
+def prune_profiles(db):
+    """Aplica la retención: últimos PROFILE_RETENTION_COUNT perfiles y PROFILE_RETENTION_HOURS"""
+    cutoff = datetime.utcnow() - timedelta(hours=PROFILE_RETENTION_HOURS)
+    db.query(RequestProfile).filter(RequestProfile.created_at < cutoff).delete(synchronize_session=False)
+    keep_from = (
+        db.query(RequestProfile.id)
+        .order_by(RequestProfile.id.desc())
+        .offset(PROFILE_RETENTION_COUNT)
+        .limit(1)
+        .scalar()
+    )
+    if keep_from is not None:
+        db.query(RequestProfile).filter(RequestProfile.id <= keep_from).delete(synchronize_session=False)
+
+
+class ProfilingMiddleware:
+    """Perfila las peticiones que cumplen alguna captura activa (sin capturas no hace nada)"""
+
+    def __init__(self, app, profiler: RequestProfiler, router):
+        self.app = app
+        self.profiler = profiler
+        self.router = router
+
+    def _route_path(self, scope) -> Optional[str]:
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", None)
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.captures:
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route_path(scope)
+        task = asyncio.current_task()
+        profile = self.profiler.begin(task, scope["method"], route, scope["path"]) if route is not None else None
+        if profile is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.profiler.finish(task, profile)
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,23 @@
+"""
+Creación del esquema de la base de datos global y de los shards
+
+Se ejecuta una vez al arrancar: en lifespan (un solo proceso) o en serve.py
+antes de lanzar los workers, que entonces la omiten (SCHEMA_INIT=skip).
+"""
+
+from database import Base, engine
+from search_service import ensure_search_index
+from settings import settings
+from sharding import shard_router
+
+
+def schema_init_enabled() -> bool:
+    return settings.schema_init.lower() != "skip"
+
+
+def init_schema():
+    """Crea las tablas que falten, prepara los shards y el índice de búsqueda"""
+    Base.metadata.create_all(bind=engine)
+    shard_router.init_schemas()
+    for shard_engine in shard_router.engines:
+        ensure_search_index(shard_engine)
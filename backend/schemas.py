@@ -1,6 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
-from typing import Optional, List
+from typing import Literal, Optional, List
 
 # User Schemas
 class UserCreate(BaseModel):
@@ -40,6 +40,9 @@ class CompanyCreate(BaseModel):
     identifier: str  # Identificador único para llamadas públicas (ej: "mi-empresa-123")
     description: Optional[str] = None
     business_logic: Optional[str] = None  # Lógica de negocio, personalidad, catálogo, ofertas
+    retention_days: Optional[int] = Field(None, ge=1)  # Días antes de archivar llamadas finalizadas
+    daily_budget_usd: Optional[float] = Field(None, gt=0)  # Gasto diario máximo en Groq
+    budget_action: Optional[Literal["downgrade", "throttle"]] = None
 
 class CompanyResponse(BaseModel):
     id: int
@@ -47,6 +50,9 @@ class CompanyResponse(BaseModel):
     identifier: str
     description: Optional[str]
     business_logic: Optional[str]
+    retention_days: Optional[int] = None
+    daily_budget_usd: Optional[float] = None
+    budget_action: Optional[str] = None
     created_at: datetime
     
     class Config:
@@ -56,6 +62,54 @@ class CompanyUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
     business_logic: Optional[str] = None
+    retention_days: Optional[int] = Field(None, ge=1)
+    daily_budget_usd: Optional[float] = Field(None, gt=0)
+    budget_action: Optional[Literal["downgrade", "throttle"]] = None
+
+class ProfileCaptureCreate(BaseModel):
+    requests: int = Field(ge=1)  # Próximas N peticiones a perfilar
+    route: Optional[str] = None  # Plantilla exacta o prefijo de la ruta
+    company: Optional[str] = None  # identifier o ID de la empresa
+    expires_minutes: Optional[int] = Field(default=None, ge=1)
+
+class ProfileCaptureResponse(BaseModel):
+    id: int
+    route: Optional[str]
+    company: Optional[str]
+    requested: int
+    remaining: int
+    created_at: datetime
+    expires_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class RequestProfileResponse(BaseModel):
+    id: int
+    capture_id: int
+    method: str
+    route: str
+    path: str
+    company: str
+    status_code: Optional[int]
+    duration_ms: float
+    samples: int
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class PhoneNumberCreate(BaseModel):
+    phone_number: str  # Formato E.164, ej: +5215512345678
+
+class PhoneNumberResponse(BaseModel):
+    id: int
+    company_id: int
+    phone_number: str
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
 
 # Document Schemas
 class DocumentCreate(BaseModel):
@@ -84,6 +138,7 @@ class CallMessageResponse(BaseModel):
     role: str
     content: str
     timestamp: datetime
+    trace: Optional[dict] = None  # Tiempos del turno (solo en mensajes del asistente)
     
     class Config:
         from_attributes = True
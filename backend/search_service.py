@@ -0,0 +1,152 @@
+"""
+Búsqueda de texto completo sobre las transcripciones (CallMessage.content)
+
+- SQLite: tabla virtual FTS5 con contenido externo, sincronizada por triggers
+- PostgreSQL: columna tsvector generada con índice GIN
+"""
+import re
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+SNIPPET_TOKENS = 12
+
+_SQLITE_SETUP = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS call_messages_fts USING fts5(
+        content,
+        content='call_messages',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS call_messages_fts_insert AFTER INSERT ON call_messages BEGIN
+        INSERT INTO call_messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS call_messages_fts_delete AFTER DELETE ON call_messages BEGIN
+        INSERT INTO call_messages_fts(call_messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS call_messages_fts_update AFTER UPDATE OF content ON call_messages BEGIN
+        INSERT INTO call_messages_fts(call_messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO call_messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+_POSTGRES_SETUP = [
+    """
+    ALTER TABLE call_messages ADD COLUMN IF NOT EXISTS content_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('spanish', coalesce(content, ''))) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_call_messages_content_tsv ON call_messages USING GIN (content_tsv)",
+]
+
+
+def ensure_search_index(engine: Engine):
+    """Crea el índice de texto completo y su sincronización si no existen"""
+    statements = _POSTGRES_SETUP if engine.dialect.name == "postgresql" else _SQLITE_SETUP
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
+
+def rebuild_search_index(engine: Engine):
+    """Reindexa todos los mensajes existentes (solo necesario en SQLite)"""
+    ensure_search_index(engine)
+    if engine.dialect.name == "postgresql":
+        return
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO call_messages_fts(call_messages_fts) VALUES ('rebuild')"))
+
+
+def _fts5_query(query: str) -> str:
+    """
+    Convierte el texto del usuario en una consulta FTS5 segura:
+    cada palabra se entrecomilla (sin operadores) y la última admite prefijo.
+    """
+    words = re.findall(r"\w+", query, flags=re.UNICODE)
+    if not words:
+        return ""
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_messages(
+    db: Session,
+    query: str,
+    company_id: Optional[int] = None,
+    page: int = 1,
+    page_size: int = 20,
+) -> list:
+    """
+    Busca mensajes por relevancia (mayor rank = más relevante) y devuelve fragmentos resaltados.
+    Los fragmentos contienen el texto original de la transcripción: el cliente
+    debe escapar el contenido y solo interpretar las marcas de resaltado.
+    """
+    params = {"limit": page_size, "offset": (page - 1) * page_size}
+    company_filter = ""
+    if company_id is not None:
+        company_filter = "AND c.company_id = :company_id"
+        params["company_id"] = company_id
+
+    if db.get_bind().dialect.name == "postgresql":
+        params["q"] = query
+        sql = f"""
+            SELECT m.id, m.call_id, c.company_id, m.role, m.timestamp,
+                   ts_headline('spanish', m.content, q,
+                       'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords={SNIPPET_TOKENS * 2}, MinWords={SNIPPET_TOKENS}') AS snippet,
+                   ts_rank(m.content_tsv, q) AS rank
+            FROM call_messages m
+            JOIN calls c ON c.id = m.call_id,
+                 websearch_to_tsquery('spanish', :q) q
+            WHERE m.content_tsv @@ q {company_filter}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    else:
+        params["q"] = _fts5_query(query)
+        if not params["q"]:
+            return []
+        sql = f"""
+            SELECT m.id, m.call_id, c.company_id, m.role, m.timestamp,
+                   snippet(call_messages_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', {SNIPPET_TOKENS}) AS snippet,
+                   -bm25(call_messages_fts) AS rank
+            FROM call_messages_fts
+            JOIN call_messages m ON m.id = call_messages_fts.rowid
+            JOIN calls c ON c.id = m.call_id
+            WHERE call_messages_fts MATCH :q {company_filter}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT :limit OFFSET :offset
+        """
+
+    rows = db.execute(text(sql), params).mappings().all()
+    return [dict(row) for row in rows]
+
+
+def search_shards(
+    sessions: list,
+    query: str,
+    company_id: Optional[int] = None,
+    page: int = 1,
+    page_size: int = 20,
+) -> list:
+    """Busca en varios shards y combina los resultados por relevancia"""
+    if len(sessions) == 1:
+        return search_messages(sessions[0], query, company_id, page, page_size)
+
+    # Cada shard devuelve sus mejores page * page_size resultados y se paginan combinados
+    results = []
+    for db in sessions:
+        results.extend(search_messages(db, query, company_id, 1, page * page_size))
+    results.sort(key=lambda row: row["rank"], reverse=True)
+    return results[(page - 1) * page_size:page * page_size]
@@ -0,0 +1,97 @@
+"""
+Servidor de producción: varios procesos worker de Uvicorn
+
+El esquema de la base de datos se crea una sola vez aquí, antes de lanzar los
+workers (que lo omiten con SCHEMA_INIT=skip). Cada worker crea sus clientes,
+pools y workers en segundo plano en el lifespan de FastAPI y los cierra al salir.
+
+Uso:
+    python serve.py                          # WEB_CONCURRENCY workers (por defecto, uno)
+    python serve.py --workers 4 --port 8000
+
+Varios workers de un mismo serve.py comparten el socket: las peticiones de una llamada
+llegan a cualquiera de ellos. Funciona (el contexto se guarda con control de versión),
+pero las respuestas especulativas, la deduplicación de reintentos y la cache de llamadas
+activas son de cada proceso y pierden eficacia. Para escalar con afinidad, lanza varias
+instancias de un worker detrás de un balanceador que envíe cada llamada siempre a la misma
+(CALL_AFFINITY=true); esa opción se rechaza con --workers mayor que 1.
+
+Señales (Linux/macOS):
+    SIGHUP   reinicia los workers uno a uno (recarga sin cortar el servicio)
+    SIGTERM  apagado ordenado: cada worker termina sus requests y vacía sus colas
+    SIGTTIN / SIGTTOU  agrega / quita un worker
+
+Las métricas de /metrics de todos los workers se combinan a través de
+PROMETHEUS_MULTIPROC_DIR (si no se define, se usa un directorio temporal).
+"""
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+
+import uvicorn
+
+from schema_setup import init_schema, schema_init_enabled
+from settings import settings
+
+GRACEFUL_SHUTDOWN_SECONDS = settings.graceful_shutdown_seconds
+
+
+def prepare_metrics_dir() -> str | None:
+    """
+    Directorio donde los workers escriben sus métricas. Se vacía en cada arranque
+    para no sumar valores de ejecuciones anteriores. Devuelve el directorio si es
+    temporal (hay que borrarlo al salir).
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for stale in glob.glob(os.path.join(path, "*.db")):
+            os.remove(stale)
+        return None
+    path = tempfile.mkdtemp(prefix="voice-metrics-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path  # Los workers heredan el entorno
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor de producción de Voice Assistant API")
+    parser.add_argument("--host", default=settings.host)
+    parser.add_argument("--port", type=int, default=settings.port)
+    parser.add_argument("--workers", type=int, default=settings.web_concurrency)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if settings.call_affinity:
+            print("❌ CALL_AFFINITY=true no es posible con varios workers en un mismo serve.py: "
+                  "uvicorn reparte las peticiones de una llamada entre todos ellos")
+            sys.exit(1)
+        print(f"⚠️ {args.workers} workers sin afinidad por llamada: la especulación, la deduplicación de "
+              "reintentos y la cache de llamadas activas son de cada worker")
+
+    if schema_init_enabled():
+        print("Preparando el esquema de la base de datos...")
+        init_schema()
+    os.environ["SCHEMA_INIT"] = "skip"  # Los workers heredan el entorno
+
+    temporary_metrics_dir = prepare_metrics_dir()
+
+    print(f"Iniciando {args.workers} workers en {args.host}:{args.port}")
+    try:
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS,
+            proxy_headers=True,
+        )
+    finally:
+        if temporary_metrics_dir:
+            shutil.rmtree(temporary_metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Configuración de la aplicación
+
+Se lee una sola vez (variables de entorno y archivo .env) en un objeto tipado.
+Los módulos toman de aquí sus valores en lugar de llamar a load_dotenv/os.getenv.
+"""
+import os
+from typing import List, Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    # El .env del backend, aunque el proceso arranque desde otro directorio
+    model_config = SettingsConfigDict(
+        env_file=os.path.join(os.path.dirname(__file__), ".env"),
+        env_file_encoding="utf-8",
+        extra="ignore"
+    )
+
+    # Base de datos
+    database_url: str = "sqlite:///./voice_assistant.db"
+    shard_database_urls: str = ""  # URLs separadas por comas
+    shard_map_ttl_seconds: float = 30
+    schema_init: str = "auto"  # "skip" si el esquema ya se creó (workers de serve.py)
+
+    # Autenticación
+    secret_key: str = "your-secret-key-change-in-production"
+    bcrypt_rounds: int = 12
+    bcrypt_workers: int = os.cpu_count() or 1
+    auth_cache_ttl_seconds: float = 60
+
+    # Servicios externos
+    groq_api_key: Optional[str] = None
+    groq_max_retries: int = 2
+    groq_base_url: Optional[str] = None  # Servidor compatible con Groq (p. ej. fake_groq.py en pruebas de carga)
+    groq_cassette_mode: str = "off"  # "record" o "replay" (groq_cassettes.py)
+    groq_cassette: Optional[str] = None  # Archivo del cassette (JSON Lines)
+    groq_replay_match: str = "exact"  # "exact" (método, ruta y cuerpo) o "sequence" (método y ruta, en bucle)
+    groq_replay_latency_scale: float = 1.0  # 0 = responder sin esperar la latencia grabada
+    budget_downgrade_model: str = "openai/gpt-oss-20b"
+    usage_flush_seconds: float = 10
+    twilio_account_sid: Optional[str] = None
+    twilio_auth_token: Optional[str] = None
+    twilio_phone_number: Optional[str] = None
+    base_url: str = "http://localhost:8000"
+
+    # Caches
+    company_cache_check_seconds: float = 5
+
+    # Llamadas telefónicas
+    twilio_status_queue_size: int = 10000
+    tts_cache_dir: str = "./tts_cache"
+    tts_play_timeout_seconds: float = 4
+    tts_cache_max_mb: float = 500  # Al superarlo se borran los clips usados hace más tiempo
+    twilio_play_audio: bool = True
+    twilio_speculation: bool = True
+    speculation_max_per_call: int = 6
+    speculation_min_words: int = 3
+    speculation_match_ratio: float = 0.9
+
+    # Turnos y llamadas activas
+    turn_dedup_seconds: float = 15
+    active_calls_max: int = 10000
+    active_call_idle_seconds: float = 900
+    active_call_sweep_seconds: float = 60
+    call_affinity: bool = False  # true solo si el balanceador envía cada llamada siempre al mismo worker
+
+    # Detector de bloqueos del event loop
+    loop_watchdog: str = "off"  # "log" o "strict" (la petición que bloquea responde 500)
+    loop_block_threshold_ms: float = 100
+    loop_watchdog_interval_ms: float = 20
+
+    # Perfilado bajo demanda (super_admin)
+    profile_max_requests: int = 50
+    profile_sample_interval_ms: float = 10
+    profile_max_overhead: float = 0.05  # Fracción de tiempo de CPU del muestreador
+    profile_max_concurrent: int = 4  # Peticiones perfiladas a la vez por worker
+    profile_max_seconds: float = 30
+    profile_max_stacks: int = 2000
+    profile_retention_count: int = 200
+    profile_retention_hours: float = 72
+    profile_capture_ttl_minutes: int = 60
+    profile_check_seconds: float = 2
+    profile_idle_check_seconds: float = 30  # Intervalo máximo de relectura sin capturas activas
+
+    # Servidor (serve.py)
+    host: str = "0.0.0.0"
+    port: int = 8000
+    # Un worker por defecto: la especulación, la deduplicación de turnos y la cache de llamadas
+    # activas viven en cada proceso y uvicorn reparte las peticiones sin afinidad por llamada
+    web_concurrency: int = 1
+    graceful_shutdown_seconds: int = 30
+
+    @property
+    def shard_urls(self) -> List[str]:
+        return [url.strip() for url in self.shard_database_urls.split(",") if url.strip()]
+
+
+settings = Settings()
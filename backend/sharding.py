@@ -0,0 +1,186 @@
+"""
+Sharding opcional por empresa para las tablas de llamadas
+
+La base de datos global (DATABASE_URL) guarda users, companies y shard_map y
+además actúa como shard 0. Si SHARD_DATABASE_URLS tiene valores (separados por
+comas), cada URL es un shard adicional (1..N) con sus propias tablas calls,
+call_messages, call_archives y call_rollups.
+
+Los IDs de llamada son únicos globalmente: el shard k asigna IDs a partir de
+k * SHARD_ID_STRIDE, de modo que el shard de una llamada se deduce de su ID.
+"""
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import MetaData, create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from database import SessionLocal, engine
+from models import Call, CallArchive, CallMessage, CallRollup, CallTurnTrace, CallUsage, ShardMap
+from settings import settings
+
+SHARD_ID_STRIDE = 1 << 40
+SHARD_MAP_TTL_SECONDS = settings.shard_map_ttl_seconds
+
+# Tablas que viven en cada shard (el resto solo existe en la base global)
+SHARDED_TABLES = [Call.__table__, CallMessage.__table__, CallArchive.__table__, CallRollup.__table__, CallTurnTrace.__table__, CallUsage.__table__]
+
+
+def _create_engine(url: str) -> Engine:
+    return create_engine(
+        url,
+        connect_args={"check_same_thread": False} if "sqlite" in url else {}
+    )
+
+
+def _shard_metadata() -> MetaData:
+    """
+    Copia de las tablas de los shards sin las claves foráneas a tablas que solo existen
+    en la base global (companies, users): en un shard no hay tabla a la que referenciar.
+    """
+    metadata = MetaData()
+    sharded = {table.name for table in SHARDED_TABLES}
+    for table in SHARDED_TABLES:
+        shard_table = table.to_metadata(metadata)
+        for constraint in list(shard_table.foreign_key_constraints):
+            if all(fk.target_fullname.split(".")[0] in sharded for fk in constraint.elements):
+                continue
+            shard_table.constraints.discard(constraint)
+            for fk in constraint.elements:
+                fk.parent.foreign_keys.discard(fk)
+                shard_table.foreign_keys.discard(fk)
+    return metadata
+
+
+SHARD_METADATA = _shard_metadata()
+
+
+def _init_shard_schema(shard_engine: Engine, shard: int):
+    """Crea las tablas del shard y fija el inicio de su rango de IDs de llamada"""
+    SHARD_METADATA.create_all(bind=shard_engine)
+    start = shard * SHARD_ID_STRIDE
+    with shard_engine.begin() as conn:
+        if shard_engine.dialect.name == "postgresql":
+            current = conn.execute(text("SELECT last_value FROM calls_id_seq")).scalar()
+            if current < start:
+                conn.execute(text("SELECT setval('calls_id_seq', :start)"), {"start": start})
+        else:
+            current = conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'calls'")).scalar()
+            if current is None:
+                conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('calls', :start)"), {"start": start})
+            elif current < start:
+                conn.execute(text("UPDATE sqlite_sequence SET seq = :start WHERE name = 'calls'"), {"start": start})
+
+
+class ShardRouter:
+    """Resuelve el shard de una empresa o de una llamada"""
+
+    def __init__(self, shard_urls: Optional[List[str]] = None):
+        self.engines: List[Engine] = [engine]
+        self.sessionmakers: List[sessionmaker] = [SessionLocal]
+        for url in shard_urls or []:
+            shard_engine = _create_engine(url)
+            self.engines.append(shard_engine)
+            self.sessionmakers.append(sessionmaker(autocommit=False, autoflush=False, bind=shard_engine))
+
+        self._map: Dict[int, int] = {}
+        self._map_loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.engines) > 1
+
+    @property
+    def shard_count(self) -> int:
+        return len(self.engines)
+
+    def init_schemas(self):
+        for shard, shard_engine in enumerate(self.engines):
+            if shard > 0:
+                _init_shard_schema(shard_engine, shard)
+
+    def shard_for_call(self, call_id: int) -> int:
+        shard = call_id // SHARD_ID_STRIDE
+        return shard if shard < self.shard_count else 0
+
+    def _load_map(self, db: Session):
+        rows = db.query(ShardMap.company_id, ShardMap.shard).all()
+        self._map = {company_id: shard for company_id, shard in rows}
+        self._map_loaded_at = time.monotonic()
+
+    def shard_for_company(self, company_id: Optional[int]) -> int:
+        """
+        Devuelve el shard de la empresa. El mapa se cachea en memoria y se recarga
+        cada SHARD_MAP_TTL_SECONDS para ver los cambios hechos por otros procesos.
+        Una empresa sin asignación se asigna por módulo y se persiste.
+        """
+        if not self.enabled or company_id is None:
+            return 0
+
+        with self._lock:
+            expired = time.monotonic() - self._map_loaded_at > SHARD_MAP_TTL_SECONDS
+            if company_id in self._map and not expired:
+                return self._map[company_id]
+
+            db = SessionLocal()
+            try:
+                self._load_map(db)
+                if company_id not in self._map:
+                    # Las empresas con llamadas previas al sharding se quedan en el shard 0
+                    has_legacy_calls = db.query(Call.id).filter(Call.company_id == company_id).first() is not None
+                    shard = 0 if has_legacy_calls else company_id % self.shard_count
+                    db.add(ShardMap(company_id=company_id, shard=shard))
+                    db.commit()
+                    self._map[company_id] = shard
+                return self._map[company_id]
+            finally:
+                db.close()
+
+    def set_company_shard(self, db: Session, company_id: int, shard: int):
+        """Cambia la asignación de una empresa (usado por la herramienta de rebalanceo)"""
+        entry = db.query(ShardMap).filter(ShardMap.company_id == company_id).first()
+        if entry:
+            entry.shard = shard
+        else:
+            db.add(ShardMap(company_id=company_id, shard=shard))
+        db.commit()
+        with self._lock:
+            self._map[company_id] = shard
+
+
+shard_router = ShardRouter(settings.shard_urls)
+
+
+class ShardSessions:
+    """
+    Sesiones por shard con alcance de request. Se abren bajo demanda y se
+    cierran al terminar la request; el shard 0 reutiliza la sesión global.
+    """
+
+    def __init__(self, db: Session, router: ShardRouter = shard_router):
+        self.db = db
+        self.router = router
+        self._sessions: Dict[int, Session] = {0: db}
+
+    def shard(self, shard: int) -> Session:
+        if shard not in self._sessions:
+            self._sessions[shard] = self.router.sessionmakers[shard]()
+        return self._sessions[shard]
+
+    def for_company(self, company_id: Optional[int]) -> Session:
+        return self.shard(self.router.shard_for_company(company_id))
+
+    def for_call(self, call_id: int) -> Session:
+        return self.shard(self.router.shard_for_call(call_id))
+
+    def all(self) -> Iterator[Session]:
+        for shard in range(self.router.shard_count):
+            yield self.shard(shard)
+
+    def close(self):
+        for shard, session in self._sessions.items():
+            if shard != 0:
+                session.close()
@@ -0,0 +1,164 @@
+"""
+Cache en disco de audio sintetizado (TTS) para reproducirlo en Twilio con <Play>
+
+Cada clip se guarda como <sha256>.wav, donde el hash cubre el texto y la
+configuración de voz. El endpoint /api/tts/{hash}.wav lo sirve con ETag y
+cabeceras de cache largas (el contenido de un hash nunca cambia).
+
+La mayoría de las respuestas del LLM son únicas, así que el directorio se limita a
+TTS_CACHE_MAX_MB: al superarlo se borran los clips usados hace más tiempo (el mtime se
+actualiza cada vez que un clip se reutiliza). Nunca se borran los mensajes fijos
+generados por adelantado ni los clips de menos de TTS_CLIP_MIN_AGE_SECONDS, que Twilio
+puede estar a punto de descargar.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from settings import settings
+
+
+TTS_CACHE_DIR = settings.tts_cache_dir
+# Tiempo máximo que un webhook de Twilio espera por un clip antes de usar <Say>
+TTS_PLAY_TIMEOUT_SECONDS = settings.tts_play_timeout_seconds
+TTS_CACHE_MAX_BYTES = int(settings.tts_cache_max_mb * 1024 * 1024)
+TTS_CLIP_MIN_AGE_SECONDS = 300
+TTS_EVICT_TARGET = 0.9  # Se borra hasta quedar en el 90 % del límite
+
+_CLIP_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class TTSAudioCache:
+    def __init__(self, groq_service, cache_dir: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES):
+        self.groq_service = groq_service
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._pinned: Set[str] = set()  # Mensajes fijos: no se borran
+        # Tamaño estimado del directorio: el del último recorrido más lo escrito desde entonces.
+        # Otros workers escriben en el mismo directorio; el recorrido los incluye.
+        self._size_lock = threading.Lock()
+        self._estimated_bytes = 0
+        self.stats = {"evicted": 0}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._estimated_bytes = self._scan_size()
+
+    def clip_hash(self, text: str) -> str:
+        service = type(self.groq_service)
+        key = "|".join([
+            getattr(service, "TTS_MODEL", ""),
+            getattr(service, "TTS_VOICE", ""),
+            getattr(service, "TTS_FORMAT", ""),
+            text,
+        ])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def clip_path(self, clip_hash: str) -> Optional[str]:
+        """Ruta del clip en disco, o None si el hash no es válido o no existe"""
+        if not _CLIP_HASH_PATTERN.match(clip_hash):
+            return None
+        path = os.path.join(self.cache_dir, f"{clip_hash}.wav")
+        return path if os.path.exists(path) else None
+
+    def _synthesize_to_disk(self, text: str, clip_hash: str):
+        audio_bytes = self.groq_service.synthesize_speech(text)
+        path = os.path.join(self.cache_dir, f"{clip_hash}.wav")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio_bytes)
+        os.replace(tmp_path, path)  # Escritura atómica
+        with self._size_lock:
+            self._estimated_bytes += len(audio_bytes)
+            over_limit = self.max_bytes and self._estimated_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _clips(self):
+        """(mtime, tamaño, hash, ruta) de cada clip del directorio"""
+        clips = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".wav"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Otro worker lo acaba de borrar
+                clips.append((stat.st_mtime, stat.st_size, entry.name[:-4], entry.path))
+        return clips
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _, _ in self._clips())
+
+    def evict(self) -> int:
+        """Borra los clips usados hace más tiempo hasta quedar por debajo del límite"""
+        with self._size_lock:
+            clips = self._clips()
+            total = sum(size for _, size, _, _ in clips)
+            target = self.max_bytes * TTS_EVICT_TARGET
+            cutoff = time.time() - TTS_CLIP_MIN_AGE_SECONDS
+            removed = 0
+            for mtime, size, clip_hash, path in sorted(clips):
+                if total <= target:
+                    break
+                if mtime > cutoff:
+                    break  # Los siguientes son más recientes
+                if clip_hash in self._pinned or clip_hash in self._pending:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            self._estimated_bytes = total
+            self.stats["evicted"] += removed
+        return removed
+
+    def _schedule(self, text: str, clip_hash: str) -> asyncio.Task:
+        """Sintetiza en un hilo; varias peticiones del mismo texto comparten la tarea"""
+        task = self._pending.get(clip_hash)
+        if task is None:
+            task = asyncio.create_task(asyncio.to_thread(self._synthesize_to_disk, text, clip_hash))
+            self._pending[clip_hash] = task
+            task.add_done_callback(lambda done: self._finished(clip_hash, done))
+        return task
+
+    def _finished(self, clip_hash: str, task: asyncio.Task):
+        self._pending.pop(clip_hash, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"⚠️ No se pudo sintetizar audio para Twilio: {task.exception()}")
+
+    async def ensure(self, text: str, timeout: Optional[float] = TTS_PLAY_TIMEOUT_SECONDS) -> Optional[str]:
+        """
+        Devuelve el hash del clip si está en disco o se sintetiza dentro de timeout.
+        Si tarda más, la síntesis sigue en segundo plano y se devuelve None.
+        """
+        clip_hash = self.clip_hash(text)
+        path = self.clip_path(clip_hash)
+        if path:
+            try:
+                os.utime(path)  # Recién usado: el último en borrarse
+            except FileNotFoundError:
+                pass
+            else:
+                return clip_hash
+
+        task = self._schedule(text, clip_hash)
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            return None
+        except Exception:
+            return None  # El error ya se registró en _finished
+        return clip_hash
+
+    async def pregenerate(self, texts: Iterable[str]):
+        """Genera por adelantado los clips de mensajes fijos (sin límite de tiempo); no se borran"""
+        for text in texts:
+            self._pinned.add(self.clip_hash(text))
+            await self.ensure(text, timeout=None)
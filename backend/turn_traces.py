@@ -0,0 +1,193 @@
+"""
+Trazas de tiempos por turno de conversación
+
+Cada turno de /api/voice/process y /api/twilio/gather abre una traza. Las etapas
+medidas con metrics.stage() y las respuestas de Groq (modelo, tokens e ID de la
+petición) se anotan en ella sin pasarla como parámetro: viaja en un contextvar.
+
+Al terminar el turno la traza se encola ligada a su par de mensajes (cliente y
+asistente). Un worker en segundo plano la guarda en call_turn_traces en lotes,
+así que la respuesta al usuario nunca espera a esa escritura. Si la cola se
+llena, las trazas se descartan.
+"""
+import asyncio
+import json
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from models import CallTurnTrace
+
+TRACE_QUEUE_MAX_SIZE = 10000
+TRACE_BATCH_SIZE = 200
+TRACE_BATCH_WAIT_SECONDS = 1.0
+
+
+class TurnTrace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: List[list] = []  # [etapa, inicio_ms, duración_ms]
+        self.upstream: List[dict] = []
+        self.info: Dict[str, object] = {}
+        self.call_id: Optional[int] = None
+        self.request_message_id: Optional[int] = None
+        self.response_message_id: Optional[int] = None
+
+    def add_stage(self, name: str, start: float, end: float):
+        self.stages.append([name, round((start - self.started) * 1000, 1), round((end - start) * 1000, 1)])
+
+    def add_upstream(self, operation: str, **details):
+        """Anota una petición a un servicio externo (se omiten los valores None)"""
+        entry = {"op": operation}
+        entry.update((key, value) for key, value in details.items() if value is not None)
+        self.upstream.append(entry)
+
+    def attach(self, call_id: int, request_message_id: Optional[int], response_message_id: int):
+        """Liga la traza al par de mensajes del turno; sin esto no se guarda"""
+        self.call_id = call_id
+        self.request_message_id = request_message_id
+        self.response_message_id = response_message_id
+
+    def to_json(self) -> str:
+        document = {
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages": self.stages,
+        }
+        if self.upstream:
+            document["upstream"] = self.upstream
+        document.update(self.info)
+        return json.dumps(document, ensure_ascii=False, separators=(",", ":"))
+
+
+_current: ContextVar[Optional[TurnTrace]] = ContextVar("turn_trace", default=None)
+
+
+def start_trace() -> TurnTrace:
+    """Abre la traza del turno de la petición actual"""
+    trace = TurnTrace()
+    _current.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[TurnTrace]:
+    return _current.get()
+
+
+def load_traces(db, call_id: int) -> Dict[int, dict]:
+    """Trazas de una llamada indexadas por el ID del mensaje del asistente"""
+    rows = (
+        db.query(CallTurnTrace.response_message_id, CallTurnTrace.request_message_id, CallTurnTrace.trace)
+        .filter(CallTurnTrace.call_id == call_id)
+        .all()
+    )
+    traces = {}
+    for response_message_id, request_message_id, trace_json in rows:
+        trace = json.loads(trace_json)
+        trace["request_message_id"] = request_message_id
+        traces[response_message_id] = trace
+    return traces
+
+
+@dataclass
+class _PendingTrace:
+    call_id: int
+    request_message_id: Optional[int]
+    response_message_id: int
+    trace: str
+    created_at: datetime
+
+
+class TraceWriter:
+    def __init__(self, shard_router, max_size: int = TRACE_QUEUE_MAX_SIZE):
+        self.shard_router = shard_router
+        self.max_size = max_size
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"written": 0, "dropped": 0}
+
+    def submit(self, trace: Optional[TurnTrace]) -> bool:
+        """Encola la traza de un turno completado. No bloquea: si la cola está llena se descarta"""
+        if trace is None or trace.response_message_id is None or self.queue is None:
+            return False
+        try:
+            self.queue.put_nowait(_PendingTrace(
+                trace.call_id, trace.request_message_id, trace.response_message_id, trace.to_json(), datetime.utcnow()
+            ))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return False
+        return True
+
+    # ---------- Ciclo de vida ----------
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Guarda lo que quede en la cola y detiene el worker"""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+
+    # ---------- Worker ----------
+
+    async def _next_batch(self) -> tuple[List[_PendingTrace], bool]:
+        first = await self.queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = asyncio.get_running_loop().time() + TRACE_BATCH_WAIT_SECONDS
+        while len(batch) < TRACE_BATCH_SIZE:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                pending = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if pending is None:
+                return batch, True
+            batch.append(pending)
+        return batch, False
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._next_batch()
+            if not batch:
+                continue
+            try:
+                # SQLAlchemy es síncrono: escribir el lote fuera del event loop
+                await asyncio.to_thread(self.write_batch, batch)
+            except Exception as e:
+                print(f"❌ Error guardando trazas de turnos: {e}")
+
+    def write_batch(self, batch: List[_PendingTrace]):
+        """Inserta un lote de trazas, agrupadas por el shard de su llamada"""
+        by_shard = defaultdict(list)
+        for pending in batch:
+            by_shard[self.shard_router.shard_for_call(pending.call_id)].append({
+                "call_id": pending.call_id,
+                "request_message_id": pending.request_message_id,
+                "response_message_id": pending.response_message_id,
+                "trace": pending.trace,
+                "created_at": pending.created_at,
+            })
+
+        for shard, rows in by_shard.items():
+            db = self.shard_router.sessionmakers[shard]()
+            try:
+                db.bulk_insert_mappings(CallTurnTrace, rows)
+                db.commit()
+                self.stats["written"] += len(rows)
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
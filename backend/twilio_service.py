@@ -1,32 +1,78 @@
 """
 Servicio para integrar Twilio con el sistema de voz
 """
-from twilio.twiml.voice_response import VoiceResponse, Gather
-from twilio.rest import Client
-import os
-from dotenv import load_dotenv
+from settings import settings
+from twiml_renderer import render_gather, render_hangup
 
-load_dotenv()
+# Mensajes fijos de las llamadas telefónicas (su audio se genera por adelantado)
+PROMPT_NO_COMPANIES = "Lo sentimos, no hay empresas configuradas en el sistema."
+PROMPT_NUMBER_NOT_ASSIGNED = "Lo sentimos, este número no está asignado a ninguna empresa."
+PROMPT_ERROR = "Lo sentimos, ha ocurrido un error. Por favor, intenta más tarde."
+PROMPT_CALL_NOT_FOUND = "Error: Llamada no encontrada."
+PROMPT_COMPANY_NOT_CONFIGURED = "Error: Empresa no encontrada o sin configuración."
+PROMPT_REPEAT = "No pude escucharte. Por favor, repite tu pregunta."
+PROMPT_PROCESSING_ERROR = "Lo sentimos, ha ocurrido un error procesando tu mensaje. Por favor, intenta de nuevo."
+PROMPT_SERVICE_UNAVAILABLE = "Lo sentimos, el servicio no está disponible en este momento. Por favor, intenta más tarde."
+
+FIXED_PROMPTS = [
+    PROMPT_NO_COMPANIES,
+    PROMPT_NUMBER_NOT_ASSIGNED,
+    PROMPT_ERROR,
+    PROMPT_CALL_NOT_FOUND,
+    PROMPT_COMPANY_NOT_CONFIGURED,
+    PROMPT_REPEAT,
+    PROMPT_PROCESSING_ERROR,
+    PROMPT_SERVICE_UNAVAILABLE,
+]
+
+def welcome_message(company_name: str) -> str:
+    return f"Hola, bienvenido a {company_name}. ¿En qué puedo ayudarte hoy?"
 
 class TwilioService:
     def __init__(self):
-        self.account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-        self.auth_token = os.getenv("TWILIO_AUTH_TOKEN")
-        self.phone_number = os.getenv("TWILIO_PHONE_NUMBER")
+        self.account_sid = settings.twilio_account_sid
+        self.auth_token = settings.twilio_auth_token
+        self.phone_number = settings.twilio_phone_number
         
         if self.account_sid and self.auth_token:
+            # twilio.rest es pesado de importar: solo se carga si hay credenciales
+            from twilio.rest import Client
             self.client = Client(self.account_sid, self.auth_token)
         else:
             self.client = None
             print("⚠️ Twilio no configurado. Configura TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN y TWILIO_PHONE_NUMBER en .env")
     
-    def generate_twiml_for_call(self, message: str, gather: bool = False, action_url: str = None):
+    def generate_twiml_for_call(self, message: str, gather: bool = False, action_url: str = None, audio_url: str = None,
+                                partial_callback_url: str = None):
         """
         Genera TwiML para responder a una llamada
+        Si se indica audio_url se reproduce ese audio con <Play> en lugar de <Say>
+        Si se indica partial_callback_url Twilio envía ahí los resultados parciales del reconocimiento
         """
+        if gather and action_url:
+            return render_gather(message, action_url, audio_url=audio_url, partial_callback_url=partial_callback_url)
+        if not gather:
+            return render_hangup(message, audio_url=audio_url)
+        # Gather sin action_url: caso poco común, se delega en el SDK
+        return self.generate_twiml_with_sdk(message, gather, action_url, audio_url, partial_callback_url)
+
+    def generate_twiml_with_sdk(self, message: str, gather: bool = False, action_url: str = None, audio_url: str = None,
+                                partial_callback_url: str = None):
+        """
+        Misma respuesta que generate_twiml_for_call construida con el SDK de Twilio.
+        Es la referencia con la que benchmark_twiml.py compara las plantillas.
+        """
+        from twilio.twiml.voice_response import VoiceResponse, Gather
+
         response = VoiceResponse()
         
         if gather and action_url:
+            partial_options = {}
+            if partial_callback_url:
+                partial_options = {
+                    'partial_result_callback': partial_callback_url,
+                    'partial_result_callback_method': 'POST',
+                }
             gather = Gather(
                 input='speech',
                 action=action_url,
@@ -34,9 +80,15 @@ class TwilioService:
                 speech_timeout='auto',
                 language='es-ES',
                 hints='',  # Puedes agregar palabras clave aquí
+                **partial_options
             )
-            gather.say(message, language='es-ES')
+            if audio_url:
+                gather.play(audio_url)
+            else:
+                gather.say(message, language='es-ES')
             response.append(gather)
+        elif audio_url:
+            response.play(audio_url)
         else:
             response.say(message, language='es-ES')
         
@@ -52,6 +104,8 @@ class TwilioService:
         """
         Genera TwiML para reproducir un audio desde una URL
         """
+        from twilio.twiml.voice_response import VoiceResponse
+
         response = VoiceResponse()
         response.play(audio_url)
         return str(response)
@@ -0,0 +1,177 @@
+"""
+Prefetch especulativo de respuestas del LLM en llamadas de Twilio
+
+Mientras el usuario habla, Twilio envía resultados parciales del reconocimiento
+de voz a /api/twilio/partial. Cuando la parte estable de la transcripción cambia,
+se lanza en segundo plano un text_to_text con ese texto. Al llegar el resultado
+final a /api/twilio/gather, si se parece lo suficiente al texto especulado (y el
+contexto de la conversación no cambió) se reutiliza esa respuesta en lugar de
+esperar una llamada nueva al LLM.
+
+Cada llamada tiene un máximo de peticiones especulativas (SPECULATION_MAX_PER_CALL).
+Cancelar una especulación (nuevo parcial, fallo o fin de llamada) solo descarta su
+resultado: text_to_text hace la petición a Groq en un hilo (asyncio.to_thread), que
+sigue hasta el final, así que la completion se factura igualmente.
+"""
+import asyncio
+import json
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+from typing import Optional
+
+from settings import settings
+
+
+SPECULATION_ENABLED = settings.twilio_speculation
+SPECULATION_MAX_PER_CALL = settings.speculation_max_per_call
+SPECULATION_MIN_WORDS = settings.speculation_min_words
+SPECULATION_MATCH_RATIO = settings.speculation_match_ratio
+SPECULATION_MAX_CALLS = 10000  # Llamadas con estado de especulación en memoria
+
+
+def normalize_transcript(text: str) -> str:
+    """Minúsculas, sin puntuación y con espacios simples"""
+    return " ".join(re.findall(r"\w+", (text or "").lower(), flags=re.UNICODE))
+
+
+def transcripts_match(speculated: str, final: str, min_ratio: float = SPECULATION_MATCH_RATIO) -> bool:
+    a, b = normalize_transcript(speculated), normalize_transcript(final)
+    if not a or not b:
+        return False
+    if a == b:
+        return True
+    return SequenceMatcher(None, a, b).ratio() >= min_ratio
+
+
+@dataclass
+class _Speculation:
+    text: str
+    context: Optional[str]
+    task: asyncio.Task
+    cancelled: bool = False  # La cancelamos nosotros (no el turno que la espera)
+
+    def cancel(self):
+        self.cancelled = True
+        self.task.cancel()
+
+
+@dataclass
+class _CallState:
+    spent: int = 0
+    current: Optional[_Speculation] = None
+    last_text: str = ""
+
+
+class SpeculativeResponder:
+    def __init__(self, groq_service, max_per_call: int = SPECULATION_MAX_PER_CALL):
+        self.groq_service = groq_service
+        self.max_per_call = max_per_call
+        self._calls: "OrderedDict[int, _CallState]" = OrderedDict()
+        self.stats = {"started": 0, "hits": 0, "misses": 0}
+
+    def _state(self, call_id: int) -> _CallState:
+        state = self._calls.get(call_id)
+        if state is None:
+            state = _CallState()
+            self._calls[call_id] = state
+            while len(self._calls) > SPECULATION_MAX_CALLS:
+                _, evicted = self._calls.popitem(last=False)
+                self._discard(evicted)
+        else:
+            self._calls.move_to_end(call_id)
+        return state
+
+    @staticmethod
+    def _discard(state: _CallState):
+        if state.current is not None:
+            state.current.cancel()
+            state.current = None
+
+    def wants(self, call_id: int, stable_text: Optional[str]) -> bool:
+        """
+        Indica si vale la pena especular con este parcial: el texto estable cambió,
+        tiene suficientes palabras y la llamada no agotó su presupuesto.
+        Se comprueba antes de leer la base de datos.
+        """
+        if not SPECULATION_ENABLED:
+            return False
+        normalized = normalize_transcript(stable_text)
+        if len(normalized.split()) < SPECULATION_MIN_WORDS:
+            return False
+        state = self._calls.get(call_id)
+        if state is None:
+            return self.max_per_call > 0
+        return normalized != state.last_text and state.spent < self.max_per_call
+
+    def start(self, call_id: int, stable_text: str, business_logic: str, conversation_context_json: Optional[str]):
+        """Lanza un text_to_text especulativo reemplazando al anterior de la llamada"""
+        if not self.wants(call_id, stable_text):
+            return
+        state = self._state(call_id)
+        self._discard(state)
+        state.spent += 1
+        state.last_text = normalize_transcript(stable_text)
+        task = asyncio.create_task(
+            self.groq_service.text_to_text(stable_text, business_logic, conversation_context_json=conversation_context_json)
+        )
+        # Evita avisos de "exception never retrieved" si nadie llega a usar el resultado
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        state.current = _Speculation(stable_text, conversation_context_json, task)
+        self.stats["started"] += 1
+
+    async def take(self, call_id: int, final_text: str, conversation_context_json: Optional[str]) -> Optional[tuple[str, str, bool]]:
+        """
+        Devuelve (respuesta, contexto, should_end_call) si hay una especulación
+        reutilizable para el texto final; si no, None. Consume la especulación.
+        """
+        state = self._calls.get(call_id)
+        if state is None or state.current is None:
+            return None
+        speculation = state.current
+        state.current = None
+        state.last_text = ""
+
+        if speculation.context != conversation_context_json or not transcripts_match(speculation.text, final_text):
+            speculation.cancel()
+            self.stats["misses"] += 1
+            return None
+
+        if speculation.task.cancelled():
+            self.stats["misses"] += 1
+            return None
+        try:
+            # Si aún está en curso se espera: igualmente ya lleva ventaja
+            response_text, context_json, _ = await speculation.task
+        except asyncio.CancelledError:
+            # Cancelar el turno (apagado o desconexión) sí se propaga; si solo se canceló la especulación, es un fallo
+            if not speculation.cancelled:
+                raise
+            self.stats["misses"] += 1
+            return None
+        except Exception:
+            self.stats["misses"] += 1
+            return None
+
+        self.stats["hits"] += 1
+        if speculation.text != final_text:
+            context_json = self._replace_user_message(context_json, final_text)
+        return response_text, context_json, self.groq_service._check_if_user_wants_to_end(final_text)
+
+    @staticmethod
+    def _replace_user_message(context_json: str, final_text: str) -> str:
+        """Guarda en el contexto lo que el usuario dijo realmente (no el parcial)"""
+        context = json.loads(context_json)
+        messages = context.get("messages", [])
+        for message in reversed(messages):
+            if message.get("role") == "user":
+                message["content"] = final_text
+                break
+        return json.dumps(context, ensure_ascii=False)
+
+    def forget(self, call_id: int):
+        """Libera el estado de una llamada finalizada"""
+        state = self._calls.pop(call_id, None)
+        if state is not None:
+            self._discard(state)
@@ -0,0 +1,209 @@
+"""
+Ingesta de los webhooks de estado de Twilio (/api/twilio/status)
+
+El endpoint solo encola el evento y responde. Un worker en segundo plano
+agrupa los eventos en lotes y los aplica a Call (estado final, duración y
+end_time). Los eventos pueden llegar desordenados: un estado solo se aplica si
+avanza respecto al guardado. Los duplicados por (CallSid, status) se descartan
+solo cuando el lote que los contenía se aplicó; si falla, se reintenta
+STATUS_BATCH_ATTEMPTS veces y después los reintentos de Twilio vuelven a entrar.
+"""
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+
+from call_state import mark_call_ended
+from metrics import STATUS_QUEUE_DEPTH
+from models import Call
+from settings import settings
+
+STATUS_QUEUE_MAX_SIZE = settings.twilio_status_queue_size
+STATUS_BATCH_SIZE = 200
+STATUS_BATCH_WAIT_SECONDS = 0.05
+STATUS_DEDUP_SIZE = 50000
+STATUS_BATCH_ATTEMPTS = 3
+STATUS_RETRY_DELAY_SECONDS = 0.5
+
+# Orden de los estados de una llamada de Twilio; los terminales tienen el mismo rango
+STATUS_RANK = {
+    "queued": 0,
+    "initiated": 1,
+    "ringing": 2,
+    "in-progress": 3,
+    "completed": 4,
+    "busy": 4,
+    "failed": 4,
+    "no-answer": 4,
+    "canceled": 4,
+}
+TERMINAL_RANK = 4
+
+
+@dataclass(frozen=True)
+class StatusEvent:
+    call_sid: str
+    status: str
+    duration: Optional[int]
+    received_at: datetime
+
+
+def _status_rank(status: Optional[str]) -> int:
+    return STATUS_RANK.get(status, -1)
+
+
+class StatusIngestor:
+    def __init__(self, shard_router, max_size: int = STATUS_QUEUE_MAX_SIZE,
+                 on_call_ended: Optional[Callable[[int], None]] = None):
+        self.shard_router = shard_router
+        self.max_size = max_size
+        self.on_call_ended = on_call_ended  # Se llama con el ID de cada llamada en estado terminal
+        self.queue: Optional[asyncio.Queue] = None
+        self._seen = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    # ---------- API usada por el endpoint ----------
+
+    def submit(self, call_sid: Optional[str], status: Optional[str], duration: Optional[str]) -> bool:
+        """
+        Encola un evento. Devuelve False si la cola está llena.
+        Los duplicados de eventos ya aplicados (reintentos de Twilio) se aceptan pero se descartan aquí.
+        """
+        if not call_sid or status not in STATUS_RANK:
+            return True
+
+        key = (call_sid, status)
+        if key in self._seen:
+            return True
+
+        try:
+            parsed_duration = int(duration) if duration else None
+        except ValueError:
+            parsed_duration = None
+
+        try:
+            self.queue.put_nowait(StatusEvent(call_sid, status, parsed_duration, datetime.utcnow()))
+        except asyncio.QueueFull:
+            return False
+        STATUS_QUEUE_DEPTH.set(self.queue.qsize())
+        return True
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    # ---------- Ciclo de vida ----------
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Procesa lo que quede en la cola y detiene el worker"""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+
+    # ---------- Worker ----------
+
+    async def _next_batch(self) -> tuple[List[StatusEvent], bool]:
+        first = await self.queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = asyncio.get_running_loop().time() + STATUS_BATCH_WAIT_SECONDS
+        while len(batch) < STATUS_BATCH_SIZE:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if event is None:
+                return batch, True
+            batch.append(event)
+        return batch, False
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._next_batch()
+            STATUS_QUEUE_DEPTH.set(self.queue.qsize())
+            if not batch:
+                continue
+            for attempt in range(STATUS_BATCH_ATTEMPTS):
+                try:
+                    # SQLAlchemy es síncrono: aplicar el lote fuera del event loop
+                    await asyncio.to_thread(self.apply_batch, batch)
+                except Exception as e:
+                    print(f"❌ Error aplicando estados de Twilio (intento {attempt + 1}/{STATUS_BATCH_ATTEMPTS}): {e}")
+                    if attempt + 1 < STATUS_BATCH_ATTEMPTS:
+                        await asyncio.sleep(STATUS_RETRY_DELAY_SECONDS * 2 ** attempt)
+                    continue
+                self._mark_seen(batch)
+                break
+
+    def _mark_seen(self, events: List[StatusEvent]):
+        """Solo los eventos ya aplicados cuentan como duplicados"""
+        for event in events:
+            self._seen[(event.call_sid, event.status)] = True
+        while len(self._seen) > STATUS_DEDUP_SIZE:
+            self._seen.popitem(last=False)
+
+    def apply_batch(self, events: List[StatusEvent]):
+        """Aplica un lote de eventos: se queda con el más avanzado por CallSid"""
+        latest: Dict[str, StatusEvent] = {}
+        for event in events:
+            current = latest.get(event.call_sid)
+            if current is None or _status_rank(event.status) > _status_rank(current.status) or (
+                _status_rank(event.status) == _status_rank(current.status) and (event.duration or 0) > (current.duration or 0)
+            ):
+                latest[event.call_sid] = event
+
+        # El CallSid no dice en qué shard está la llamada: se busca en todos
+        pending = dict(latest)
+        for session_factory in self.shard_router.sessionmakers:
+            if not pending:
+                break
+            db = session_factory()
+            ended = []
+            try:
+                calls = db.query(Call).filter(Call.twilio_call_sid.in_(list(pending))).all()
+                for call in calls:
+                    if self._apply_event(db, call, pending.pop(call.twilio_call_sid)):
+                        ended.append(call.id)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+            if self.on_call_ended:
+                for call_id in ended:
+                    self.on_call_ended(call_id)
+
+    def _apply_event(self, db, call: Call, event: StatusEvent) -> bool:
+        """Aplica el evento a la llamada; devuelve True si el estado es terminal"""
+        if _status_rank(event.status) < _status_rank(call.twilio_status):
+            return False  # Evento atrasado
+
+        call.twilio_status = event.status
+        if event.duration is not None:
+            call.twilio_duration = max(call.twilio_duration or 0, event.duration)
+
+        if _status_rank(event.status) != TERMINAL_RANK:
+            return False
+        if call.end_time is None:
+            if event.duration is not None and call.start_time is not None:
+                end_time = call.start_time + timedelta(seconds=event.duration)
+            else:
+                end_time = event.received_at
+            # mark_call_ended recarga la llamada: guardar antes el estado y la duración
+            db.flush()
+            # UPDATE condicional: el colgado desde gather o el barrido de inactivas pueden cerrarla a la vez
+            mark_call_ended(db, call.id, end_time)
+        return True
@@ -49,6 +49,13 @@ def update_existing_companies():
                 )
                 print(f"✓ Empresa '{company_name}' (ID: {company_id}) -> identificador: '{identifier}'")
             
+            # Invalidar la cache de empresas de los workers en ejecución
+            updated = conn.execute(
+                text("UPDATE cache_versions SET version = version + 1 WHERE name = 'companies'")
+            ).rowcount
+            if not updated:
+                conn.execute(text("INSERT INTO cache_versions (name, version) VALUES ('companies', 1)"))
+            
             conn.commit()
             print(f"\n✓ {len(companies)} empresas actualizadas exitosamente")
             
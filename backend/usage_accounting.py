@@ -0,0 +1,317 @@
+"""
+Contabilidad de uso y coste de Groq por llamada y por empresa, con presupuestos diarios
+
+Cada petición a Groq (STT, LLM y TTS) se anota en memoria: tokens, segundos de
+audio transcrito, caracteres sintetizados y coste estimado. Un worker en segundo
+plano vuelca lo acumulado cada USAGE_FLUSH_SECONDS en:
+
+- call_usage: por llamada y modelo (shard de la llamada)
+- company_usage_rollups: por empresa, día (UTC) y modelo (base global)
+
+El turno nunca escribe en la base de datos por esto. Tras cada volcado se relee
+el gasto del día de las empresas con presupuesto; lo gastado = lo último leído +
+lo anotado en este proceso que aún no se volcó. Con varios workers cada uno ve el
+gasto de los demás con un retraso de hasta USAGE_FLUSH_SECONDS.
+
+Al superar daily_budget_usd la empresa pasa a BUDGET_DOWNGRADE_MODEL (budget_action
+"downgrade", por defecto) o se rechazan sus turnos hasta el día siguiente ("throttle").
+"""
+import asyncio
+import threading
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from analytics_service import bucket_start
+from models import CallUsage, CompanyUsageRollup
+from settings import settings
+
+USAGE_FLUSH_SECONDS = settings.usage_flush_seconds
+BUDGET_DOWNGRADE_MODEL = settings.budget_downgrade_model
+
+BUDGET_DOWNGRADE = "downgrade"
+BUDGET_THROTTLE = "throttle"
+
+USAGE_FIELDS = ("requests", "prompt_tokens", "completion_tokens", "audio_seconds", "tts_characters", "cost_usd")
+
+# Precios de lista de Groq en USD por unidad (actualizar si cambian)
+MODEL_PRICES = {
+    "openai/gpt-oss-120b": {"prompt_tokens": 0.15 / 1e6, "completion_tokens": 0.60 / 1e6},
+    "openai/gpt-oss-20b": {"prompt_tokens": 0.075 / 1e6, "completion_tokens": 0.30 / 1e6},
+    "whisper-large-v3": {"audio_seconds": 0.111 / 3600},
+    "whisper-large-v3-turbo": {"audio_seconds": 0.04 / 3600},
+    "playai-tts": {"tts_characters": 50 / 1e6},
+}
+
+
+class BudgetExceededError(Exception):
+    """La empresa superó su presupuesto diario y está configurada para rechazar turnos"""
+
+
+def estimate_cost(model: Optional[str], usage: dict) -> float:
+    prices = MODEL_PRICES.get(model or "", {})
+    return sum((usage.get(field) or 0) * price for field, price in prices.items())
+
+
+@dataclass(frozen=True)
+class UsageScope:
+    company_id: int
+    call_id: Optional[int]
+    daily_budget_usd: Optional[float]
+    budget_action: Optional[str]
+
+
+_scope: ContextVar[Optional[UsageScope]] = ContextVar("usage_scope", default=None)
+
+
+def bind_usage(company, call_id: Optional[int] = None):
+    """Atribuye a esta empresa (y llamada) el uso de Groq del resto de la petición"""
+    if company is not None:
+        _scope.set(UsageScope(company.id, call_id, company.daily_budget_usd, company.budget_action))
+
+
+def _upsert(db: Session, model, index_elements: List[str], keys: dict, deltas: dict):
+    """Suma los deltas a la fila, creándola si no existe (INSERT ... ON CONFLICT)"""
+    dialect = db.get_bind().dialect.name
+    insert = pg_insert if dialect == "postgresql" else sqlite_insert
+
+    stmt = insert(model).values(**keys, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={field: getattr(model, field) + getattr(stmt.excluded, field) for field in deltas}
+    )
+    db.execute(stmt)
+
+
+def _add(target: dict, deltas: dict):
+    for field, value in deltas.items():
+        target[field] += value
+
+
+def _empty() -> dict:
+    return {field: 0 for field in USAGE_FIELDS}
+
+
+class UsageMeter:
+    def __init__(self, shard_router, session_factory):
+        self.shard_router = shard_router
+        self.session_factory = session_factory
+        # Se anota desde los hilos de las peticiones a Groq
+        self._lock = threading.Lock()
+        self._calls: Dict[Tuple[int, int, str], dict] = defaultdict(_empty)  # (call_id, company_id, modelo)
+        self._companies: Dict[Tuple[int, datetime, str], dict] = defaultdict(_empty)  # (company_id, día, modelo)
+        self._unflushed_cost: Dict[Tuple[int, datetime], float] = defaultdict(float)
+        self._spent: Dict[Tuple[int, datetime], float] = {}  # Último gasto leído de la base de datos
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"recorded": 0, "flushes": 0, "downgraded": 0, "throttled": 0}
+
+    # ---------- Anotación (camino caliente, sin base de datos) ----------
+
+    def record(self, model: Optional[str], usage: dict):
+        """Anota el uso de una petición a Groq de la empresa/llamada de la petición actual"""
+        scope = _scope.get()
+        if scope is None:
+            return  # Uso sin empresa (p. ej. audio de mensajes fijos)
+        deltas = _empty()
+        deltas.update((field, value) for field, value in usage.items() if value)
+        deltas["requests"] = 1
+        deltas["cost_usd"] = estimate_cost(model, deltas)
+        day = bucket_start(datetime.utcnow(), "day")
+        model = model or "unknown"
+
+        with self._lock:
+            if scope.call_id is not None:
+                _add(self._calls[(scope.call_id, scope.company_id, model)], deltas)
+            _add(self._companies[(scope.company_id, day, model)], deltas)
+            self._unflushed_cost[(scope.company_id, day)] += deltas["cost_usd"]
+            self.stats["recorded"] += 1
+
+    def spent_today(self, company_id: int) -> float:
+        key = (company_id, bucket_start(datetime.utcnow(), "day"))
+        with self._lock:
+            return self._spent.get(key, 0.0) + self._unflushed_cost.get(key, 0.0)
+
+    def route_llm_model(self, model: str) -> str:
+        """
+        Modelo a usar para la empresa de la petición actual según su presupuesto.
+        Lanza BudgetExceededError si la empresa lo superó y está en modo throttle.
+        """
+        scope = _scope.get()
+        if scope is None or scope.daily_budget_usd is None:
+            return model
+        if self.spent_today(scope.company_id) < scope.daily_budget_usd:
+            return model
+        if scope.budget_action == BUDGET_THROTTLE:
+            self.stats["throttled"] += 1
+            raise BudgetExceededError("La empresa superó su presupuesto diario de IA")
+        self.stats["downgraded"] += 1
+        return BUDGET_DOWNGRADE_MODEL
+
+    def check_budget(self, company):
+        """Rechaza el turno antes de gastar en STT/LLM si la empresa está en throttle"""
+        if (
+            company is not None
+            and company.daily_budget_usd is not None
+            and company.budget_action == BUDGET_THROTTLE
+            and self.spent_today(company.id) >= company.daily_budget_usd
+        ):
+            self.stats["throttled"] += 1
+            raise BudgetExceededError("La empresa superó su presupuesto diario de IA")
+
+    # ---------- Volcado en segundo plano ----------
+
+    def start(self, interval: float = USAGE_FLUSH_SECONDS):
+        self._task = asyncio.create_task(self._flush_loop(interval))
+
+    async def stop(self):
+        """Detiene el worker y vuelca lo pendiente"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.flush)
+
+    async def _flush_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                print(f"❌ Error guardando el uso de Groq: {e}")
+
+    def flush(self):
+        with self._lock:
+            calls, self._calls = self._calls, defaultdict(_empty)
+            companies, self._companies = self._companies, defaultdict(_empty)
+
+        try:
+            self._write_calls(calls)
+            self._write_companies(companies)
+        except Exception:
+            # Se reintenta en el siguiente volcado
+            with self._lock:
+                for key, deltas in calls.items():
+                    _add(self._calls[key], deltas)
+                for key, deltas in companies.items():
+                    _add(self._companies[key], deltas)
+            raise
+
+        written_cost = defaultdict(float)
+        for (company_id, day, _), deltas in companies.items():
+            written_cost[(company_id, day)] += deltas["cost_usd"]
+        self.refresh_spent(written_cost)
+        self.stats["flushes"] += 1
+
+    def _write_calls(self, calls: dict):
+        """Escribe el uso por llamada; quita de calls lo que ya quedó confirmado"""
+        by_shard = defaultdict(list)
+        for (call_id, company_id, model), deltas in calls.items():
+            by_shard[self.shard_router.shard_for_call(call_id)].append((call_id, company_id, model, deltas))
+        for shard, rows in by_shard.items():
+            db = self.shard_router.sessionmakers[shard]()
+            try:
+                for call_id, company_id, model, deltas in rows:
+                    _upsert(db, CallUsage, ["call_id", "model"],
+                            {"call_id": call_id, "company_id": company_id, "model": model}, deltas)
+                db.commit()
+                for call_id, company_id, model, _ in rows:
+                    del calls[(call_id, company_id, model)]
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def _write_companies(self, companies: dict):
+        if not companies:
+            return
+        db = self.session_factory()
+        try:
+            for (company_id, day, model), deltas in companies.items():
+                _upsert(db, CompanyUsageRollup, ["company_id", "day", "model"],
+                        {"company_id": company_id, "day": day, "model": model}, deltas)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def refresh_spent(self, written_cost: Optional[dict] = None):
+        """Relee el gasto del día (de todos los workers) y descuenta lo ya volcado"""
+        day = bucket_start(datetime.utcnow(), "day")
+        db = self.session_factory()
+        try:
+            rows = (
+                db.query(CompanyUsageRollup.company_id, func.sum(CompanyUsageRollup.cost_usd))
+                .filter(CompanyUsageRollup.day == day)
+                .group_by(CompanyUsageRollup.company_id)
+                .all()
+            )
+        finally:
+            db.close()
+
+        with self._lock:
+            for key, cost in (written_cost or {}).items():
+                self._unflushed_cost[key] -= cost
+                if self._unflushed_cost[key] <= 1e-12:
+                    del self._unflushed_cost[key]
+            self._spent = {(company_id, day): total or 0.0 for company_id, total in rows}
+
+
+# ---------- Consultas del endpoint ----------
+
+def _totals(rows) -> dict:
+    totals = _empty()
+    for row in rows:
+        for field in USAGE_FIELDS:
+            totals[field] += getattr(row, field) or 0
+    totals["cost_usd"] = round(totals["cost_usd"], 6)
+    return totals
+
+
+def _row(row, *fields) -> dict:
+    data = {field: getattr(row, field) for field in fields}
+    data.update((field, getattr(row, field) or 0) for field in USAGE_FIELDS)
+    data["cost_usd"] = round(data["cost_usd"], 6)
+    return data
+
+
+def get_company_usage(
+    db: Session,
+    company_id: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> dict:
+    """Uso por empresa, día y modelo con los totales del periodo"""
+    query = db.query(CompanyUsageRollup)
+    if company_id is not None:
+        query = query.filter(CompanyUsageRollup.company_id == company_id)
+    if start is not None:
+        query = query.filter(CompanyUsageRollup.day >= bucket_start(start, "day"))
+    if end is not None:
+        query = query.filter(CompanyUsageRollup.day < end)
+    rows = query.order_by(CompanyUsageRollup.day, CompanyUsageRollup.company_id, CompanyUsageRollup.model).all()
+    return {
+        "days": [_row(row, "company_id", "day", "model") for row in rows],
+        "totals": _totals(rows),
+    }
+
+
+def get_call_usage(db: Session, call_id: int) -> dict:
+    rows = db.query(CallUsage).filter(CallUsage.call_id == call_id).order_by(CallUsage.model).all()
+    return {
+        "call_id": call_id,
+        "models": [_row(row, "model") for row in rows],
+        "totals": _totals(rows),
+    }
@@ -5,6 +5,49 @@ import { format } from 'date-fns'
 import { es } from 'date-fns/locale'
 import './CallDetail.css'
 
+const STAGE_LABELS = {
+  company_resolution: 'Empresa',
+  upload_read: 'Lectura de audio',
+  stt: 'Transcripción',
+  llm: 'Respuesta IA',
+  llm_prefetch: 'Respuesta anticipada',
+  tts: 'Voz',
+  db_commit: 'Base de datos',
+  twiml_render: 'TwiML'
+}
+
+// Cascada de tiempos de un turno: cada etapa es una barra en su posición dentro del total
+function TurnWaterfall({ trace }) {
+  const total = trace.total_ms || 1
+  return (
+    <div className="turn-trace">
+      <div className="turn-trace-header">
+        Tiempo del turno: {Math.round(trace.total_ms)} ms{trace.prefetched ? ' (respuesta anticipada)' : ''}
+      </div>
+      {trace.stages.map(([stage, start, duration], index) => (
+        <div key={index} className="turn-trace-row">
+          <div className="turn-trace-label">{STAGE_LABELS[stage] || stage}</div>
+          <div className="turn-trace-track">
+            <div
+              className={`turn-trace-bar ${stage}`}
+              style={{ left: `${(start / total) * 100}%`, width: `${Math.max((duration / total) * 100, 0.5)}%` }}
+            />
+          </div>
+          <div className="turn-trace-ms">{Math.round(duration)} ms</div>
+        </div>
+      ))}
+      {trace.upstream && trace.upstream.map((call, index) => (
+        <div key={index} className="turn-trace-upstream">
+          {call.op.toUpperCase()} · {call.model || 'modelo desconocido'}
+          {call.prompt_tokens != null && ` · ${call.prompt_tokens} + ${call.completion_tokens} tokens`}
+          {call.attempts && ` · ${call.attempts} intentos`}
+          {call.request_id && <span className="turn-trace-request-id"> · {call.request_id}</span>}
+        </div>
+      ))}
+    </div>
+  )
+}
+
 function CallDetail() {
   const { callId } = useParams()
   const navigate = useNavigate()
@@ -140,6 +183,7 @@ function CallDetail() {
                     )}
                   </div>
                   <div className="message-content">{message.content}</div>
+                  {message.trace && <TurnWaterfall trace={message.trace} />}
                 </div>
               ))
             ) : (